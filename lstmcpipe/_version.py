@@ -0,0 +1 @@
+__version__ = '0.1.dev16+g851982c.d20261018'
\ No newline at end of file
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the lstmcpipe orchestration (planning and submission of the jobs) on a synthetic AllSky-like production,
+using the fake slurm commands of `lstmcpipe.scripts.fake_slurm` instead of a cluster.
+
+The production has, for each pointing, GammaDiffuse and Protons training directories and a Gamma testing node, with
+empty simtel files. All the stages from r0_to_dl1 to dl2_to_irfs are submitted.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess as sp
+from pathlib import Path
+from ruamel.yaml import YAML
+
+from ..scripts import fake_slurm
+
+TRAINING_PARTICLES = ["GammaDiffuse", "Protons"]
+STAGES = ["r0_to_dl1", "merge_dl1", "train_pipe", "dl1_to_dl2", "dl2_to_irfs"]
+
+
+def generate_tree(base_dir, n_pointings, n_files):
+    """
+    Write the R0 directories of the production with `n_files` empty simtel files each.
+
+    Returns
+    -------
+    dict: {pointing: {particle: R0 dir}}
+    """
+    tree = {}
+    for index in range(n_pointings):
+        pointing = f"dec_{index}"
+        dirs = {
+            particle: Path(base_dir, "DL0", "TrainingDataset", particle, pointing) for particle in TRAINING_PARTICLES
+        }
+        dirs["Gamma"] = Path(base_dir, "DL0", "TestingDataset", "Gamma", f"node_{pointing}")
+        for particle, r0_dir in dirs.items():
+            r0_dir.mkdir(parents=True, exist_ok=True)
+            for run in range(n_files):
+                r0_dir.joinpath(f"{particle.lower()}_{pointing}_run{run}.simtel.gz").touch()
+        tree[pointing] = dirs
+    return tree
+
+
+def generate_config(base_dir, tree):
+    """
+    lstmcpipe config (paths of all the stages) of the production.
+    """
+    base_dir = Path(base_dir)
+    stages = {stage: [] for stage in STAGES}
+    for pointing, dirs in tree.items():
+        merged = {}
+        for particle, r0_dir in dirs.items():
+            dl1_dir = base_dir.joinpath("DL1", r0_dir.relative_to(base_dir.joinpath("DL0")))
+            merged[particle] = dl1_dir.parent.joinpath(f"dl1_{particle}_{dl1_dir.name}_merged.h5").as_posix()
+            stages["r0_to_dl1"].append({"input": r0_dir.as_posix(), "output": dl1_dir.as_posix()})
+            stages["merge_dl1"].append({"input": dl1_dir.as_posix(), "output": merged[particle]})
+
+        models_dir = base_dir.joinpath("models", pointing).as_posix()
+        dl2_dir = base_dir.joinpath("DL2", "TestingDataset", "Gamma", f"node_{pointing}")
+        stages["train_pipe"].append(
+            {"input": {"gamma": merged["GammaDiffuse"], "proton": merged["Protons"]}, "output": models_dir}
+        )
+        stages["dl1_to_dl2"].append({"input": merged["Gamma"], "path_model": models_dir, "output": dl2_dir.as_posix()})
+        stages["dl2_to_irfs"].append(
+            {
+                "input": {"gamma_file": dl2_dir.joinpath(Path(merged["Gamma"]).name.replace("dl1", "dl2")).as_posix()},
+                "output": base_dir.joinpath("IRF", f"irf_{pointing}.fits.gz").as_posix(),
+                "options": "--point-like",
+            }
+        )
+    return {
+        "workflow_kind": "lstchain",
+        "source_environment": {"source_file": "/dev/null", "conda_env": "benchmark"},
+        "prod_id": "orchestration_benchmark",
+        "stages_to_run": STAGES,
+        "stages": stages,
+    }
+
+
+def run_benchmark(
+    work_dir,
+    n_pointings=2,
+    n_files=10,
+    submit_latency=0.0,
+    n_submit_threads=None,
+    array_stages=(),
+):
+    """
+    Run lstmcpipe on a synthetic production with fake slurm commands.
+
+    Parameters
+    ----------
+    work_dir: str or Path
+    n_pointings: int
+    n_files: int
+        Number of simtel files per R0 directory
+    submit_latency: float
+        Duration of each sbatch call in seconds
+    n_submit_threads: int or None
+        `n_submit_threads` slurm config entry
+    array_stages: list of str
+        `array_stages` slurm config entry
+
+    Returns
+    -------
+    dict: timing results
+    """
+    work_dir = Path(work_dir).resolve()
+    state_dir = work_dir.joinpath("fake_slurm")
+    bin_dir = work_dir.joinpath("bin")
+    fake_slurm.install(bin_dir, state_dir, submit_latency=submit_latency)
+
+    start = time.time()
+    tree = generate_tree(work_dir.joinpath("prod"), n_pointings, n_files)
+    config = generate_config(work_dir.joinpath("prod"), tree)
+    config["slurm_config"] = {"n_submit_threads": n_submit_threads, "array_stages": list(array_stages)}
+    config_file = work_dir.joinpath("lstmcpipe_config.yml")
+    with open(config_file, "w") as f:
+        YAML().dump(config, f)
+    lstchain_config = work_dir.joinpath("lstchain_config.json")
+    lstchain_config.write_text("{}")
+    tree_time = time.time() - start
+
+    env = dict(
+        os.environ,
+        PATH=f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}",
+        LSTMCPIPE_PROD_LOGS=work_dir.joinpath("prod_logs").as_posix(),
+    )
+    start = time.time()
+    process = sp.run(
+        [sys.executable, "-m", "lstmcpipe.lstmcpipe_start", "-c", config_file, "-conf_lst", lstchain_config],
+        input="y\n",
+        env=env,
+        cwd=work_dir,
+        stdout=sp.PIPE,
+        stderr=sp.STDOUT,
+        encoding="utf-8",
+    )
+    end = time.time()
+    if process.returncode != 0:
+        raise RuntimeError(f"lstmcpipe failed:\n{process.stdout}")
+
+    jobs = fake_slurm.load_jobs(state_dir)
+    simulation = fake_slurm.Simulation(jobs, job_duration=0)
+    submissions = [job["submit"] for job in jobs]
+    n_tasks = sum(len(simulation.tasks(job["jobid"])) for job in jobs)
+    submission_time = max(submissions) - min(submissions) if submissions else 0.0
+    return {
+        "n_pointings": n_pointings,
+        "n_simtel_files": n_pointings * len(TRAINING_PARTICLES + ["Gamma"]) * n_files,
+        "n_jobs": len(jobs),
+        "n_tasks": n_tasks,
+        "tree_generation_s": tree_time,
+        "total_s": end - start,
+        "planning_s": min(submissions) - start if submissions else end - start,
+        "submission_s": submission_time,
+        "submissions_per_s": len(jobs) / submission_time if submission_time > 0 else float("nan"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("work_dir", type=Path, help="Directory of the synthetic production")
+    parser.add_argument("--n-pointings", type=int, default=2)
+    parser.add_argument("--n-files", type=int, default=10, help="Number of simtel files per R0 directory")
+    parser.add_argument("--submit-latency", type=float, default=0.0, help="Duration of each sbatch call (s)")
+    parser.add_argument("--n-submit-threads", type=int, default=None)
+    parser.add_argument("--array-stages", nargs="*", default=[], help="Stages batched as slurm arrays")
+    parser.add_argument("--output", type=Path, default=None, help="json file to write the results to")
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        args.work_dir,
+        n_pointings=args.n_pointings,
+        n_files=args.n_files,
+        submit_latency=args.submit_latency,
+        n_submit_threads=args.n_submit_threads,
+        array_stages=args.array_stages,
+    )
+    for key, value in results.items():
+        print(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
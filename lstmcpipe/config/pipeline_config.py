@@ -127,12 +127,33 @@ def complete_lstmcpipe_config(loaded_config):
         f"conda activate {loaded_config['source_environment']['conda_env']}; "
     )
     # 1 - Parse slurm user config account
-    slurm_account = loaded_config.get("slurm_config", {}).get("user_account", "")
+    slurm_config = loaded_config.get("slurm_config") or {}
+    slurm_account = slurm_config.get("user_account", "")
 
     # 2 - Create a dict for all env configuration and slurm configuration (batch arguments)
     config["batch_config"] = {
         "source_environment": src_env,
         "slurm_account": slurm_account,
+        "dl1_n_workers": slurm_config.get("dl1_n_workers"),
+        "dl1_target_job_duration": slurm_config.get("dl1_target_job_duration"),
+        "dl1_throughput_MBps": slurm_config.get("dl1_throughput_MBps"),
+        "dl1ab_throughput_MBps": slurm_config.get("dl1ab_throughput_MBps"),
+        "dl1_scratch_staging": slurm_config.get("dl1_scratch_staging", False),
+        "dl1_scratch_dir": slurm_config.get("dl1_scratch_dir"),
+        "dl1_write_behind": slurm_config.get("dl1_write_behind", False),
+        "dl1_prefetch_depth": slurm_config.get("dl1_prefetch_depth", 0),
+        "dl1_prefetch_max_gb": slurm_config.get("dl1_prefetch_max_gb"),
+        "stage_cache": loaded_config.get("stage_cache"),
+        "resource_history": loaded_config.get("resource_history"),
+        "resource_margin": loaded_config.get("resource_margin"),
+        "virtual_train_test_split": loaded_config.get("virtual_train_test_split", False),
+        "executor": loaded_config.get("executor", "slurm"),
+        "n_local_workers": loaded_config.get("n_local_workers"),
+        "local_memory_gb": loaded_config.get("local_memory_gb"),
+        "array_stages": slurm_config.get("array_stages", []),
+        "array_parallel_jobs": slurm_config.get("array_parallel_jobs"),
+        "max_array_size": slurm_config.get("max_array_size"),
+        "n_submit_threads": slurm_config.get("n_submit_threads"),
     }
 
     return config
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+# Graph of the jobs of a production.
+# Each node is one unit of a stage (one entry of its paths: inputs -> outputs) with the id of the job producing its
+# outputs. A unit only waits for the jobs producing its own inputs instead of all the jobs of the previous stage,
+# e.g. the dl1_to_dl2 job of a pointing starts as soon as its merged file and its models exist.
+
+import logging
+from pathlib import Path
+from .utils import join_jobids
+
+log = logging.getLogger(__name__)
+
+
+def flatten_paths(paths):
+    """
+    Resolved paths of a paths entry, that can be a path, a list of paths or a dict of paths (e.g. train_pipe inputs).
+    Values that are not paths are ignored.
+
+    Returns
+    -------
+    list of Path
+    """
+    if paths is None:
+        return []
+    if isinstance(paths, dict):
+        paths = list(paths.values())
+    if not isinstance(paths, (list, tuple)):
+        paths = [paths]
+    flat = []
+    for path in paths:
+        if isinstance(path, (dict, list, tuple)):
+            flat.extend(flatten_paths(path))
+        elif isinstance(path, (str, Path)):
+            # other values (e.g. the train/test split ratio) are not paths
+            flat.append(Path(path).resolve())
+    return flat
+
+
+def is_related(input_path, output_path):
+    """
+    An input is produced by a job if it is one of its outputs, if it is inside one of its output directories or if it
+    is a directory containing one of its outputs.
+    """
+    return input_path == output_path or output_path in input_path.parents or input_path in output_path.parents
+
+
+class JobDag:
+    """
+    Jobs of a production, as (inputs -> outputs) units with their job ids.
+
+    Parameters
+    ----------
+    db: `lstmcpipe.io.production_db.ProductionDB` or None
+        Database of the production, where the input and output files of the units are recorded
+    """
+
+    def __init__(self, db=None):
+        self.nodes = []
+        self.db = db
+
+    def add(self, stage, inputs, outputs, jobid=""):
+        """
+        Add a unit of a stage.
+
+        Parameters
+        ----------
+        stage: str
+        inputs: str, list or dict
+        outputs: str, list or dict
+        jobid: str
+            Comma-separated job ids (or `jobid_task` ids of array tasks) producing the outputs.
+            Empty if the outputs already exist (e.g. restored from the stage cache).
+        """
+        node = {
+            "stage": stage,
+            "inputs": flatten_paths(inputs),
+            "outputs": flatten_paths(outputs),
+            "jobid": jobid or "",
+        }
+        self.nodes.append(node)
+        if self.db is not None:
+            self.db.add_unit(stage, node["inputs"], node["outputs"], node["jobid"])
+
+    def producers(self, input_path):
+        """
+        Nodes producing a (resolved) input path
+        """
+        return [node for node in self.nodes if any(is_related(input_path, out) for out in node["outputs"])]
+
+    def dependencies(self, inputs, barrier=""):
+        """
+        Jobs to wait for before running a unit with the given inputs.
+
+        Parameters
+        ----------
+        inputs: str, list or dict
+        barrier: str
+            Comma-separated job ids to wait for if an input is not produced by any known unit, usually all the jobs of
+            the previous stage.
+
+        Returns
+        -------
+        str: comma-separated job ids
+        """
+        jobids = []
+        for input_path in flatten_paths(inputs):
+            producers = self.producers(input_path)
+            if producers:
+                jobids.extend(node["jobid"] for node in producers)
+            else:
+                jobids.append(barrier or "")
+        return join_jobids(*jobids)
+
+    def stage_jobids(self, stage):
+        """
+        Comma-separated job ids of all the units of a stage
+        """
+        return join_jobids(*[node["jobid"] for node in self.nodes if node["stage"] == stage])
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+# Backends running the jobs of the stages.
+# The slurm backend submits them with sbatch. The local backend runs the same commands on the current machine, sharing
+# its cores and memory and respecting the dependencies between jobs (e.g. for quick-look productions on a large node).
+
+import os
+import logging
+import itertools
+import threading
+import subprocess as sp
+from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import Future
+
+from .utils import run_sbatch, memory_to_mb
+
+log = logging.getLogger(__name__)
+
+# exit code of local jobs not run because one of their dependencies failed
+DEPENDENCY_FAILED = -1
+
+
+class SlurmExecutor:
+    """
+    Submit the jobs with sbatch
+    """
+
+    name = "slurm"
+
+    def submit(self, stage):
+        """
+        Parameters
+        ----------
+        stage: `lstmcpipe.utils.SbatchLstMCStage`
+
+        Returns
+        -------
+        str: job id
+        """
+        return run_sbatch(stage.slurm_command)
+
+    def wait(self):
+        """
+        Jobs are run by slurm, nothing to wait for.
+        """
+        return True
+
+
+class LocalExecutor:
+    """
+    Run the jobs on the local machine.
+
+    A job starts once all its dependencies succeeded (slurm `afterok`) and is not run if one of them failed.
+    Jobs waiting for their dependencies do not use any resource. A ready job starts when the cores (`cpus-per-task`,
+    1 by default) and the memory (`mem`) it requests are available, in submission order among the ready jobs.
+    The tasks of a job array get the `SLURM_ARRAY_TASK_ID` and `SLURM_ARRAY_TASK_COUNT` environment variables as with
+    slurm, so that the same commands can be run.
+
+    Parameters
+    ----------
+    n_workers: int or None
+        Number of cores shared by the running jobs. Default: number of cores of the machine
+    memory_gb: float or None
+        Memory in GB shared by the running jobs. Default: physical memory of the machine
+    """
+
+    name = "local"
+
+    def __init__(self, n_workers=None, memory_gb=None):
+        self.n_workers = n_workers or os.cpu_count()
+        self.memory_mb = memory_gb * 1024 if memory_gb else physical_memory_mb()
+        self._free_cpus = self.n_workers
+        self._free_memory_mb = self.memory_mb
+        self._pending = []
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._jobids = itertools.count(1)
+
+    def submit(self, stage):
+        """
+        Parameters
+        ----------
+        stage: `lstmcpipe.utils.SbatchLstMCStage`
+
+        Returns
+        -------
+        str: job id
+        """
+        options = stage.slurm_options
+        return self.submit_command(
+            stage.shell_command,
+            dependencies=options.get("dependencies"),
+            output=options.get("output"),
+            error=options.get("error"),
+            array=options.get("array"),
+            cpus=options.get("cpus-per-task"),
+            mem=options.get("mem"),
+        )
+
+    def submit_command(self, cmd, dependencies=None, output=None, error=None, array=None, cpus=None, mem=None):
+        """
+        Queue a shell command.
+
+        Parameters
+        ----------
+        cmd: str
+        dependencies: str
+            Comma-separated job ids (or `jobid_task` ids of array tasks) that must succeed before running the command
+        output: str
+            stdout file, `%j`, `%A` and `%a` are replaced as by slurm. Default: `./slurm-%j.o`
+        error: str
+            stderr file. Default: `./slurm-%j.e`
+        array: str
+            slurm array specification (`first-last%parallel`), the command is run once per task
+        cpus: int or str
+            Cores used by each task (slurm `cpus-per-task`). Default: 1
+        mem: str
+            Memory used by each task, with the slurm syntax (e.g. `16GB`). Default: no memory reserved
+
+        Returns
+        -------
+        str: job id
+        """
+        # a job requesting more than the machine would never start
+        cpus = min(int(cpus or 1), self.n_workers)
+        memory_mb = min(memory_to_mb(mem) if mem else 0, self.memory_mb)
+        with self._lock:
+            jobid = str(next(self._jobids))
+            wait_for = [future for dep in (dependencies or "").split(",") if dep for future in self._find(dep)]
+            tasks = parse_array(array)
+            futures = []
+            for task in tasks:
+                env = None
+                if task is not None:
+                    env = dict(os.environ, SLURM_ARRAY_TASK_ID=str(task), SLURM_ARRAY_TASK_COUNT=str(len(tasks)))
+                futures.append(Future())
+                self._pending.append(
+                    _LocalTask(
+                        cmd,
+                        wait_for,
+                        log_file(output or "./slurm-%j.o", jobid, task),
+                        log_file(error or "./slurm-%j.e", jobid, task),
+                        env,
+                        cpus,
+                        memory_mb,
+                        futures[-1],
+                    )
+                )
+                if task is not None:
+                    self._jobs[f"{jobid}_{task}"] = [futures[-1]]
+            self._jobs[jobid] = futures
+            self._dispatch()
+        return jobid
+
+    def _find(self, jobid):
+        if jobid not in self._jobs:
+            log.warning(f"Unknown dependency {jobid} of a local job, ignored")
+            return []
+        return self._jobs[jobid]
+
+    def _dispatch(self):
+        # called with the lock held, whenever a job is submitted or finished.
+        # Dependencies are always submitted before the jobs waiting for them, so a failure propagates in one pass.
+        pending = []
+        for task in self._pending:
+            if any(future.done() and future.result() != 0 for future in task.wait_for):
+                log.error(f"Local job not run as one of its dependencies failed: {task.cmd}")
+                task.future.set_result(DEPENDENCY_FAILED)
+            elif (
+                all(future.done() for future in task.wait_for)
+                and task.cpus <= self._free_cpus
+                and task.memory_mb <= self._free_memory_mb
+            ):
+                self._free_cpus -= task.cpus
+                self._free_memory_mb -= task.memory_mb
+                threading.Thread(target=self._run, args=(task,), name="lstmcpipe_local", daemon=True).start()
+            else:
+                pending.append(task)
+        self._pending = pending
+
+    def _run(self, task):
+        try:
+            for filename in (task.output, task.error):
+                Path(filename).parent.mkdir(exist_ok=True, parents=True)
+            with open(task.output, "w") as out, open(task.error, "w") as err:
+                returncode = sp.run(
+                    task.cmd, shell=True, executable="/bin/bash", stdout=out, stderr=err, env=task.env
+                ).returncode
+        except Exception as e:
+            log.error(f"Local job {task.cmd} could not be run: {e}")
+            returncode = 1
+        with self._lock:
+            self._free_cpus += task.cpus
+            self._free_memory_mb += task.memory_mb
+            task.future.set_result(returncode)
+            self._dispatch()
+
+    def wait(self):
+        """
+        Wait for all the submitted jobs.
+
+        Returns
+        -------
+        bool: True if all the jobs succeeded
+        """
+        with self._lock:
+            futures = [future for jobid, job in self._jobs.items() if "_" not in jobid for future in job]
+        return all(future.result() == 0 for future in futures)
+
+
+_LocalTask = namedtuple("_LocalTask", ["cmd", "wait_for", "output", "error", "env", "cpus", "memory_mb", "future"])
+
+
+def physical_memory_mb():
+    """
+    Physical memory of the machine in MB
+    """
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**2
+
+
+def parse_array(array):
+    """
+    Task ids of a slurm array specification, e.g. `0-9%4` or `1,3,5`. [None] if not an array.
+    """
+    if not array:
+        return [None]
+    tasks = []
+    for item in str(array).split("%")[0].split(","):
+        first, _, last = item.partition("-")
+        tasks.extend(range(int(first), int(last or first) + 1))
+    return tasks
+
+
+def log_file(pattern, jobid, task=None):
+    """
+    Log file of a local job, replacing the slurm filename patterns.
+    """
+    task_jobid = jobid if task is None else f"{jobid}_{task}"
+    return (
+        str(pattern).replace("%A", jobid).replace("%a", "" if task is None else str(task)).replace("%j", task_jobid)
+    )
+
+
+EXECUTORS = {"slurm": SlurmExecutor, "local": LocalExecutor}
+_executors = {}
+
+
+def get_executor(batch_config):
+    """
+    Executor selected by the `executor` entry of the batch config (`slurm` by default).
+    The same instance is returned for all the stages of a production.
+
+    Parameters
+    ----------
+    batch_config: dict
+
+    Returns
+    -------
+    `SlurmExecutor` or `LocalExecutor`
+    """
+    batch_config = batch_config or {}
+    kind = batch_config.get("executor") or "slurm"
+    if kind not in EXECUTORS:
+        raise ValueError(f"Unknown executor {kind}, valid executors are {', '.join(EXECUTORS)}")
+    if kind not in _executors:
+        if kind == "local":
+            _executors[kind] = LocalExecutor(
+                n_workers=batch_config.get("n_local_workers"), memory_gb=batch_config.get("local_memory_gb")
+            )
+        else:
+            _executors[kind] = EXECUTORS[kind]()
+    return _executors[kind]
@@ -5,11 +5,76 @@
 
 import os
 import argparse
+import subprocess
 from lstmcpipe.hiperta.reorganize_dl1hiperta300_to_dl1lstchain060 import (
     main as reorganize_dl1,
 )
 
 
+def hiperta_output_filename(infile, outdir):
+    """Name of the dl1 file written by hiperta_r0_dl1 for `infile`"""
+    return os.path.join(outdir, "dl1_" + os.path.basename(infile))
+
+
+def reorganized_filename(infile, outdir):
+    """Name of the reorganized lstchain dl1 file of `infile`"""
+    return os.path.join(outdir, "dl1v06_reorganized_" + os.path.basename(infile))
+
+
+def run_hiperta(infile, outdir, config, debug_mode=False):
+    """
+    Run hiperta_r0_dl1 on a r0 file
+
+    Parameters
+    ----------
+    infile: str
+        mc r0 file
+    outdir: str
+        directory where hiperta writes its dl1 file
+    config: str
+        configuration file for hiperta_r1_dl1
+    debug_mode: bool
+        add the cleaned mask in the output hdf5
+
+    Returns
+    -------
+    str: the hiperta dl1 file
+
+    Raises
+    ------
+    subprocess.CalledProcessError if hiperta_r0_dl1 fails
+    """
+    # TODO. Hardcoded. Change `--selectedtel 1` when various tels available
+    cmd_hiperta = ["hiperta_r0_dl1", "-i", str(infile), "-c", str(config), "-o", str(outdir), "--selectedtel", "1"]
+    if debug_mode:  # in HiPeRTA
+        cmd_hiperta.append("-g")
+    subprocess.run(cmd_hiperta, check=True)
+    return hiperta_output_filename(infile, outdir)
+
+
+def reorganize(output_hiperta_filename, output_reorganized_filename, keep_file=False):
+    """
+    Reorganize a hiperta dl1 file to the lstchain v0.6 data model
+
+    Parameters
+    ----------
+    output_hiperta_filename: str
+    output_reorganized_filename: str
+    keep_file: bool
+        keep the hiperta dl1 file
+
+    Returns
+    -------
+    str: the reorganized file
+    """
+    reorganize_dl1(output_hiperta_filename, output_reorganized_filename)
+
+    # Erase the hiperta dl1 file created ?
+    if not keep_file:
+        os.remove(output_hiperta_filename)
+    return output_reorganized_filename
+
+
 def main():
     """Run hiperta_r0_dl1 and reorganize_dl1hipertaV300_to_dl1lstchain060"""
     parser = argparse.ArgumentParser(
@@ -58,20 +123,8 @@ def main():
 
     os.makedirs(args.outdir, exist_ok=True)
 
-    # TODO. Hardcoded. Change `--selectedtel 1` when various tels available
-    cmd_hiperta = f"hiperta_r0_dl1 -i {args.infile} -c {args.config} -o {args.outdir} --selectedtel 1"
-    if args.debug_mode:  # in HiPeRTA
-        cmd_hiperta += " -g"
-    os.system(cmd_hiperta)
-
-    # We know in advance the name of the output
-    output_hiperta_filename = os.path.join(args.outdir, "dl1_" + os.path.basename(args.infile))
-    output_reorganized_filename = os.path.join(args.outdir, "dl1v06_reorganized_" + os.path.basename(args.infile))
-    reorganize_dl1(output_hiperta_filename, output_reorganized_filename)
-
-    # Erase the hiperta dl1 file created ?
-    if not args.keep_file:
-        os.remove(output_hiperta_filename)
+    output_hiperta_filename = run_hiperta(args.infile, args.outdir, args.config, debug_mode=args.debug_mode)
+    reorganize(output_hiperta_filename, reorganized_filename(args.infile, args.outdir), keep_file=args.keep_file)
 
     print("\nDone.")
 
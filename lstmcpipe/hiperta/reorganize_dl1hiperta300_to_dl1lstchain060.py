@@ -7,10 +7,11 @@ import os
 import tables
 import argparse
 import numpy as np
-from astropy.table import Table, vstack, join
+from astropy.table import Table
 from astropy.io.misc.hdf5 import write_table_hdf5
 from lstmcpipe.hiperta.reorganize_dl1hiperta_to_dl1lstchain import (
     add_disp_and_mc_type_to_parameters_table,
+    join_mc_event,
 )
 
 parser = argparse.ArgumentParser(
@@ -36,8 +37,59 @@ parser.add_argument(
     default="./dl1v0.6_reorganized.h5",
 )
 
+parser.add_argument(
+    "--chunk-size",
+    type=int,
+    dest="chunk_size",
+    help="Number of rows of the image and parameters tables copied at once. 10000 by default.",
+    default=10000,
+)
+
+
+def stack_tables_by_chunks(hfile_out, tables_to_stack, newparent_pointer, newname, chunk_size, modify_chunk=None):
+    """
+    Stack tables into a new table of the output file, copying `chunk_size` rows at a time so that the memory used does
+    not depend on the size of the tables. The stacked tables are removed from the output file once copied.
 
-def stack_and_write_images_table(input_filename, hfile_out, node_dl1_event):
+    Parameters
+    hfile_out : output File pointer
+    tables_to_stack : list of the `tel_00X` tables to stack
+    newparent_pointer : parent node of the new table
+    newname : [str] name of the new table
+    chunk_size : [int] number of rows copied at once
+    modify_chunk : function applied to each chunk of rows (numpy structured array), returning the rows to write
+    """
+    modify_chunk = modify_chunk or (lambda rows: rows)
+    expected_rows = sum(table.nrows for table in tables_to_stack)
+    new_table = None
+
+    for table in tables_to_stack:
+        for start in range(0, table.nrows, chunk_size):
+            rows = modify_chunk(table.read(start, start + chunk_size))
+            if new_table is None:
+                # extendable table sized for all the rows
+                new_table = hfile_out.create_table(
+                    newparent_pointer,
+                    newname,
+                    description=rows.dtype,
+                    expectedrows=expected_rows,
+                    filters=table.filters,
+                )
+            chunk = np.empty(len(rows), dtype=new_table.dtype)
+            for name in new_table.colnames:
+                chunk[name] = rows[name]
+            new_table.append(chunk)
+        hfile_out.remove_node(table)
+
+    if new_table is None:
+        # only empty tables
+        rows = modify_chunk(tables_to_stack[0].read(0, 0))
+        new_table = hfile_out.create_table(newparent_pointer, newname, description=rows.dtype)
+    new_table.flush()
+    return new_table
+
+
+def stack_and_write_images_table(input_filename, hfile_out, node_dl1_event, chunk_size=10000):
     """
     Stack all the `tel_00X` image tables (in case they exit) and write in the v0.6 file
 
@@ -45,44 +97,31 @@ def stack_and_write_images_table(input_filename, hfile_out, node_dl1_event):
     input_filename : [ste] input hfile name
     hfile_out : output File pointer
     node_dl1_event : Output hfile (V0.6) dl1.event node pointer
+    chunk_size : [int] number of rows copied at once
     """
     telescope_node = node_dl1_event.telescope
 
-    imag_per_tels = [Table(table_img.read()) for table_img in telescope_node.images]
-    image_table = vstack(imag_per_tels)
-
-    for tab in telescope_node.images:
-        hfile_out.remove_node(tab)
-
     # Todo change names of column `image_mask` to `` ??
 
-    dump_plus_copy_node_to_create_new_table(
-        input_filename,
+    stack_tables_by_chunks(
         hfile_out,
-        image_table,
+        list(telescope_node.images),
         hfile_out.root.dl1.event.telescope.image,
-        newname_pointer="LST_LSTCam",
-        tmp_name="imgsTable",
+        "LST_LSTCam",
+        chunk_size,
     )
 
 
-def stack_and_write_parameters_table(input_filename, hfile_out, node_dl1_event, output_mc_table_pointer):
+def modify_parameters_chunk(rows, mc_event):
     """
-    Stack all the `tel_00X` parameters tables (of v0.8), change names of the columns and write the table in the
-    V0.6 (lstchain like) format
+    Change the names of the columns of a chunk of a v0.8 parameters table, compute the missing parameters and join it
+    with the mc_shower table
 
     Parameters
-    hfile_out : output File pointer
-    node_dl1_event : Output hfile (V0.6) dl1.event node pointer
-    output_mc_table_pointer : output subarray node pointer
+    rows : chunk of a `tel_00X` parameters table (numpy structured array)
+    mc_event : mc_shower table without `obs_id`, sorted by event_id (numpy structured array)
     """
-    telescope_node = node_dl1_event.telescope
-
-    param_per_tels = [Table(table_param.read()) for table_param in telescope_node.parameters]
-    parameter_table = vstack(param_per_tels)
-
-    for tab in telescope_node.parameters:
-        hfile_out.remove_node(tab)
+    parameter_table = Table(rows)
 
     parameter_table.rename_column("hillas_intensity", "intensity")
     parameter_table.rename_column("hillas_x", "x")
@@ -101,19 +140,37 @@ def stack_and_write_parameters_table(input_filename, hfile_out, node_dl1_event,
     parameter_table.add_column(np.log10(parameter_table["intensity"]), name="log_intensity")
     parameter_table.add_column(parameter_table["width"] / parameter_table["length"], name="wl")
 
-    # Param table is indeed huge - it contains all the mc_events parameters (from v0.6 !!) too
-    mc_event_table = Table(output_mc_table_pointer.mc_shower.read())
-    mc_event_table.remove_column("obs_id")
-    parameter_table = join(parameter_table, mc_event_table, keys="event_id")
+    parameter_table = join_mc_event(parameter_table, mc_event)
     parameter_table.add_column(np.log10(parameter_table["mc_energy"]), name="log_mc_energy")
+    return parameter_table.as_array()
 
-    dump_plus_copy_node_to_create_new_table(
-        input_filename,
+
+def stack_and_write_parameters_table(
+    input_filename, hfile_out, node_dl1_event, output_mc_table_pointer, chunk_size=10000
+):
+    """
+    Stack all the `tel_00X` parameters tables (of v0.8), change names of the columns and write the table in the
+    V0.6 (lstchain like) format
+
+    Parameters
+    hfile_out : output File pointer
+    node_dl1_event : Output hfile (V0.6) dl1.event node pointer
+    output_mc_table_pointer : output subarray node pointer
+    chunk_size : [int] number of rows copied at once
+    """
+    telescope_node = node_dl1_event.telescope
+
+    # Param table is indeed huge - it contains all the mc_events parameters (from v0.6 !!) too
+    mc_event = output_mc_table_pointer.mc_shower.read()
+    mc_event = np.sort(mc_event[[name for name in mc_event.dtype.names if name != "obs_id"]], order="event_id")
+
+    stack_tables_by_chunks(
         hfile_out,
-        parameter_table,
+        list(telescope_node.parameters),
         hfile_out.root.dl1.event.telescope.parameters,
-        newname_pointer="LST_LSTCam",
-        tmp_name="paramsTable",
+        "LST_LSTCam",
+        chunk_size,
+        modify_chunk=lambda rows: modify_parameters_chunk(rows, mc_event),
     )
 
 
@@ -196,6 +253,7 @@ def create_hfile_out(
     config_pointer08,
     dl1_pointer,
     filter_pointer,
+    chunk_size=10000,
 ):
     """
     Create output hfile (lstchainv0.6 like hdf5 file)
@@ -207,6 +265,7 @@ def create_hfile_out(
     config_pointer08 : dl1-file_v.08_configuration pointer
     dl1_pointer :  dl1-file_v0.8_dl1 pointer
     filter_pointer : dl1-file_v0.8 filters pointer
+    chunk_size : [int] number of rows of the image and parameters tables copied at once
     """
     hfile_out = tables.open_file(outfile_name, "w")
     hfile_out.create_group("/", "simulation")
@@ -275,20 +334,23 @@ def create_hfile_out(
     )
 
     rename_mc_shower_colnames(input_filename, hfile_out, dl1_event_node06, subarray_pointer)
-    stack_and_write_parameters_table(input_filename, hfile_out, dl1_event_node06, subarray_pointer)
+    stack_and_write_parameters_table(
+        input_filename, hfile_out, dl1_event_node06, subarray_pointer, chunk_size=chunk_size
+    )
     if "image" in dl1_event_node06.telescope:
-        stack_and_write_images_table(input_filename, hfile_out, dl1_event_node06)
+        stack_and_write_images_table(input_filename, hfile_out, dl1_event_node06, chunk_size=chunk_size)
 
     hfile_out.close()
 
 
-def main(input_filename, output_filename):
+def main(input_filename, output_filename, chunk_size=10000):
     """
     Conversion from dl1 data model (ctapipe and hiper(CTA)RTA) data model, and convert it to lstchain_v0.6 data mode.
 
     Parameters
     input_filename : [str] Input filename
     output_filename : [str] Output filename
+    chunk_size : [int] number of rows of the image and parameters tables copied at once
     """
     hfile = tables.open_file(input_filename, "r")
 
@@ -305,6 +367,7 @@ def main(input_filename, output_filename):
         configuration_v08,
         dl1_v08,
         filter_v08,
+        chunk_size=chunk_size,
     )
 
     # Add disp_* and mc_type to the parameters table.
@@ -315,4 +378,4 @@ def main(input_filename, output_filename):
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    main(args.infile, args.outfile)
+    main(args.infile, args.outfile, chunk_size=args.chunk_size)
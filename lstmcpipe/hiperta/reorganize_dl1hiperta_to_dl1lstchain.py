@@ -6,14 +6,13 @@
 # Usage :
 # $ python reorganize_dl1_file -i input.h5 [-o outname.h5]
 
-import os
 import copy
 import tables
 import argparse
 import numpy as np
 import pandas as pd
 import astropy.units as u
-from astropy.table import join, Table, vstack, Column
+from astropy.table import Table, Column
 from ctapipe.coordinates import CameraFrame
 from astropy.time import Time
 from astropy.coordinates import SkyCoord, EarthLocation, AltAz
@@ -56,6 +55,14 @@ parser.add_argument(
     default="./dl1_reorganized.h5",
 )
 
+parser.add_argument(
+    "--chunk-size",
+    type=int,
+    dest="chunk_size",
+    help="Number of events of a telescope reorganized at once. 10000 by default.",
+    default=10000,
+)
+
 
 def add_column_table(table, ColClass, col_label, values):
     """
@@ -74,16 +81,48 @@ def add_column_table(table, ColClass, col_label, values):
     -------
     `tables.table.Table`
     """
-    # Step 1: Adjust table description
+    return add_columns_table(table, {col_label: (ColClass, values)})
+
+
+def add_columns_table(table, columns, chunk_size=100000):
+    """
+    Add several columns to a pytable Table in a single rewrite of the table.
+
+    The table is copied by chunks of rows as structured arrays, the new columns being filled with numpy
+    instead of appending the rows one by one.
+
+    Parameters
+    ----------
+    table: `tables.table.Table`
+    columns: dict
+        {col_label: (ColClass, values)} of the columns to add, in that order
+    chunk_size: int
+        number of rows copied at once
+
+    Returns
+    -------
+    `tables.table.Table`
+    """
+    # Step 1: Adjust table description, new columns are placed after the existing ones
     d = table.description._v_colobjects.copy()  # original description
-    d[col_label] = ColClass()  # add column
+    for pos, (col_label, (ColClass, values)) in enumerate(columns.items(), start=len(d)):
+        if len(values) != table.nrows:
+            raise ValueError(f"{len(values)} values given for the column {col_label} of a {table.nrows} rows table")
+        d[col_label] = ColClass(pos=pos)
 
     # Step 2: Create new temporary table:
     newtable = tables.Table(table._v_file.root, "_temp_table", d, filters=table.filters)  # new table
     table.attrs._f_copy(newtable)  # copy attributes
-    # Copy table rows, also add new column values:
-    for row, value in zip(table, values):
-        newtable.append([tuple(list(row[:]) + [value])])
+    # Copy table rows by chunks, also add new column values:
+    for start in range(0, table.nrows, chunk_size):
+        stop = min(start + chunk_size, table.nrows)
+        rows = table.read(start, stop)
+        chunk = np.empty(stop - start, dtype=newtable.dtype)
+        for name in rows.dtype.names:
+            chunk[name] = rows[name]
+        for col_label, (ColClass, values) in columns.items():
+            chunk[col_label] = values[start:stop]
+        newtable.append(chunk)
     newtable.flush()
 
     # Step 3: Move temporary table to original location:
@@ -172,7 +211,105 @@ def sky_to_camera(alt, az, focal, pointing_alt, pointing_az):
     return camera_pos
 
 
-def add_disp_and_mc_type_to_parameters_table(dl1_file, table_path):
+def sky_to_camera_numpy(alt, az, focal, pointing_alt, pointing_az):
+    """
+    Numpy implementation of `sky_to_camera` for a fixed pointing.
+
+    Both directions are in the same horizontal frame, so the transformation is a rotation bringing the pointing to the
+    camera center, followed by the equidistant projection of `ctapipe.coordinates.CameraFrame` (without rotation).
+
+    Parameters
+    ----------
+    alt: astropy Quantity
+    az: astropy Quantity
+    focal: astropy Quantity
+    pointing_alt: pointing altitude in angle unit
+    pointing_az: pointing altitude in angle unit
+
+    Returns
+    -------
+    (x, y): astropy Quantities in the unit of `focal`
+    """
+    alt = clip_alt(alt).to_value(u.rad)
+    delta_az = (az - pointing_az).to_value(u.rad)
+    pointing_alt = clip_alt(pointing_alt).to_value(u.rad)
+
+    # cartesian coordinates of the direction in the frame where the pointing is along the first axis
+    x_pointing = np.cos(alt) * np.cos(delta_az)
+    along = x_pointing * np.cos(pointing_alt) + np.sin(alt) * np.sin(pointing_alt)
+    lateral = np.cos(alt) * np.sin(delta_az)
+    vertical = np.sin(alt) * np.cos(pointing_alt) - x_pointing * np.sin(pointing_alt)
+
+    fov_lon = np.arctan2(lateral, along)
+    fov_lat = np.arctan2(vertical, np.hypot(along, lateral))
+
+    return fov_lat * focal, fov_lon * focal
+
+
+def disp_and_mc_type_columns(params, focal, run_array_dir, dl1_file, use_astropy=False):
+    """
+    Compute the disp parameters, source position, pointing and mc_type columns of a DL1 parameters table.
+
+    Parameters
+    ----------
+    params: `numpy.ndarray`, `astropy.table.Table` or `pandas.DataFrame` with the `mc_alt`, `mc_az`, `x` and `y` columns
+    focal: float
+        equivalent focal length in meters
+    run_array_dir: array
+        (az, alt) pointing direction of the run in radians
+    dl1_file: str
+        name of the DL1 file, giving the mc_type
+    use_astropy: bool
+        compute the source position with the astropy frames (`sky_to_camera`) instead of `sky_to_camera_numpy`
+
+    Returns
+    -------
+    dict
+        {col_label: values} of the new columns, in the order they are added to the table
+    """
+    n_events = len(params["x"])
+    transformation = sky_to_camera if use_astropy else sky_to_camera_numpy
+    source_pos_in_camera = transformation(
+        np.asarray(params["mc_alt"]) * u.rad,
+        np.asarray(params["mc_az"]) * u.rad,
+        focal * u.m,
+        run_array_dir[1] * u.rad,
+        run_array_dir[0] * u.rad,
+    )
+    if use_astropy:
+        src_x, src_y = source_pos_in_camera.x, source_pos_in_camera.y
+    else:
+        src_x, src_y = source_pos_in_camera
+
+    disp_parameters = disp(
+        np.asarray(params["x"]) * u.m,
+        np.asarray(params["y"]) * u.m,
+        src_x,
+        src_y,
+    )
+
+    columns = {
+        "disp_dx": disp_parameters[0].value,
+        "disp_dy": disp_parameters[1].value,
+        "disp_norm": disp_parameters[2].value,
+        "disp_angle": disp_parameters[3].value,
+        "disp_sign": disp_parameters[4],
+        "src_x": src_x.to_value(u.m),
+        "src_y": src_y.to_value(u.m),
+        "mc_alt_tel": np.ones(n_events) * run_array_dir[1],
+        "mc_az_tel": np.ones(n_events) * run_array_dir[0],
+    }
+    if "gamma" in dl1_file:
+        columns["mc_type"] = np.zeros(n_events)
+    if "electron" in dl1_file:
+        columns["mc_type"] = np.ones(n_events)
+    if "proton" in dl1_file:
+        columns["mc_type"] = 101 * np.ones(n_events)
+
+    return {col_label: np.asarray(values, dtype=np.float32) for col_label, values in columns.items()}
+
+
+def add_disp_and_mc_type_to_parameters_table(dl1_file, table_path, use_astropy=False):
     """
     HARDCODED function obtained from `lstchain.reco.dl0_to_dl1` because `mc_alt_tel` and `mc_az_tel` are zipped within
     `run_array_direction`.
@@ -190,6 +327,8 @@ def add_disp_and_mc_type_to_parameters_table(dl1_file, table_path):
 
     table_path: path to the parameters table in the file
 
+    use_astropy: compute the source position with the astropy frames instead of the numpy implementation
+
     Returns
     -------
         None
@@ -200,73 +339,30 @@ def add_disp_and_mc_type_to_parameters_table(dl1_file, table_path):
         focal = copy.copy(hfile.root.instrument.telescope.optics.col("equivalent_focal_length")[0])
 
     df = pd.read_hdf(dl1_file, key=table_path)
-    source_pos_in_camera = sky_to_camera(
-        df.mc_alt.values * u.rad,
-        df.mc_az.values * u.rad,
-        focal * u.m,
-        run_array_dir[1] * u.rad,
-        run_array_dir[0] * u.rad,
-    )
-
-    disp_parameters = disp(
-        df.x.values * u.m,
-        df.y.values * u.m,
-        source_pos_in_camera.x,
-        source_pos_in_camera.y,
-    )
+    columns = disp_and_mc_type_columns(df, focal, run_array_dir, dl1_file, use_astropy=use_astropy)
 
+    # all the columns are added in a single rewrite of the table
     with tables.open_file(dl1_file, mode="a") as file:
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, "disp_dx", disp_parameters[0].value)
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, "disp_dy", disp_parameters[1].value)
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, "disp_norm", disp_parameters[2].value)
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, "disp_angle", disp_parameters[3].value)
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, "disp_sign", disp_parameters[4])
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, "src_x", source_pos_in_camera.x.value)
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, "src_y", source_pos_in_camera.y.value)
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, "mc_alt_tel", np.ones(len(df)) * run_array_dir[1])
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, "mc_az_tel", np.ones(len(df)) * run_array_dir[0])
-        if "gamma" in dl1_file:
-            tab = file.root[table_path]
-            add_column_table(tab, tables.Float32Col, "mc_type", np.zeros(len(df)))
-        if "electron" in dl1_file:
-            tab = file.root[table_path]
-            add_column_table(tab, tables.Float32Col, "mc_type", np.ones(len(df)))
-        if "proton" in dl1_file:
-            tab = file.root[table_path]
-            add_column_table(tab, tables.Float32Col, "mc_type", 101 * np.ones(len(df)))
-
-
-def create_final_h5(hfile, hfile_tmp, hfile_tmp2, output_filename):
+        add_columns_table(
+            file.root[table_path],
+            {col_label: (tables.Float32Col, values) for col_label, values in columns.items()},
+        )
+
+
+def create_hfile_out(hfile, output_filename):
     """
     Create the final output HDF5 file.
     It copies /instruments and /simulations nodes from the output of hipecta_hdf5_r1_to_dl1.py,
-        - and /dl1/event from the created table.
-        - and includes the image and pulse_time within the correct path, i.e., /dl1/event/telescope/
-
-    TODO: Define somehow the paths globally so that it can be used .get_node()
+    the /dl1/event tables being written afterwards by chunks of events.
 
     Parameters
     ----------
-        hfile: [obj, astropy.table.table.Table] output file
-        hfile_tmp: [obj, astropy.table.table.Table] hdf5 file with dl1 parameters. path:
-                    `dl1/event/telescope/parameters/LST_LSTCam`
-        hfile_tmp2: [obj, astropy.table.table.Table] hdf5 file with images and pulse_time. path:
-                    `dl1/event/telescope/image/LST_LSTCam`
+        hfile: [obj, tables.file.File] input hiperta/hipecta file
         output_filename: [str] name of output file
 
     Returns
     -------
-        None
-
+        hfile_out: [obj, tables.file.File] output file, opened in write mode
     """
     # The complevel MUST be set to zero, otherwise this version of libhdf5 does NOT accept the copy_node()
     filter = tables.Filters(
@@ -280,16 +376,39 @@ def create_final_h5(hfile, hfile_tmp, hfile_tmp2, output_filename):
     hfile_out = tables.open_file(output_filename, "w")
     hfile_out.copy_node(hfile.root.instrument, newparent=hfile_out.root, recursive=True, filters=filter)
     hfile_out.copy_node(hfile.root.simulation, newparent=hfile_out.root, recursive=True, filters=filter)
-    hfile_out.copy_node(hfile_tmp.root.dl1, newparent=hfile_out.root, recursive=True)
-    hfile_out.copy_children(
-        hfile_tmp2.root.dl1.event.telescope,
-        hfile_out.root.dl1.event.telescope,
-        recursive=True,
-    )
 
     # Move the telescope table from /instrument/subarray to /instrument (lstchain output file dl1 format)
     hfile_out.move_node("/instrument/subarray/telescope", newparent="/instrument", createparents=True)
-    hfile_out.close()
+    return hfile_out
+
+
+def append_rows(hfile_out, table_path, rows):
+    """
+    Append rows to a table of the output file, creating the table with the first rows.
+
+    Parameters
+    ----------
+        hfile_out: [obj, tables.file.File] output file
+        table_path: [str] path of the table in the file
+        rows: [obj, astropy.table.table.Table] rows to append
+
+    Returns
+    -------
+        None
+    """
+    if len(rows) == 0:
+        return
+    array = rows.as_array()
+    where, name = ("/" + table_path).rsplit("/", 1)
+    if "/" + table_path not in hfile_out:
+        hfile_out.create_table(where, name, obj=array, createparents=True)
+        return
+    table = hfile_out.get_node(where, name)
+    # the columns of every telescope are written in the order of the first one
+    chunk = np.empty(len(array), dtype=table.dtype)
+    for name in table.colnames:
+        chunk[name] = array[name]
+    table.append(chunk)
 
 
 def modify_params_table(table, tel_id, focal=28):
@@ -329,121 +448,144 @@ def modify_params_table(table, tel_id, focal=28):
     table.add_column(table["width"] / table["length"], name="wl")
 
 
-def stack_by_telid(dl1_pointer, focal=28):
+def get_tel_ids(dl1_pointer):
     """
-    Stack :
-        - LST telescopes' parameters into a table
-        - Calibrated images and pulse_times into another table
+    Telescope ids of the hiperta/hipecta dl1 groups
 
     Parameters
     ----------
         dl1_pointer: [obj, tables.group.Group] pointer of the input hdf5 file `hfile.root.dl1`
-        focal: [float] focal length in meters  # TODO: deprecated, done at hipecta/rta level
 
     Returns
     -------
-        Two tables [obj, astropy.table.table.Table] containing the parameters, and the images and pulse_times int their
-            respective path
+        list of int
     """
-
-    tels_params = [Table(tel.parameters.read()) for tel in dl1_pointer]
     try:
-        tel_ids = [tel["telId"][0] for tel in dl1_pointer]
+        return [tel["telId"][0] for tel in dl1_pointer]
     except:  # noqa
         # if the tel_id column does not exist, we assign tel ids by simple iteration
-        tel_ids = [i + 1 for i in range(len(tels_params))]
+        return [i + 1 for i, _ in enumerate(dl1_pointer)]
 
-    for tab, tel_id in zip(tels_params, tel_ids):
-        modify_params_table(tab, tel_id, focal=focal)
 
-    # tabs = [Table(tel) for tel in tels_params]
+def join_mc_event(table, mc_event):
+    """
+    Inner join of a chunk of a parameters table with the mc_event table on `event_id`.
+    Unlike `astropy.table.join`, the rows keep the order of `table`.
+
+    Parameters
+    ----------
+        table: [obj, astropy.table.table.Table] chunk of a parameters table
+        mc_event: [obj, numpy.ndarray] mc_event table, sorted by event_id
+
+    Returns
+    -------
+        [obj, astropy.table.table.Table] the rows of `table` with a simulated event, and the mc_event columns
+    """
+    index = np.searchsorted(mc_event["event_id"], table["event_id"])
+    index = np.clip(index, 0, max(len(mc_event) - 1, 0))
+    matched = np.zeros(len(table), dtype=bool)
+    if len(mc_event) > 0:
+        matched = mc_event["event_id"][index] == table["event_id"]
+    table = table[matched]
+    for name in mc_event.dtype.names:
+        if name not in table.colnames:
+            table[name] = mc_event[name][index[matched]]
+    return table
+
+
+def reorganize_chunk(params, images, tel_id, mc_event, focal, run_array_dir, output_filename):
+    """
+    Reorganize a chunk of events of one telescope:
+        - modify the parameters table and join it with the mc_event table
+        - add the disp, source position and mc_type columns
+        - add the tel_id and event_id to the images
 
-    stacked_param = vstack(tels_params)
+    Parameters
+    ----------
+        params: [obj, numpy.ndarray] chunk of the hiperta/hipecta parameters table
+        images: [obj, numpy.ndarray] matching chunk of the calib_pic table
+        tel_id: [int] telescope identifier
+        mc_event: [obj, numpy.ndarray] mc_event table, sorted by event_id
+        focal: [float] focal length in meters
+        run_array_dir: [array] (az, alt) pointing direction of the run in radians
+        output_filename: [str] name of output file, giving the mc_type
 
-    images = [Table(tel.calib_pic.read()) for tel in dl1_pointer]
+    Returns
+    -------
+        Two tables [obj, astropy.table.table.Table] containing the parameters, and the images and pulse_times
+    """
+    table_dl1 = Table(params)
+    modify_params_table(table_dl1, tel_id, focal=focal)
 
-    # adding stupid tel_id to the image table as well
-    for image_tab, tel_id in zip(images, tel_ids):
-        image_tab.add_column(Column(tel_id * np.ones(len(image_tab)), dtype=int), name="tel_id")
+    # Join together with the mc_events, compute log of mc_energy
+    table_dl1 = join_mc_event(table_dl1, mc_event)
+    table_dl1.add_column(np.log10(table_dl1["mc_energy"]), name="log_mc_energy")
 
-    stacked_images = vstack(images)
-    if "event_id" not in stacked_images.columns:
-        stacked_images.add_column(stacked_param["event_id"])
+    if len(table_dl1) > 0:
+        for col_label, values in disp_and_mc_type_columns(table_dl1, focal, run_array_dir, output_filename).items():
+            table_dl1[col_label] = values
 
-    try:
+    table_imags = Table(images)
+    # adding stupid tel_id to the image table as well
+    table_imags.add_column(Column(tel_id * np.ones(len(table_imags)), dtype=int), name="tel_id")
+    if "eventId" in table_imags.colnames:
         #  HiPeCTA case
-        stacked_images.rename_column("eventId", "event_id")
-    except KeyError:
+        table_imags.rename_column("eventId", "event_id")
+    elif "event_id" not in table_imags.colnames:
         #  HiPeRTA case
-        pass
+        table_imags.add_column(params["event_id"], name="event_id")
 
-    return stacked_param, stacked_images
+    return table_dl1, table_imags
 
 
-def reorganize_dl1(input_filename, output_filename):
+def reorganize_dl1(input_filename, output_filename, chunk_size=10000):
     """
     Reorganize the output dl1 files of hiperta/hipecta codes to reach the same structure found in lstchain dl1 files.
 
+    The events are read by chunks of `chunk_size` rows per telescope and written directly in the final file, so that
+    each event is read and written once and the memory used does not depend on the size of the file.
+    The telescopes are stacked one after the other.
+
     Parameters
     ----------
         input_filename: str
             Input filename
         output_filename: str
             Output filename
+        chunk_size: int
+            Number of events of a telescope processed at once
     Returns
     -------
         None. It dumps the final hdf5 file with the correct structure.
 
     """
-    hfile = tables.open_file(input_filename, "r")
-
-    # Pointers
-    dl1 = hfile.root.dl1
-    mc_event = Table(hfile.root.simulation.mc_event.read())
-
-    # Temporal names for temporal files, later erased
-    _param = (
-        str(os.path.abspath(output_filename).rsplit("/", 1)[0])
-        + "/dl1_prams_tmp_"
-        + str(os.path.basename(input_filename))
-    )
-    _images = (
-        str(os.path.abspath(output_filename).rsplit("/", 1)[0])
-        + "/dl1_imags_tmp_"
-        + str(os.path.basename(input_filename))
-    )
-
-    # File has not been reorganized yet ! Thus, the path for optics is inside /instrument/subarray/telescope
-    # only valid for LSTs !
-    focal = hfile.root.instrument.subarray.telescope.optics.col("equivalent_focal_length")[0]
-    table_dl1, table_imags = stack_by_telid(dl1, focal=focal)
-
-    # Join together with the mc_events, compute log of mc_energy and dump it
-    table_dl1 = join(table_dl1, mc_event, keys="event_id")
-    table_dl1.add_column(np.log10(table_dl1["mc_energy"]), name="log_mc_energy")
-
-    # write tmp files
-    table_dl1.write(_param, format="hdf5", path=dl1_params_lstcam_key, overwrite=True)
-    table_imags.write(_images, format="hdf5", path=dl1_images_lstcam_key, overwrite=True)
-
-    # open tmp files
-    _hfile_param = tables.open_file(_param, "r")
-    _hfile_imags = tables.open_file(_images, "r")
-
-    create_final_h5(hfile, _hfile_param, _hfile_imags, output_filename)
-
-    # Add disp_* and mc_type to the parameters table
-    add_disp_and_mc_type_to_parameters_table(output_filename, dl1_params_lstcam_key)
-
-    # Close and erase
-    _hfile_param.close()
-    _hfile_imags.close()
-    os.remove(_param)
-    os.remove(_images)
-
-    hfile.close()
+    with tables.open_file(input_filename, "r") as hfile:
+        # Pointers
+        dl1 = hfile.root.dl1
+        mc_event = np.sort(hfile.root.simulation.mc_event.read(), order="event_id")
+        run_array_dir = copy.copy(hfile.root.simulation.run_config.col("run_array_direction")[0])
+        # File has not been reorganized yet ! Thus, the path for optics is inside /instrument/subarray/telescope
+        # only valid for LSTs !
+        focal = hfile.root.instrument.subarray.telescope.optics.col("equivalent_focal_length")[0]
+
+        with create_hfile_out(hfile, output_filename) as hfile_out:
+            for tel, tel_id in zip(dl1, get_tel_ids(dl1)):
+                n_rows = max(tel.parameters.nrows, tel.calib_pic.nrows)
+                for start in range(0, n_rows, chunk_size):
+                    stop = start + chunk_size
+                    table_dl1, table_imags = reorganize_chunk(
+                        tel.parameters.read(start, stop),
+                        tel.calib_pic.read(start, stop),
+                        tel_id,
+                        mc_event,
+                        focal,
+                        run_array_dir,
+                        output_filename,
+                    )
+                    append_rows(hfile_out, dl1_params_lstcam_key, table_dl1)
+                    append_rows(hfile_out, dl1_images_lstcam_key, table_imags)
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    reorganize_dl1(args.infile, args.outfile)
+    reorganize_dl1(args.infile, args.outfile, chunk_size=args.chunk_size)
@@ -0,0 +1,203 @@
+import astropy.units as u
+import numpy as np
+import pytest
+import tables
+from astropy.table import Table, join, vstack
+
+from ..reorganize_dl1hiperta_to_dl1lstchain import (
+    add_column_table,
+    add_columns_table,
+    disp_and_mc_type_columns,
+    dl1_images_lstcam_key,
+    dl1_params_lstcam_key,
+    reorganize_dl1,
+    sky_to_camera,
+    sky_to_camera_numpy,
+)
+from ..reorganize_dl1hiperta300_to_dl1lstchain060 import stack_and_write_images_table, stack_and_write_parameters_table
+
+
+class Parameters(tables.IsDescription):
+    event_id = tables.Int64Col(pos=0)
+    intensity = tables.Float64Col(pos=1)
+
+
+def make_table(path, n_rows):
+    with tables.open_file(path, "w") as file:
+        table = file.create_table("/dl1", "parameters", Parameters, createparents=True)
+        table.append(np.rec.fromarrays([np.arange(n_rows), np.linspace(1, 100, n_rows)], dtype=table.dtype))
+        table.attrs.source = "hiperta"
+
+
+def test_add_columns_table(tmp_path):
+    path = tmp_path / "dl1.h5"
+    make_table(path, 250)
+    src_x = np.random.default_rng(0).normal(size=250)
+    with tables.open_file(path, "a") as file:
+        columns = {"src_x": (tables.Float32Col, src_x), "mc_type": (tables.Int32Col, np.full(250, 101))}
+        add_columns_table(file.root.dl1.parameters, columns, chunk_size=100)
+        add_column_table(file.root.dl1.parameters, tables.Float32Col, "wl", np.ones(250))
+
+    with tables.open_file(path) as file:
+        table = file.root.dl1.parameters
+        assert table.colnames == ["event_id", "intensity", "src_x", "mc_type", "wl"]
+        assert table.attrs.source == "hiperta"
+        np.testing.assert_array_equal(table.col("event_id"), np.arange(250))
+        np.testing.assert_array_equal(table.col("src_x"), src_x.astype(np.float32))
+        assert (table.col("mc_type") == 101).all()
+        assert "_temp_table" not in file.root
+
+        with pytest.raises(ValueError):
+            add_column_table(table, tables.Float32Col, "short", np.ones(10))
+
+
+class HipertaParameters(tables.IsDescription):
+    event_id = tables.Int64Col()
+    intensity = tables.Float32Col()
+    width = tables.Float32Col()
+    length = tables.Float32Col()
+    x = tables.Float32Col()
+    y = tables.Float32Col()
+    leakage_intensity1 = tables.Float32Col()
+    leakage_intensity2 = tables.Float32Col()
+    leakage_pixel1 = tables.Float32Col()
+    leakage_pixel2 = tables.Float32Col()
+    nb_selected_pixel = tables.Int32Col()
+
+
+def make_hiperta_file(path, events_per_tel, mc_event_ids):
+    rng = np.random.default_rng(1)
+    with tables.open_file(path, "w") as file:
+        for tel, event_ids in enumerate(events_per_tel):
+            params = file.create_table(f"/dl1/Tel_{tel + 1}", "parameters", HipertaParameters, createparents=True)
+            rows = np.zeros(len(event_ids), dtype=params.dtype)
+            rows["event_id"] = event_ids
+            for name in ["intensity", "width", "length"]:
+                rows[name] = rng.uniform(1, 2, len(event_ids))
+            for name in ["x", "y"]:
+                rows[name] = rng.uniform(-0.5, 0.5, len(event_ids))
+            params.append(rows)
+            images = np.zeros(len(event_ids), dtype=[("image", np.float32, (4,))])
+            images["image"] = rng.normal(size=(len(event_ids), 4))
+            file.create_table(f"/dl1/Tel_{tel + 1}", "calib_pic", obj=images)
+
+        mc_event = np.zeros(
+            len(mc_event_ids),
+            dtype=[("event_id", np.int64), ("mc_energy", np.float32), ("mc_alt", np.float32), ("mc_az", np.float32)],
+        )
+        mc_event["event_id"] = mc_event_ids[::-1]
+        mc_event["mc_energy"] = rng.uniform(0.1, 10, len(mc_event_ids))
+        mc_event["mc_alt"] = 1.2 + rng.normal(scale=0.01, size=len(mc_event_ids))
+        mc_event["mc_az"] = 3.1 + rng.normal(scale=0.01, size=len(mc_event_ids))
+        file.create_table("/simulation", "mc_event", obj=mc_event, createparents=True)
+        run_config = np.array([([3.1, 1.2],)], dtype=[("run_array_direction", np.float64, (2,))])
+        file.create_table("/simulation", "run_config", obj=run_config)
+        optics = np.array([(28.0,)], dtype=[("equivalent_focal_length", np.float32)])
+        file.create_table("/instrument/subarray/telescope", "optics", obj=optics, createparents=True)
+
+
+def test_reorganize_dl1(tmp_path):
+    input_file = tmp_path / "hiperta_proton.h5"
+    make_hiperta_file(input_file, [np.arange(10), np.arange(5)], np.arange(9))
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    reorganize_dl1(str(input_file), str(out_dir / "dl1_proton.h5"), chunk_size=3)
+    reorganize_dl1(str(input_file), str(out_dir / "dl1_proton_one_chunk.h5"))
+    # no temporary files
+    assert sorted(path.name for path in out_dir.iterdir()) == ["dl1_proton.h5", "dl1_proton_one_chunk.h5"]
+
+    with tables.open_file(out_dir / "dl1_proton.h5") as file:
+        assert "/instrument/telescope/optics" in file
+        params = file.get_node("/" + dl1_params_lstcam_key).read()
+        images = file.get_node("/" + dl1_images_lstcam_key).read()
+    with tables.open_file(out_dir / "dl1_proton_one_chunk.h5") as file:
+        np.testing.assert_array_equal(file.get_node("/" + dl1_params_lstcam_key).read(), params)
+
+    # the event 9 of the first telescope has no simulated shower
+    np.testing.assert_array_equal(params["tel_id"], [1] * 9 + [2] * 5)
+    np.testing.assert_array_equal(params["event_id"], list(range(9)) + list(range(5)))
+    assert len(images) == 15
+    np.testing.assert_array_equal(images["event_id"], list(range(10)) + list(range(5)))
+    assert "n_pixels" in params.dtype.names
+    assert (params["mc_type"] == 101).all()
+    np.testing.assert_allclose(params["log_mc_energy"], np.log10(params["mc_energy"]))
+    expected = disp_and_mc_type_columns(params, 28.0, [3.1, 1.2], "proton", use_astropy=True)
+    for name, values in expected.items():
+        np.testing.assert_allclose(params[name], values, rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize("pointing_alt, pointing_az", [(70, 180), (20, 359), (90, 10), (45, 0)])
+def test_sky_to_camera_numpy(pointing_alt, pointing_az):
+    rng = np.random.default_rng(2)
+    alt = np.clip(pointing_alt + rng.normal(scale=2, size=1000), -90, 91) * u.deg
+    az = (pointing_az + rng.normal(scale=2, size=1000)) * u.deg
+    focal = 28 * u.m
+    expected = sky_to_camera(alt, az, focal, pointing_alt * u.deg, pointing_az * u.deg)
+    x, y = sky_to_camera_numpy(alt.to(u.rad), az.to(u.rad), focal, pointing_alt * u.deg, pointing_az * u.deg)
+    assert x.unit == u.m
+    np.testing.assert_allclose(x.to_value(u.m), expected.x.to_value(u.m), atol=1e-6)
+    np.testing.assert_allclose(y.to_value(u.m), expected.y.to_value(u.m), atol=1e-6)
+
+
+def make_v08_tables(path, n_rows_per_tel):
+    rng = np.random.default_rng(3)
+    hillas = ["intensity", "x", "y", "r", "phi", "length", "width", "psi", "skewness", "kurtosis"]
+    columns = [("obs_id", np.int32), ("event_id", np.int64), ("tel_id", np.int16)]
+    columns += [(f"hillas_{name}", np.float64) for name in hillas]
+    columns += [("timing_slope", np.float64), ("timing_intercept", np.float64)]
+    columns += [("morphology_num_pixels", np.int32), ("morphology_num_islands", np.int32)]
+    with tables.open_file(path, "w") as file:
+        for tel_id, n_rows in enumerate(n_rows_per_tel, start=1):
+            params = np.zeros(n_rows, dtype=columns)
+            params["event_id"] = rng.permutation(n_rows + 5)[:n_rows]
+            params["tel_id"] = tel_id
+            for name in hillas + ["timing_slope", "timing_intercept"]:
+                key = name if name.startswith("timing") else f"hillas_{name}"
+                params[key] = rng.uniform(1, 2, n_rows)
+            file.create_table("/dl1/event/telescope/parameters", f"tel_{tel_id:03d}", obj=params, createparents=True)
+            images = np.zeros(n_rows, dtype=[("event_id", np.int64), ("tel_id", np.int16), ("image", np.float32, 5)])
+            images["event_id"], images["tel_id"] = params["event_id"], tel_id
+            images["image"] = rng.normal(size=(n_rows, 5))
+            file.create_table("/dl1/event/telescope/images", f"tel_{tel_id:03d}", obj=images, createparents=True)
+        file.create_group("/dl1/event/telescope", "image")
+        # event 0 was not simulated
+        mc_shower = np.zeros(
+            max(n_rows_per_tel) + 4, dtype=[("obs_id", np.int32), ("event_id", np.int64), ("mc_energy", np.float64)]
+        )
+        mc_shower["event_id"] = np.arange(1, len(mc_shower) + 1)[::-1]
+        mc_shower["mc_energy"] = rng.uniform(0.1, 10, len(mc_shower))
+        file.create_table("/dl1/event/subarray", "mc_shower", obj=mc_shower, createparents=True)
+
+
+def test_stack_tables_by_chunks(tmp_path):
+    path = tmp_path / "dl1.h5"
+    make_v08_tables(path, [23, 10, 0])
+    with tables.open_file(path) as file:
+        telescope = file.root.dl1.event.telescope
+        expected_images = vstack([Table(table.read()) for table in telescope.images])
+        expected_params = vstack([Table(table.read()) for table in telescope.parameters])
+        mc_shower = Table(file.root.dl1.event.subarray.mc_shower.read())
+        mc_shower.remove_column("obs_id")
+        expected_params = join(expected_params, mc_shower, keys="event_id")
+
+    with tables.open_file(path, "a") as file:
+        event = file.root.dl1.event
+        stack_and_write_parameters_table(str(path), file, event, event.subarray, chunk_size=4)
+        stack_and_write_images_table(str(path), file, event, chunk_size=4)
+
+    with tables.open_file(path) as file:
+        telescope = file.root.dl1.event.telescope
+        assert telescope.parameters._v_children.keys() == {"LST_LSTCam"}
+        assert telescope.images._v_children.keys() == set()
+        images = telescope.image.LST_LSTCam.read()
+        params = telescope.parameters.LST_LSTCam.read()
+
+    np.testing.assert_array_equal(images, expected_images.as_array())
+    # the rows are stacked telescope by telescope, the join does not sort them by event_id
+    params = np.sort(params, order=["event_id", "tel_id"])
+    assert len(params) == len(expected_params)
+    assert {"intensity", "n_islands", "wl", "log_intensity", "mc_energy", "log_mc_energy"} <= set(params.dtype.names)
+    for name in ["event_id", "tel_id", "hillas_intensity", "mc_energy"]:
+        expected = np.sort(expected_params.as_array(), order=["event_id", "tel_id"])[name]
+        np.testing.assert_array_equal(params[{"hillas_intensity": "intensity"}.get(name, name)], expected)
+    np.testing.assert_allclose(params["log_mc_energy"], np.log10(params["mc_energy"]))
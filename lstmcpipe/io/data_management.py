@@ -3,6 +3,7 @@
 import os
 import sys
 import shutil
+import tables
 from pathlib import Path
 from distutils.util import strtobool
 
@@ -106,6 +107,38 @@ def get_input_filelist(data_path, glob_pattern=None):
     return [file.resolve().as_posix() for file in _path]
 
 
+def is_complete_hdf5_file(filename, required_nodes=(), min_size=0, required_attrs=()):
+    """
+    Check that a file is a readable HDF5 file, larger than `min_size` bytes and containing all the `required_nodes`
+    and root attributes `required_attrs`.
+
+    Parameters
+    ----------
+    filename: str or Path
+    required_nodes: list of str
+        HDF5 paths, e.g. "/dl1/event/telescope/parameters"
+    min_size: int
+        Minimum size of the file in bytes
+    required_attrs: list of str
+        Attributes of the root node, e.g. "LSTCHAIN_VERSION"
+
+    Returns
+    -------
+    bool
+    """
+    filename = Path(filename)
+    try:
+        if not filename.is_file() or filename.stat().st_size < min_size:
+            return False
+        with tables.open_file(filename, mode="r") as file:
+            return all(node in file for node in required_nodes) and all(
+                attr in file.root._v_attrs for attr in required_attrs
+            )
+    except Exception:
+        # any error opening the file means it is not complete (truncated, not HDF5, still being written...)
+        return False
+
+
 def check_and_make_dir(directory):
     """
     Check if a directory exists or contains data before to makedir.
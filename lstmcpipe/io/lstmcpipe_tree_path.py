@@ -3,6 +3,7 @@
 import shutil
 from pathlib import Path
 from lstmcpipe import prod_logs, __version__
+from lstmcpipe.utils import join_jobids
 
 
 def backup_log(file):
@@ -102,10 +103,8 @@ def update_scancel_file(scancel_file, jobids_to_update):
     jobids_to_update: str
         job_ids to be included into the the file
     """
-    if scancel_file.stat().st_size == 0:
-        with open(scancel_file, "r+") as f:
-            f.write(f"scancel {jobids_to_update}")
-
-    else:
-        with open(scancel_file, "a") as f:
-            f.write(f",{jobids_to_update}")
+    if not jobids_to_update:
+        return
+    jobids = scancel_file.read_text().replace("scancel", "").strip()
+    with open(scancel_file, "w") as f:
+        f.write(f"scancel {join_jobids(jobids, jobids_to_update)}")
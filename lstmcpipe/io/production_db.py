@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+
+# Database of a production.
+#
+# The jobs of a production (with their commands, dependencies and states), the tasks of the job arrays, the input and
+# output files of each job and the logs of the stages are written in a SQLite file in the log directory of the
+# production, through a single connection and with batched inserts.
+# The YAML log files are exported from it after each stage.
+# The log directory is on a shared filesystem and the database is also written from the compute nodes (resource history
+# of the production check job): it uses the rollback journal, as WAL needs shared memory on a single host.
+
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from ruamel.yaml import YAML
+
+from .lstmcpipe_tree_path import backup_log
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    jobid TEXT PRIMARY KEY,
+    stage TEXT NOT NULL,
+    command TEXT,
+    dependencies TEXT NOT NULL DEFAULT '',
+    state TEXT NOT NULL DEFAULT 'SUBMITTED',
+    submitted REAL,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    jobid TEXT NOT NULL,
+    task INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'SUBMITTED',
+    updated REAL,
+    PRIMARY KEY (jobid, task)
+);
+CREATE TABLE IF NOT EXISTS files (
+    jobid TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    path TEXT NOT NULL,
+    direction TEXT NOT NULL CHECK (direction IN ('input', 'output'))
+);
+CREATE TABLE IF NOT EXISTS log_sections (
+    section INTEGER PRIMARY KEY,
+    log_type TEXT NOT NULL,
+    stage TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS log_entries (
+    section INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS resubmissions (
+    old TEXT PRIMARY KEY,
+    new TEXT NOT NULL,
+    reason TEXT,
+    attempt INTEGER NOT NULL,
+    mem TEXT,
+    time TEXT,
+    submitted REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_stage ON jobs (stage);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE INDEX IF NOT EXISTS files_jobid ON files (jobid);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+CREATE INDEX IF NOT EXISTS log_entries_section ON log_entries (section);
+"""
+
+# job id of the files of a unit not produced by a job (e.g. restored from the stage cache)
+NO_JOB = ""
+
+_DEPENDENCY_PATTERN = re.compile(r"--dependency=\w+:(\S+)")
+
+
+class ProductionDB:
+    """
+    SQLite database of the jobs, files and logs of a production.
+
+    Records are buffered and written in a single transaction by `flush`, which is called when the buffer is full,
+    after each stage and when the database is closed.
+    The database can be used from several threads.
+
+    Parameters
+    ----------
+    filename: str or Path
+        SQLite file, created if it does not exist
+    buffer_size: int
+        Number of buffered records triggering a flush
+    """
+
+    def __init__(self, filename, buffer_size=10000):
+        self.filename = Path(filename)
+        self.buffer_size = buffer_size
+        self._lock = threading.RLock()
+        # writers on other hosts lock the whole file, wait for them
+        self._connection = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=DELETE")
+        self._connection.executescript(SCHEMA)
+        self._pending = {"jobs": [], "tasks": [], "files": [], "log_entries": []}
+        self._next_section = self._connection.execute(
+            "SELECT COALESCE(MAX(section), 0) + 1 FROM log_sections"
+        ).fetchone()[0]
+        self._sections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_jobs(self, stage, jobid2cmd):
+        """
+        Record submitted jobs. Their dependencies are read from the `--dependency` option of their sbatch command.
+
+        Parameters
+        ----------
+        stage: str
+        jobid2cmd: dict
+            {jobid: batch command}, as logged by the stages
+        """
+        now = time.time()
+        with self._lock:
+            for jobid, command in jobid2cmd.items():
+                match = _DEPENDENCY_PATTERN.search(str(command))
+                dependencies = match.group(1).replace(":", ",") if match else ""
+                self._pending["jobs"].append((str(jobid), stage, str(command), dependencies, now, now))
+            self._flush_if_full()
+
+    def add_unit(self, stage, inputs, outputs, jobid=""):
+        """
+        Record the input and output files of a unit of a stage, see `lstmcpipe.dag.JobDag.add`.
+        The tasks of job arrays (`jobid_task` ids) are recorded in the tasks table.
+
+        Parameters
+        ----------
+        stage: str
+        inputs: list of Path
+        outputs: list of Path
+        jobid: str
+            Comma-separated job ids, empty if the outputs are not produced by a job
+        """
+        now = time.time()
+        jobids = [j for j in (jobid or "").split(",") if j] or [NO_JOB]
+        with self._lock:
+            for job in jobids:
+                array_jobid, _, task = job.partition("_")
+                if task:
+                    self._pending["tasks"].append((array_jobid, int(task), now))
+                for direction, paths in (("input", inputs), ("output", outputs)):
+                    self._pending["files"].extend((job, stage, Path(p).as_posix(), direction) for p in paths)
+            self._flush_if_full()
+
+    def add_log(self, log_type, stage, dictionary):
+        """
+        Record a log of a stage, as written in the YAML log files.
+
+        Parameters
+        ----------
+        log_type: str
+            `log_file` or `debug_file`
+        stage: str
+        dictionary: dict
+        """
+        with self._lock:
+            section = self._next_section
+            self._next_section += 1
+            self._sections.append((section, log_type, stage))
+            self._pending["log_entries"].extend(
+                (section, str(key), json.dumps(value, default=str)) for key, value in dictionary.items()
+            )
+            self._flush_if_full()
+
+    def set_states(self, states):
+        """
+        Update the states of jobs or array tasks. Array tasks not recorded yet are added.
+
+        Parameters
+        ----------
+        states: dict
+            {jobid or `jobid_task`: state}, e.g. as reported by sacct
+        """
+        self.flush()
+        now = time.time()
+        jobs, tasks = [], []
+        for jobid, state in states.items():
+            array_jobid, _, task = str(jobid).partition("_")
+            if task:
+                tasks.append((state, now, array_jobid, int(task)))
+            else:
+                jobs.append((state, now, array_jobid))
+        with self._lock, self._connection:
+            self._connection.executemany("UPDATE jobs SET state = ?, updated = ? WHERE jobid = ?", jobs)
+            # the tasks of the arrays not built from units (e.g. r0_to_dl1 file batches) are only known from slurm
+            self._connection.executemany(
+                "INSERT INTO tasks (state, updated, jobid, task) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (jobid, task) DO UPDATE SET state = excluded.state, updated = excluded.updated",
+                tasks,
+            )
+
+    def set_dependencies(self, jobid, dependencies):
+        """
+        Update the dependencies of a job.
+
+        Parameters
+        ----------
+        jobid: str
+        dependencies: str
+            Comma-separated job ids
+        """
+        self.flush()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE jobs SET dependencies = ?, updated = ? WHERE jobid = ?", (dependencies, time.time(), jobid)
+            )
+
+    def add_resubmission(self, old, new, reason, attempt, mem=None, time_limit=None):
+        """
+        Record that a failed job or array task was resubmitted. The files of the old unit are recorded for the new one.
+
+        Parameters
+        ----------
+        old: str
+            jobid or `jobid_task` of the failed unit
+        new: str
+            jobid or `jobid_task` of the resubmitted unit
+        reason: str
+            slurm state of the failed unit
+        attempt: int
+            Number of the resubmission of the unit (1 for the first one)
+        mem: str or None
+            Memory requested for the new unit
+        time_limit: str or None
+            Time limit of the new unit
+        """
+        self.flush()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO resubmissions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (old, new, reason, attempt, mem, time_limit, time.time()),
+            )
+            self._connection.execute(
+                "INSERT INTO files SELECT ?, stage, path, direction FROM files WHERE jobid = ?", (new, old)
+            )
+
+    def resubmissions(self):
+        """
+        Resubmitted units
+
+        Returns
+        -------
+        dict: {old unit: row of the resubmissions table as a dict}
+        """
+        return {row["old"]: dict(row) for row in self.query("SELECT * FROM resubmissions ORDER BY submitted")}
+
+    def flush(self):
+        """
+        Write the buffered records in a single transaction.
+        """
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT INTO log_sections VALUES (?, ?, ?)", self._sections)
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO jobs (jobid, stage, command, dependencies, submitted, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                self._pending["jobs"],
+            )
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO tasks (jobid, task, updated) VALUES (?, ?, ?)", self._pending["tasks"]
+            )
+            self._connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?)", self._pending["files"])
+            self._connection.executemany("INSERT INTO log_entries VALUES (?, ?, ?)", self._pending["log_entries"])
+            self._sections = []
+            for records in self._pending.values():
+                records.clear()
+
+    def _flush_if_full(self):
+        if sum(len(records) for records in self._pending.values()) + len(self._sections) >= self.buffer_size:
+            self.flush()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._connection.close()
+
+    def query(self, sql, parameters=()):
+        """
+        Run a SQL query on the flushed records.
+
+        Returns
+        -------
+        list of sqlite3.Row
+        """
+        self.flush()
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.row_factory = sqlite3.Row
+            return cursor.execute(sql, parameters).fetchall()
+
+    def jobs(self, stage=None, state=None):
+        """
+        Jobs of the production, optionally of a stage and/or in a state, in submission order.
+
+        Returns
+        -------
+        list of dict
+        """
+        conditions, parameters = [], []
+        for column, value in (("stage", stage), ("state", state)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return [dict(row) for row in self.query(f"SELECT * FROM jobs {where} ORDER BY rowid", parameters)]
+
+    def tasks(self, jobid):
+        """
+        Tasks of a job array
+
+        Returns
+        -------
+        list of dict
+        """
+        return [dict(row) for row in self.query("SELECT * FROM tasks WHERE jobid = ? ORDER BY task", (jobid,))]
+
+    def files(self, jobid, direction=None):
+        """
+        Input and/or output files of a job (or `jobid_task` array task)
+
+        Returns
+        -------
+        list of str
+        """
+        sql, parameters = "SELECT path FROM files WHERE jobid = ?", [jobid]
+        if direction is not None:
+            sql += " AND direction = ?"
+            parameters.append(direction)
+        return [row["path"] for row in self.query(sql, parameters)]
+
+    def producers(self, path):
+        """
+        Jobs (or array tasks) producing a file. An empty job id means that the file is not produced by a job.
+
+        Returns
+        -------
+        list of str
+        """
+        rows = self.query(
+            "SELECT DISTINCT jobid FROM files WHERE path = ? AND direction = 'output'", (Path(path).as_posix(),)
+        )
+        return [row["jobid"] for row in rows]
+
+    def export_yaml(self, logs_files):
+        """
+        Write the YAML log files from the recorded logs, one document per stage log as written by
+        `lstmcpipe.utils.save_log_to_file`.
+
+        Parameters
+        ----------
+        logs_files: dict
+            {log_type: YAML file}, e.g. `log_file` and `debug_file` entries as returned by `create_log_files`
+        """
+        entries = {}
+        for row in self.query("SELECT section, key, value FROM log_entries ORDER BY rowid"):
+            entries.setdefault(row["section"], {})[row["key"]] = json.loads(row["value"])
+        sections = self.query("SELECT * FROM log_sections ORDER BY section")
+        for log_type, filename in logs_files.items():
+            if log_type not in {row["log_type"] for row in sections}:
+                continue
+            with open(filename, "w") as fileout:
+                for row in sections:
+                    if row["log_type"] == log_type:
+                        YAML().dump({row["stage"]: entries.get(row["section"], {})}, fileout)
+
+
+def production_db_path(log_dir, prod_id):
+    """
+    Path of the database of a production in its log directory
+    """
+    return Path(log_dir).joinpath(f"lstmcpipe_{prod_id}.sqlite")
+
+
+def create_production_db(log_dir, prod_id):
+    """
+    Database of a production in its log directory. The database of a previous run is backed up and replaced.
+
+    Parameters
+    ----------
+    log_dir: Path
+    prod_id: str
+
+    Returns
+    -------
+    `ProductionDB`
+    """
+    filename = production_db_path(log_dir, prod_id)
+    if filename.exists():
+        backup_log(filename)
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{filename}{suffix}").unlink(missing_ok=True)
+    log.info(f"Production database: {filename}")
+    return ProductionDB(filename)
@@ -0,0 +1,300 @@
+# Resources used by the jobs of previous productions.
+#
+# The memory (MaxRSS), duration and CPU usage of the completed jobs of a production are read from sacct and stored,
+# with the size of their inputs, in a SQLite file shared between productions. The slurm resources of new jobs are
+# then predicted for their stage and input size, with a safety margin, instead of the fixed defaults of
+# `SbatchLstMCStage`. Options given in the config (`extra_slurm_options`) still take precedence.
+
+import math
+import time
+import sqlite3
+import logging
+import threading
+import subprocess as sp
+from pathlib import Path
+
+import numpy as np
+
+from ..dag import flatten_paths
+from ..utils import memory_to_mb, slurm_time_to_seconds, seconds_to_slurm_time
+from .stage_cache import INPUT_DIR_PATTERNS
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    prod_id TEXT NOT NULL,
+    jobid TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    input_bytes INTEGER,
+    max_rss_mb REAL NOT NULL,
+    elapsed_s REAL NOT NULL,
+    cpus INTEGER NOT NULL,
+    cpu_used REAL NOT NULL,
+    recorded REAL,
+    PRIMARY KEY (prod_id, jobid)
+);
+CREATE INDEX IF NOT EXISTS usage_stage ON usage (stage);
+"""
+
+SACCT_FIELDS = ["jobid", "state", "elapsed", "maxrss", "alloccpus", "totalcpu"]
+
+# lower bounds of the predicted resources
+MIN_MEM_MB = 1024
+MIN_TIME_S = 600
+
+
+class ResourceHistory:
+    """
+    Resources used by the completed jobs of previous productions, per stage.
+
+    Parameters
+    ----------
+    filename: str or Path
+        SQLite file, created if it does not exist
+    """
+
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.filename, check_same_thread=False)
+        self._connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def add(self, records):
+        """
+        Store usage records, ignoring the jobs already recorded.
+
+        Parameters
+        ----------
+        records: list of dict
+            with the columns of the usage table
+        """
+        now = time.time()
+        rows = [
+            (
+                r["prod_id"],
+                r["jobid"],
+                r["stage"],
+                r["input_bytes"],
+                r["max_rss_mb"],
+                r["elapsed_s"],
+                r["cpus"],
+                r["cpu_used"],
+                now,
+            )
+            for r in records
+        ]
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR IGNORE INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def stages(self):
+        """
+        Stages with usage records
+        """
+        with self._lock:
+            return [row[0] for row in self._connection.execute("SELECT DISTINCT stage FROM usage ORDER BY stage")]
+
+    def records(self, stage):
+        """
+        Usage records of a stage
+
+        Returns
+        -------
+        list of dict
+        """
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.row_factory = sqlite3.Row
+            return [dict(row) for row in cursor.execute("SELECT * FROM usage WHERE stage = ?", (stage,))]
+
+    def predict(self, stage, input_bytes=None, margin=1.5, min_records=3):
+        """
+        Resources of a job of a stage.
+
+        Memory and duration are predicted from an upper envelope of their linear dependence on the input size (the
+        fit shifted up to the largest record) when the input size is known, otherwise from the largest records.
+        The CPUs are the largest number of CPUs actually used, never more than the largest allocation.
+
+        Parameters
+        ----------
+        stage: str
+        input_bytes: int or None
+            Size of the inputs, None if unknown (e.g. inputs produced by jobs not run yet)
+        margin: float
+            Safety factor applied to the memory, duration and CPUs
+        min_records: int
+            Minimum number of records of the stage to predict its resources
+
+        Returns
+        -------
+        dict or None: {"mem_mb", "time_s", "cpus"}, None if there are not enough records
+        """
+        records = self.records(stage)
+        if len(records) < min_records:
+            return None
+        sizes = [r["input_bytes"] for r in records]
+        if input_bytes is None or any(size is None for size in sizes):
+            sizes = None
+        mem = upper_envelope(sizes, [r["max_rss_mb"] for r in records], input_bytes)
+        elapsed = upper_envelope(sizes, [r["elapsed_s"] for r in records], input_bytes)
+        cpus = min(max(r["cpus"] for r in records), math.ceil(max(r["cpu_used"] for r in records) * margin))
+        return {
+            # rounded first, so that fit rounding errors do not add a unit
+            "mem_mb": max(MIN_MEM_MB, math.ceil(round(mem * margin, 3))),
+            "time_s": max(MIN_TIME_S, math.ceil(round(elapsed * margin, 3))),
+            "cpus": max(1, cpus),
+        }
+
+
+def upper_envelope(xs, ys, x):
+    """
+    Value at `x` of the linear fit of ys(xs) shifted up to the largest residual, or max(ys) if `x` or `xs` are None,
+    if the xs do not vary or if ys decreases with xs.
+    """
+    if x is None or xs is None or len(set(xs)) < 2:
+        return max(ys)
+    slope, intercept = np.polyfit(xs, ys, 1)
+    if slope <= 0:
+        return max(ys)
+    shift = max(y - (slope * xi + intercept) for xi, y in zip(xs, ys))
+    return slope * x + intercept + shift
+
+
+def input_size(inputs):
+    """
+    Size in bytes of the inputs of a job (only the `INPUT_DIR_PATTERNS` files of a directory are counted).
+    None if an input does not exist yet.
+    """
+    size = 0
+    for path in flatten_paths(inputs):
+        if path.is_dir():
+            size += sum(f.stat().st_size for pattern in INPUT_DIR_PATTERNS for f in path.glob(pattern))
+        elif path.exists():
+            size += path.stat().st_size
+        else:
+            return None
+    return size
+
+
+def get_resource_history(batch_config):
+    """
+    Resource history configured in the batch config (`resource_history` entry), or None if not used.
+    """
+    filename = (batch_config or {}).get("resource_history")
+    return ResourceHistory(filename) if filename else None
+
+
+def learned_slurm_options(batch_config, stage, inputs):
+    """
+    Slurm options (mem, time, cpus-per-task) of a job predicted from the resource history.
+
+    Parameters
+    ----------
+    batch_config: dict
+    stage: str
+        Stage name, see `SbatchLstMCStage`
+    inputs: str, list or dict
+        Inputs of the job
+
+    Returns
+    -------
+    dict or None: None if the resource history is not used or has not enough records for the stage
+    """
+    history = get_resource_history(batch_config)
+    if history is None:
+        return None
+    with history:
+        prediction = history.predict(stage, input_size(inputs), margin=batch_config.get("resource_margin") or 1.5)
+    if prediction is None:
+        return None
+    log.debug(f"Resources of a {stage} job predicted from the resource history: {prediction}")
+    return {
+        "mem": f"{prediction['mem_mb']}M",
+        "time": seconds_to_slurm_time(prediction["time_s"]),
+        "cpus-per-task": prediction["cpus"],
+    }
+
+
+def parse_sacct_usage(output):
+    """
+    Usage of the completed jobs and array tasks from
+    `sacct -P -n --format=jobid,state,elapsed,maxrss,alloccpus,totalcpu`. The MaxRSS of a job is the largest one of its
+    steps.
+
+    Returns
+    -------
+    dict: {jobid or `jobid_task`: {"max_rss_mb", "elapsed_s", "cpus", "cpu_used"}}
+    """
+    allocations, max_rss = {}, {}
+    for line in output.splitlines():
+        fields = line.strip().split("|")
+        if len(fields) < len(SACCT_FIELDS):
+            continue
+        jobid, state, elapsed, maxrss, cpus, totalcpu = fields[: len(SACCT_FIELDS)]
+        unit, _, step = jobid.partition(".")
+        if maxrss:
+            max_rss[unit] = max(max_rss.get(unit, 0), memory_to_mb(maxrss))
+        if not step and state.startswith("COMPLETED"):
+            elapsed_s = slurm_time_to_seconds(elapsed)
+            # TotalCPU has a fractional part in seconds
+            cpu_s = slurm_time_to_seconds(totalcpu.split(".")[0]) if totalcpu else 0
+            allocations[unit] = {
+                "elapsed_s": elapsed_s,
+                "cpus": int(cpus or 1),
+                "cpu_used": cpu_s / elapsed_s if elapsed_s else 0.0,
+            }
+    return {unit: dict(usage, max_rss_mb=max_rss.get(unit, 0)) for unit, usage in allocations.items()}
+
+
+def record_production(history, db, prod_id, chunk_size=200):
+    """
+    Store the usage of the completed jobs of a production in the resource history.
+
+    Parameters
+    ----------
+    history: `ResourceHistory`
+    db: `lstmcpipe.io.production_db.ProductionDB`
+    prod_id: str
+    chunk_size: int
+        Number of job ids per sacct call
+
+    Returns
+    -------
+    int: number of records
+    """
+    jobs = {job["jobid"]: job for job in db.jobs()}
+    jobids = list(jobs)
+    usage = {}
+    for i in range(0, len(jobids), chunk_size):
+        cmd = ["sacct", "-P", "-n", f"--format={','.join(SACCT_FIELDS)}", "-j", ",".join(jobids[i : i + chunk_size])]
+        usage.update(parse_sacct_usage(sp.run(cmd, stdout=sp.PIPE, encoding="utf-8", check=True).stdout))
+
+    n_tasks = {}
+    for unit in usage:
+        n_tasks[unit.partition("_")[0]] = n_tasks.get(unit.partition("_")[0], 0) + 1
+    records = []
+    for unit, unit_usage in usage.items():
+        jobid = unit.partition("_")[0]
+        if jobid not in jobs:
+            continue
+        inputs = db.files(unit, direction="input")
+        if inputs or unit == jobid:
+            size = input_size(inputs) if inputs else None
+        else:
+            # inputs recorded for the whole array, e.g. the r0_to_dl1 input directory split in tasks
+            size = input_size(db.files(jobid, direction="input"))
+            size = size // n_tasks[jobid] if size is not None else None
+        records.append(dict(unit_usage, prod_id=prod_id, jobid=unit, stage=jobs[jobid]["stage"], input_bytes=size))
+    history.add(records)
+    log.info(f"{len(records)} jobs of {prod_id} recorded in the resource history {history.filename}")
+    return len(records)
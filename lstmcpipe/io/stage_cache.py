@@ -0,0 +1,345 @@
+# Cache of stage outputs shared between productions.
+#
+# A stage is identified by a key computed from the fingerprints (name, size, modification time) of its input files,
+# the content of its configuration files, its command (with the input/output/config paths replaced by placeholders)
+# and the source environment. When a job succeeds, its outputs are hardlinked into the cache directory under this key.
+# When the same stage is requested again, the cached outputs are linked into the new production tree and the job is
+# not run.
+
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# only these files (data files and trained models) are considered as inputs when a whole directory is given as input
+INPUT_DIR_PATTERNS = ("*.h5", "*.sav")
+
+
+class StageCache:
+    """
+    Content-addressed cache of stage outputs.
+
+    The cache directory should be on the same filesystem as the productions so that outputs can be hardlinked.
+
+    Parameters
+    ----------
+    directory: str or Path
+        Root directory of the cache
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def make_spec(self, stage, inputs, outputs, command, config_files=(), source_environment=""):
+        """
+        Build the description of a stage used to compute its key.
+
+        Parameters
+        ----------
+        stage: str
+        inputs: list of str
+            Input files or directories (only the `INPUT_DIR_PATTERNS` files of a directory are considered)
+        outputs: list of str
+            Output files or directories (only the files directly in a directory are cached)
+        command: str
+        config_files: list of str
+        source_environment: str
+
+        Returns
+        -------
+        dict
+        """
+        config_files = [p for p in config_files if p is not None]
+        command = normalize_command(command, inputs, outputs, config_files)
+        inputs = [Path(p).resolve().as_posix() for p in inputs]
+        outputs = [Path(p).resolve().as_posix() for p in outputs]
+        config_files = [Path(p).resolve().as_posix() for p in config_files]
+        return {
+            "stage": stage,
+            "inputs": inputs,
+            "outputs": outputs,
+            "config_files": config_files,
+            "command": command,
+            "source_environment": source_environment.strip(),
+        }
+
+    def compute_key(self, spec):
+        """
+        Key of a stage. The input files must exist.
+
+        Parameters
+        ----------
+        spec: dict
+            as returned by `make_spec`
+
+        Returns
+        -------
+        str
+        """
+        content = {
+            "stage": spec["stage"],
+            "inputs": fingerprint_inputs(spec["inputs"]),
+            "configs": [file_hash(f) for f in spec["config_files"]],
+            "command": spec["command"],
+            "source_environment": spec["source_environment"],
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def entry_dir(self, key):
+        return self.directory.joinpath("entries", key[:2], key)
+
+    def lookup(self, key):
+        """
+        Manifest of the cached outputs for a key, or None if the key is not (completely) in the cache.
+        """
+        manifest_file = self.entry_dir(key).joinpath("store", "manifest.json")
+        if not manifest_file.exists():
+            return None
+        with open(manifest_file) as f:
+            return json.load(f)
+
+    def restore(self, key, outputs):
+        """
+        Link the cached outputs of a key to the given output paths.
+
+        Parameters
+        ----------
+        key: str
+        outputs: list of str
+            Output paths, in the same order as when the outputs were stored
+
+        Returns
+        -------
+        bool: True if the outputs were restored
+        """
+        manifest = self.lookup(key)
+        if manifest is None or len(manifest["outputs"]) != len(outputs):
+            return False
+        store = self.entry_dir(key).joinpath("store")
+        for index, (kind, output) in enumerate(zip(manifest["outputs"], outputs)):
+            stored = store.joinpath(str(index))
+            if kind == "dir":
+                Path(output).mkdir(parents=True, exist_ok=True)
+                for file in stored.iterdir():
+                    link_file(file, Path(output, file.name))
+            else:
+                Path(output).parent.mkdir(parents=True, exist_ok=True)
+                link_file(next(stored.iterdir()), Path(output))
+        log.info(f"Outputs of {manifest['stage']} restored from cache entry {key}")
+        return True
+
+    def commit(self, spec, key, task_id=0, submission="default"):
+        """
+        Mark a (task of a) job as done. Once all the tasks of the job are done, its outputs are stored in the cache.
+
+        The done markers are scoped to one submission, so that the markers of an earlier run with the same key are
+        not counted. The resubmitted tasks of a job (e.g. by `lstmcpipe.supervisor`) run the same command, they
+        belong to the same submission.
+
+        Parameters
+        ----------
+        spec: dict
+            with the `task_ids` of the slurm array set at submission (default: a single task 0)
+        key: str
+        task_id: int
+            Index of the slurm array task
+        submission: str
+            Identifier of the submission, e.g. the name of its spec file
+        """
+        entry_dir = self.entry_dir(key)
+        markers_dir = entry_dir.joinpath("submissions", submission)
+        markers_dir.mkdir(parents=True, exist_ok=True)
+        markers_dir.joinpath(f"done_{task_id}").touch()
+        if not all(markers_dir.joinpath(f"done_{i}").exists() for i in spec.get("task_ids", [0])):
+            return
+        if entry_dir.joinpath("store").exists():
+            return
+
+        tmp_store = entry_dir.joinpath(f"store_tmp_{uuid.uuid4().hex}")
+        kinds = []
+        for index, output in enumerate(spec["outputs"]):
+            stored = tmp_store.joinpath(str(index))
+            stored.mkdir(parents=True)
+            output = Path(output)
+            if output.is_dir():
+                kinds.append("dir")
+                for file in output.iterdir():
+                    if file.is_file():
+                        link_file(file, stored.joinpath(file.name), allow_symlink=False)
+            else:
+                kinds.append("file")
+                link_file(output, stored.joinpath(output.name), allow_symlink=False)
+        with open(tmp_store.joinpath("manifest.json"), "w") as f:
+            json.dump({"stage": spec["stage"], "outputs": kinds, "command": spec["command"]}, f)
+        try:
+            tmp_store.rename(entry_dir.joinpath("store"))
+        except OSError:
+            # another task stored the outputs at the same time
+            shutil.rmtree(tmp_store)
+
+    def write_spec(self, spec):
+        """
+        Write a stage spec in the cache directory so that the job can commit its outputs.
+
+        Returns
+        -------
+        Path
+        """
+        spec_dir = self.directory.joinpath("specs")
+        spec_dir.mkdir(parents=True, exist_ok=True)
+        spec_file = spec_dir.joinpath(f"{spec['stage']}_{uuid.uuid4().hex}.json")
+        write_json(spec, spec_file)
+        return spec_file
+
+
+def get_stage_cache(batch_config):
+    """
+    Stage cache configured in the batch config (`stage_cache` entry), or None if the cache is not used.
+    """
+    directory = (batch_config or {}).get("stage_cache")
+    return StageCache(directory) if directory else None
+
+
+def restore_stage(batch_config, stage, inputs, outputs, command, config_files=(), dependencies=None):
+    """
+    Look up a stage in the cache.
+
+    If the stage does not wait for other jobs, its key is computed now and, on a hit, its outputs are linked into the
+    production tree: the stage must not be submitted.
+    Otherwise, the key can only be computed by the job itself once its inputs exist (see `cached_command`).
+
+    Parameters
+    ----------
+    batch_config: dict
+    stage: str
+    inputs: list of str
+    outputs: list of str
+    command: str
+        command of the stage, used for the key
+    config_files: list of str
+    dependencies: str or None
+        slurm dependencies of the stage
+
+    Returns
+    -------
+    (bool, dict or None): whether the outputs were restored, and the stage spec to pass to `cached_command`
+    (None if the cache is not used)
+    """
+    cache = get_stage_cache(batch_config)
+    if cache is None:
+        return False, None
+
+    spec = cache.make_spec(stage, inputs, outputs, command, config_files, batch_config.get("source_environment", ""))
+    if not dependencies:
+        key = cache.compute_key(spec)
+        if cache.restore(key, outputs):
+            return True, spec
+        spec["key"] = key
+    return False, spec
+
+
+def cached_command(batch_config, spec, command, task_ids=(0,)):
+    """
+    Wrap the command of a job so that its outputs are stored in the cache when it succeeds.
+    If the key of the stage is not known yet, the job first looks up the cache and only runs the command on a miss.
+
+    Parameters
+    ----------
+    batch_config: dict
+    spec: dict or None
+        as returned by `restore_stage`. If None, the command is returned unchanged.
+    command: str
+    task_ids: iterable of int
+        Ids of the slurm array tasks running the command, all of them must be done to store the outputs
+
+    Returns
+    -------
+    str
+    """
+    if spec is None:
+        return command
+    spec = dict(spec, task_ids=list(task_ids))
+    spec_file = get_stage_cache(batch_config).write_spec(spec)
+    command = command.rstrip(";").strip()
+    if "key" in spec:
+        return f"{command} && lstmcpipe_stage_cache commit {spec_file}"
+    return f"lstmcpipe_stage_cache restore {spec_file} || ({command} && lstmcpipe_stage_cache commit {spec_file})"
+
+
+def normalize_command(command, inputs, outputs, config_files):
+    """
+    Replace the input, output and config paths of a command by placeholders so that the same stage of two productions
+    gets the same command.
+    """
+    replacements = {}
+    for name, paths in (("input", inputs), ("output", outputs), ("config", config_files)):
+        for index, path in enumerate(paths):
+            # paths can appear in the command as given or resolved
+            for form in (str(path), Path(path).resolve().as_posix()):
+                replacements[form] = f"<{name}{index}>"
+    for path in sorted(replacements, key=len, reverse=True):
+        command = command.replace(path, replacements[path])
+    return " ".join(command.split())
+
+
+def fingerprint_inputs(inputs, n_threads=16):
+    """
+    (input index, relative name, size, modification time) of the input files.
+    Stat calls are run in a thread pool as they are latency-bound on shared filesystems.
+    """
+    files = []
+    for index, path in enumerate(inputs):
+        path = Path(path)
+        if path.is_dir():
+            dir_files = sorted(f for pattern in INPUT_DIR_PATTERNS for f in path.glob(pattern))
+            files.extend((index, f.name, f) for f in dir_files)
+        else:
+            files.append((index, path.name, path))
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        stats = list(pool.map(lambda f: os.stat(f[2]), files))
+    return [[index, name, st.st_size, st.st_mtime_ns] for (index, name, _), st in zip(files, stats)]
+
+
+def file_hash(filename):
+    """
+    sha256 of the content of a file
+    """
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def link_file(src, dst, allow_symlink=True):
+    """
+    Hardlink src to dst, replacing dst if it exists.
+    If hardlinks are not possible (e.g. across filesystems), dst is a symlink to src or, if `allow_symlink` is False,
+    a copy of src.
+    """
+    src, dst = Path(src), Path(dst)
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        if allow_symlink:
+            dst.symlink_to(src.resolve())
+        else:
+            shutil.copy2(src, dst)
+
+
+def write_json(content, filename):
+    # unique temporary file in the same directory, so that concurrent writers do not remove each other's file
+    fd, tmp_file = tempfile.mkstemp(prefix=f".{Path(filename).name}.", dir=Path(filename).parent)
+    with os.fdopen(fd, "w") as f:
+        json.dump(content, f)
+    os.replace(tmp_file, filename)
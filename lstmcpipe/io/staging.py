@@ -0,0 +1,430 @@
+# Node-local scratch staging of the files processed by the core scripts (`lstmcpipe/scripts/script_batch_filelist_*`).
+#
+# The array tasks of a production run hundreds of processes reading and writing their HDF5 files on the shared
+# filesystem at the same time, and the many small writes saturate its metadata servers. With staging, each input is
+# copied to the local scratch of the node, processed there, and the finished outputs are moved back to the output
+# directory in one sequential pass, with checksums. An output only appears under its final name on the shared
+# filesystem once it is complete.
+# The next files of a task can be prefetched (staged, or read into the page cache without staging) by a background
+# thread while the current one is processed, and the finished outputs can be moved back by another one (write-behind)
+# while the next files are processed, to hide the latency of the shared filesystem.
+
+import os
+import zlib
+import queue
+import shutil
+import logging
+import tempfile
+import threading
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# size of the chunks read when copying and checksumming files
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def add_staging_arguments(parser):
+    """
+    Add the staging arguments to the parser of a core script
+    """
+    parser.add_argument(
+        "--scratch-staging",
+        action="store_true",
+        dest="scratch_staging",
+        help="Copy the inputs to the local scratch, process them there and move the finished outputs to the output "
+        "directory at the end",
+    )
+    parser.add_argument(
+        "--scratch-dir",
+        type=Path,
+        dest="scratch_dir",
+        default=None,
+        help="Local scratch directory used with --scratch-staging. Default: $TMPDIR",
+    )
+    parser.add_argument(
+        "--write-behind",
+        action="store_true",
+        dest="write_behind",
+        help="Write the outputs to the local scratch and move each finished output to the output directory in a "
+        "background thread while the next files are processed",
+    )
+    parser.add_argument(
+        "--prefetch-depth",
+        type=int,
+        dest="prefetch_depth",
+        default=0,
+        help="Number of files prefetched while a file is processed: copied to the local scratch with "
+        "--scratch-staging, read into the page cache otherwise. Default: 0 (no prefetch)",
+    )
+    parser.add_argument(
+        "--prefetch-max-gb",
+        type=float,
+        dest="prefetch_max_gb",
+        default=None,
+        help="Maximum size in GB of the files being processed and prefetched. Default: no limit",
+    )
+
+
+def open_staging(output_dir, scratch_staging=False, scratch_dir=None, write_behind=False):
+    """
+    Staging of a core script: `ScratchStaging` if `scratch_staging` or `write_behind`, otherwise `NoStaging`.
+    With `write_behind` only, the inputs are read from the shared filesystem.
+    """
+    if scratch_staging or write_behind:
+        return ScratchStaging(
+            output_dir, scratch_dir=scratch_dir, stage_inputs=scratch_staging, write_behind=write_behind
+        )
+    return NoStaging(output_dir)
+
+
+def staging_from_args(output_dir, args):
+    """
+    `open_staging` configured by the arguments of `add_staging_arguments`
+    """
+    return open_staging(output_dir, args.scratch_staging, args.scratch_dir, args.write_behind)
+
+
+def prefetcher_from_args(files, staging, args, n_processing=1):
+    """
+    `Prefetcher` of the files of a core script, configured by the arguments of `add_staging_arguments`
+    """
+    max_bytes = int(args.prefetch_max_gb * 1e9) if args.prefetch_max_gb else None
+    return Prefetcher(files, staging, depth=args.prefetch_depth, n_processing=n_processing, max_bytes=max_bytes)
+
+
+def file_checksum(path):
+    """
+    CRC32 of a file
+    """
+    checksum = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            checksum = zlib.crc32(chunk, checksum)
+    return checksum
+
+
+def copy_with_checksum(source, destination):
+    """
+    Copy a file and return the CRC32 of the bytes read
+    """
+    checksum = 0
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            checksum = zlib.crc32(chunk, checksum)
+            dst.write(chunk)
+    shutil.copystat(source, destination)
+    return checksum
+
+
+def move_with_checksum(source, destination, max_ntry=2):
+    """
+    Move a file to another filesystem. The file is copied under a hidden temporary name, its copy is checked against
+    the checksum of the original and only then renamed, so that the destination only exists once complete.
+
+    Raises
+    ------
+    OSError
+        If the copy still differs from the original after `max_ntry` attempts
+    """
+    source, destination = Path(source), Path(destination)
+    partial = destination.with_name(f".{destination.name}.partial")
+    for ntry in range(1, max_ntry + 1):
+        checksum = copy_with_checksum(source, partial)
+        if file_checksum(partial) == checksum:
+            os.replace(partial, destination)
+            source.unlink()
+            return checksum
+        log.warning(f"Checksum mismatch copying {source} to {destination} (attempt {ntry})")
+    partial.unlink()
+    raise OSError(f"{source} could not be copied to {destination}: checksum mismatch after {max_ntry} attempts")
+
+
+def warm_page_cache(path):
+    """
+    Read a file so that it is in the page cache when it is processed
+    """
+    with open(path, "rb") as f:
+        while f.read(CHUNK_SIZE):
+            pass
+
+
+class NoStaging:
+    """
+    Files read and written directly on the shared filesystem, with the interface of `ScratchStaging`
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = Path(output_dir)
+        self.local_output_dir = self.output_dir
+
+    def __enter__(self):
+        self.output_dir.mkdir(exist_ok=True, parents=True)
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def stage_in(self, file):
+        return Path(file)
+
+    def prefetch(self, file):
+        warm_page_cache(file)
+        return Path(file)
+
+    def release(self, local_file):
+        pass
+
+    def finish(self, local_output):
+        pass
+
+    def collect(self):
+        return []
+
+
+class ScratchStaging:
+    """
+    Local working directory of a core script.
+    Inputs are copied to `work_dir/inputs` and outputs are written to `work_dir/outputs` (`local_output_dir`).
+    The finished outputs are moved to the output directory when leaving the context, even if a file failed, or, with
+    `write_behind`, by a background thread as soon as they are finished. The context then waits for all the moves and
+    raises an OSError if one failed. The working directory is removed at the end.
+
+    Parameters
+    ----------
+    output_dir: str or Path
+        Output directory on the shared filesystem
+    scratch_dir: str or Path or None
+        Local scratch directory. Default: $TMPDIR
+    stage_inputs: bool
+        Copy the inputs to the local scratch. If False, only the outputs are written there.
+    write_behind: bool
+        Move each finished output in a background thread instead of all of them at the end
+    """
+
+    def __init__(self, output_dir, scratch_dir=None, stage_inputs=True, write_behind=False):
+        self.output_dir = Path(output_dir)
+        self.scratch_dir = Path(scratch_dir or os.environ.get("TMPDIR") or tempfile.gettempdir())
+        self.stage_inputs = stage_inputs
+        self.write_behind = write_behind
+        self.work_dir = None
+        self.local_output_dir = None
+        self._finished = []
+        self._seen = set()
+        self._uploads = queue.Queue()
+        self._upload_errors = []
+        self._uploader = None
+
+    def __enter__(self):
+        self.scratch_dir.mkdir(exist_ok=True, parents=True)
+        self.work_dir = Path(tempfile.mkdtemp(prefix="lstmcpipe_", dir=self.scratch_dir))
+        self.input_dir = self.work_dir.joinpath("inputs")
+        self.local_output_dir = self.work_dir.joinpath("outputs")
+        self.input_dir.mkdir()
+        self.local_output_dir.mkdir()
+        self.output_dir.mkdir(exist_ok=True, parents=True)
+        if self.write_behind:
+            self._uploader = threading.Thread(target=self._upload, name="uploader", daemon=True)
+            self._uploader.start()
+        log.info(f"Staging the files in {self.work_dir}")
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if self._uploader is not None:
+                self._uploads.put(None)
+                self._uploader.join()
+            self.stage_out()
+        finally:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+        if self._upload_errors:
+            raise OSError(
+                f"{len(self._upload_errors)} outputs could not be moved to {self.output_dir}:\n"
+                + "\n".join(str(e) for e in self._upload_errors)
+            )
+
+    def stage_in(self, file):
+        """
+        Copy an input file to the local scratch
+
+        Returns
+        -------
+        Path: local copy, with the same name, or the input itself if the inputs are not staged
+        """
+        if not self.stage_inputs:
+            return Path(file)
+        local_file = self.input_dir.joinpath(Path(file).name)
+        shutil.copyfile(file, local_file)
+        return local_file
+
+    def prefetch(self, file):
+        if not self.stage_inputs:
+            warm_page_cache(file)
+        return self.stage_in(file)
+
+    def release(self, local_file):
+        """
+        Remove the local copy of a processed input
+        """
+        if self.stage_inputs:
+            Path(local_file).unlink(missing_ok=True)
+
+    def finish(self, local_output):
+        """
+        Mark a local output as complete, to be moved to the output directory
+        """
+        local_output = Path(local_output)
+        self._seen.add(local_output)
+        if self.write_behind:
+            self._uploads.put(local_output)
+        else:
+            self._finished.append(local_output)
+
+    def collect(self):
+        """
+        Mark all the files written in the local output directory as complete.
+        Only for scripts processing their files one after the other, whose output names are not known in advance.
+
+        Returns
+        -------
+        list of Path: newly finished outputs
+        """
+        files = sorted(path for path in self.local_output_dir.rglob("*") if path.is_file())
+        new = [path for path in files if path not in self._seen]
+        for path in new:
+            self.finish(path)
+        return new
+
+    def _move(self, local_output):
+        destination = self.output_dir.joinpath(local_output.relative_to(self.local_output_dir))
+        destination.parent.mkdir(exist_ok=True, parents=True)
+        move_with_checksum(local_output, destination)
+
+    def _upload(self):
+        while True:
+            local_output = self._uploads.get()
+            if local_output is None:
+                return
+            try:
+                if local_output.exists():
+                    self._move(local_output)
+            except Exception as e:
+                log.error(f"Moving {local_output} to {self.output_dir} failed: {e}")
+                self._upload_errors.append(e)
+
+    def stage_out(self):
+        """
+        Move the finished outputs to the output directory, one after the other
+        """
+        for local_output in self._finished:
+            if local_output.exists():
+                self._move(local_output)
+        if self._finished:
+            log.info(f"{len(self._finished)} outputs moved to {self.output_dir}")
+        self._finished = []
+
+
+class Prefetcher:
+    """
+    Iterate over the files of a task, yielding `(file, local_file)` with the next files prefetched by a background
+    thread (`staging.prefetch`) while the current ones are processed.
+    At most `depth + n_processing` files are prefetched or being processed at the same time, and their total size stays
+    below `max_bytes` (a file larger than `max_bytes` is only prefetched once no other file is held).
+    Each file must be released with `release` once processed.
+
+    Parameters
+    ----------
+    files: list of str or Path
+    staging: `ScratchStaging` or `NoStaging`
+    depth: int
+        Number of files prefetched ahead of the ones being processed. 0: files are staged when they are reached.
+    n_processing: int
+        Number of files processed at the same time (e.g. by a process pool)
+    max_bytes: int or None
+        Maximum total size of the files held
+    """
+
+    def __init__(self, files, staging, depth=1, n_processing=1, max_bytes=None):
+        self.files = list(files)
+        self.staging = staging
+        self.depth = depth
+        self.capacity = depth + n_processing
+        self.max_bytes = max_bytes
+        self._held = {}
+        self._ready = []
+        self._condition = threading.Condition()
+        self._stop = False
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._condition:
+            self._stop = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _has_room(self, size):
+        if not self._held:
+            return True
+        if len(self._held) >= self.capacity:
+            return False
+        return self.max_bytes is None or sum(self._held.values()) + size <= self.max_bytes
+
+    def _run(self):
+        for file in self.files:
+            size = os.path.getsize(file) if os.path.exists(file) else 0
+            with self._condition:
+                self._condition.wait_for(lambda: self._stop or self._has_room(size))
+                if self._stop:
+                    return
+            try:
+                result = self.staging.prefetch(file)
+                with self._condition:
+                    self._held[Path(result)] = size
+            except Exception as e:
+                result = e
+            with self._condition:
+                self._ready.append((file, result))
+                self._condition.notify_all()
+
+    def __iter__(self):
+        if self.depth <= 0 and self.capacity <= 1:
+            for file in self.files:
+                yield file, self.staging.stage_in(file)
+            return
+        if self.depth <= 0:
+            # no prefetch: the files are staged when they are reached, only the number of files held is bounded
+            for file in self.files:
+                size = os.path.getsize(file) if os.path.exists(file) else 0
+                with self._condition:
+                    self._condition.wait_for(lambda: self._has_room(size))
+                local_file = self.staging.stage_in(file)
+                with self._condition:
+                    self._held[Path(local_file)] = size
+                yield file, local_file
+            return
+
+        self._thread = threading.Thread(target=self._run, name="prefetcher", daemon=True)
+        self._thread.start()
+        for _ in self.files:
+            with self._condition:
+                self._condition.wait_for(lambda: self._ready)
+                file, result = self._ready.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            yield file, result
+
+    def release(self, local_file):
+        """
+        Release a processed file, removing its local copy
+        """
+        self.staging.release(local_file)
+        with self._condition:
+            self._held.pop(Path(local_file), None)
+            self._condition.notify_all()
@@ -1,6 +1,7 @@
 import pytest
+import tables
 
-from lstmcpipe.io.data_management import check_data_path, get_input_filelist
+from lstmcpipe.io.data_management import check_data_path, get_input_filelist, is_complete_hdf5_file
 
 
 @pytest.fixture()
@@ -37,3 +38,21 @@ def test_get_input_filelist(create_tmp_dir, create_tmp_subdir):
     assert len(get_input_filelist(create_tmp_dir)) == 6  # 5 files plus subdir
     assert len(get_input_filelist(create_tmp_dir, glob_pattern="*.h5")) == 2
     assert len(get_input_filelist(create_tmp_dir, glob_pattern="**/*.simtel.fz")) == 4
+
+
+def test_is_complete_hdf5_file(tmp_path):
+    filename = tmp_path / 'dl1.h5'
+    assert not is_complete_hdf5_file(filename)
+
+    filename.write_bytes(b'truncated')
+    assert not is_complete_hdf5_file(filename)
+
+    with tables.open_file(filename, mode='w') as file:
+        file.create_group('/dl1/event/telescope', 'parameters', createparents=True)
+    assert is_complete_hdf5_file(filename, ['/dl1/event/telescope/parameters'])
+    assert not is_complete_hdf5_file(filename, ['/simulation/event'])
+    assert not is_complete_hdf5_file(filename, min_size=filename.stat().st_size + 1)
+    assert not is_complete_hdf5_file(filename, required_attrs=['LSTCHAIN_VERSION'])
+    with tables.open_file(filename, mode='a') as file:
+        file.root._v_attrs['LSTCHAIN_VERSION'] = '0.10'
+    assert is_complete_hdf5_file(filename, required_attrs=['LSTCHAIN_VERSION'])
@@ -35,6 +35,12 @@ def test_update_scancel_file():
         lines = f.readlines()
     assert lines == ["scancel 1234,5678"]
 
+    # duplicated ids and array tasks of a known array are not added
+    update_scancel_file(scancel_file, "5678,1234_3,91011")
+    with open(scancel_file) as f:
+        lines = f.readlines()
+    assert lines == ["scancel 1234,5678,91011"]
+
     scancel_file.unlink()
     log_dir.rmdir()
 
@@ -0,0 +1,91 @@
+from lstmcpipe.dag import JobDag
+from lstmcpipe.utils import save_logs
+from lstmcpipe.stages.mc_dl1_to_dl2 import batch_dl1_to_dl2
+from ..production_db import ProductionDB, create_production_db
+
+
+def test_production_db(tmp_path):
+    with ProductionDB(tmp_path / "prod.sqlite", buffer_size=3) as db:
+        db.add_jobs("r0_to_dl1", {"12": "sbatch --parsable --array=0-1%100 --wrap='cmd'"})
+        db.add_jobs("merge_dl1", {"13": "sbatch --parsable --dependency=afterok:12_0:12_1 --wrap='merge'"})
+        dag = JobDag(db=db)
+        dag.add("r0_to_dl1", tmp_path / "r0" / "run1.simtel.gz", tmp_path / "dl1" / "run1.h5", "12_0")
+        dag.add("r0_to_dl1", tmp_path / "r0" / "run2.simtel.gz", tmp_path / "dl1" / "run2.h5", "12_1")
+        dag.add("merge_dl1", tmp_path / "dl1", tmp_path / "merged.h5", "13")
+        # restored from the stage cache
+        dag.add("train_pipe", tmp_path / "merged.h5", tmp_path / "models")
+
+        assert [job["jobid"] for job in db.jobs()] == ["12", "13"]
+        assert db.jobs(stage="merge_dl1")[0]["dependencies"] == "12_0,12_1"
+        assert [task["task"] for task in db.tasks("12")] == [0, 1]
+        assert db.files("12_1", direction="output") == [(tmp_path / "dl1" / "run2.h5").as_posix()]
+        assert db.producers(tmp_path / "merged.h5") == ["13"]
+        assert db.producers(tmp_path / "models") == [""]
+
+        db.set_states({"12_0": "COMPLETED", "12_1": "FAILED", "13": "CANCELLED"})
+        assert [task["state"] for task in db.tasks("12")] == ["COMPLETED", "FAILED"]
+        assert db.jobs(state="CANCELLED")[0]["jobid"] == "13"
+        assert db.jobs(state="SUBMITTED")[0]["jobid"] == "12"
+
+    # the records are persistent
+    with ProductionDB(tmp_path / "prod.sqlite") as db:
+        assert len(db.jobs()) == 2
+        # no WAL on the shared filesystem of the log directory
+        assert db.query("PRAGMA journal_mode")[0]["journal_mode"] == "delete"
+
+
+def test_export_yaml(tmp_path):
+    logs = [
+        ("r0_to_dl1", {"12": "sbatch r0_to_dl1"}, {"12": "r0_dl1 job from input dir: /r0"}),
+        ("merge_dl1", {}, {"**CACHED**": "restored"}),
+        ("check_full_workflow", {"20": "sbatch check"}, {"SUMMARY_r0_dl1": "12", "prod_check_20": "sbatch check"}),
+    ]
+    legacy = {"log_file": tmp_path / "legacy_log.yml", "debug_file": tmp_path / "legacy_debug.yml"}
+    db = create_production_db(tmp_path, "prod")
+    exported = {"log_file": tmp_path / "log.yml", "debug_file": tmp_path / "debug.yml", "db": db}
+    for step, log_dict, debug_log in logs:
+        save_logs(legacy, step, log_dict, debug_log)
+        save_logs(exported, step, log_dict, debug_log)
+        # the YAML log files are exported after each stage
+        for log_type in ["log_file", "debug_file"]:
+            if legacy[log_type].exists():
+                assert exported[log_type].read_text() == legacy[log_type].read_text()
+    assert [job["jobid"] for job in db.jobs()] == ["12", "20"]
+
+    db.export_yaml({"log_file": exported["log_file"], "debug_file": exported["debug_file"]})
+    db.close()
+    for log_type in ["log_file", "debug_file"]:
+        assert exported[log_type].read_text() == legacy[log_type].read_text()
+
+    # a new run backs up the database of the previous one
+    create_production_db(tmp_path, "prod").close()
+    assert tmp_path.joinpath("BACKUP_00_lstmcpipe_prod.sqlite").exists()
+
+
+def test_batch_stage_records_jobs(tmp_path, monkeypatch):
+    submitted = []
+
+    def fake_run_command(cmd):
+        submitted.append(cmd)
+        return str(100 + len(submitted))
+
+    monkeypatch.setattr("lstmcpipe.utils.run_command", fake_run_command)
+    db = ProductionDB(tmp_path / "prod.sqlite")
+    logs = {"log_file": tmp_path / "log.yml", "debug_file": tmp_path / "debug.yml", "db": db}
+    batch_config = {"source_environment": "", "slurm_account": "", "n_submit_threads": 1}
+    dict_paths = [
+        {
+            "input": (tmp_path / "dl1" / "dl1_gamma.h5").as_posix(),
+            "path_model": (tmp_path / "models").as_posix(),
+            "output": (tmp_path / "dl2").as_posix(),
+        }
+    ]
+
+    batch_dl1_to_dl2(dict_paths, None, "10", batch_config, logs, dag=JobDag(db=db))
+
+    job = db.jobs(stage="dl1_to_dl2")[0]
+    assert job["jobid"] == "101"
+    assert job["dependencies"] == "10"
+    assert job["command"] == submitted[0]
+    assert db.producers(tmp_path / "dl2") == ["101"]
+    db.close()
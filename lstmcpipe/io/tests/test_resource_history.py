@@ -0,0 +1,109 @@
+import os
+import subprocess as sp
+
+from lstmcpipe.scripts import fake_slurm
+from lstmcpipe.utils import SbatchLstMCStage
+from lstmcpipe.io.production_db import ProductionDB
+from ..resource_history import (
+    ResourceHistory,
+    learned_slurm_options,
+    parse_sacct_usage,
+    record_production,
+)
+
+
+def records(stage, sizes, mem, elapsed):
+    return [
+        {
+            "prod_id": "prod",
+            "jobid": f"{stage}_{i}",
+            "stage": stage,
+            "input_bytes": size,
+            "max_rss_mb": m,
+            "elapsed_s": e,
+            "cpus": 16,
+            "cpu_used": 3.5,
+        }
+        for i, (size, m, e) in enumerate(zip(sizes, mem, elapsed))
+    ]
+
+
+def test_predict(tmp_path):
+    with ResourceHistory(tmp_path / "history.sqlite") as history:
+        history.add(records("merge_dl1", [1000, 2000], [2000, 4000], [1000, 2000]))
+        assert history.predict("merge_dl1", 2000) is None
+
+        history.add(records("dl1_to_dl2", [1000, 2000, 3000], [2000, 3000, 4500], [1000, 2000, 3000]))
+        # recorded twice, e.g. by a second check job
+        history.add(records("dl1_to_dl2", [1000], [2000], [1000]))
+        assert len(history.records("dl1_to_dl2")) == 3
+        assert history.stages() == ["dl1_to_dl2", "merge_dl1"]
+
+        # linear fit 1.25 * size + 666.7, shifted up by its largest residual (83.3): 3250 MB for 2000 bytes
+        prediction = history.predict("dl1_to_dl2", 2000, margin=1)
+        assert prediction["mem_mb"] == 3250
+        assert prediction["time_s"] == 2000
+        assert prediction["cpus"] == 4
+
+        # inputs not produced yet: largest records
+        prediction = history.predict("dl1_to_dl2", None, margin=2)
+        assert prediction == {"mem_mb": 9000, "time_s": 6000, "cpus": 7}
+
+
+def test_parse_sacct_usage():
+    output = (
+        "12_0|COMPLETED|01:00:00||4|02:00:00\n"
+        "12_0.batch|COMPLETED|01:00:00|2000M|4|02:00:00\n"
+        "12_0.extern|COMPLETED|01:00:00|1K|4|00:00:00.012\n"
+        "12_1|OUT_OF_MEMORY|00:10:00||4|00:10:00\n"
+        "12_1.batch|OUT_OF_MEMORY|00:10:00|4G|4|00:10:00\n"
+        "13|COMPLETED|00:30:00||1|00:15:00.500\n"
+        "13.batch|COMPLETED|00:30:00|1.5G|1|00:15:00.500\n"
+    )
+    usage = parse_sacct_usage(output)
+    assert list(usage) == ["12_0", "13"]
+    assert usage["12_0"] == {"elapsed_s": 3600, "cpus": 4, "cpu_used": 2.0, "max_rss_mb": 2000}
+    assert usage["13"]["max_rss_mb"] == 1536
+    assert usage["13"]["cpu_used"] == 0.5
+
+
+def test_learned_slurm_options(tmp_path, monkeypatch):
+    batch_config = {"resource_history": tmp_path / "history.sqlite", "resource_margin": 1}
+    assert learned_slurm_options(batch_config, "train_pipe", tmp_path / "gamma.h5") is None
+    with ResourceHistory(batch_config["resource_history"]) as history:
+        history.add(records("train_pipe", [1, 2, 3], [20000, 30000, 40000], [3600, 7200, 7200]))
+    options = learned_slurm_options(batch_config, "train_pipe", tmp_path / "gamma.h5")
+    assert options == {"mem": "40000M", "time": "0-02:00:00", "cpus-per-task": 4}
+
+    # learned resources replace the stage defaults, the extra slurm options still take precedence
+    sbatch = SbatchLstMCStage("train_pipe", "train", extra_slurm_options={"time": "10:00:00"}, resource_options=options)
+    assert sbatch.slurm_options["mem"] == "40000M"
+    assert sbatch.slurm_options["cpus-per-task"] == 4
+    assert sbatch.slurm_options["time"] == "10:00:00"
+    assert sbatch.slurm_options["partition"] == "xxl"
+
+    # the learned time is capped by the maximum time of the partition (dl1_to_dl2 runs on `short`)
+    monkeypatch.setattr("lstmcpipe.utils.partition_time_limit", {"short": 3600}.get)
+    sbatch = SbatchLstMCStage("dl1_to_dl2", "dl1_to_dl2", resource_options=options)
+    assert sbatch.slurm_options["time"] == "0-01:00:00"
+    assert SbatchLstMCStage("train_pipe", "train", resource_options=options).slurm_options["time"] == "0-02:00:00"
+
+
+def test_record_production(tmp_path, monkeypatch):
+    bin_dir, state_dir = tmp_path / "bin", tmp_path / "state"
+    fake_slurm.install(bin_dir, state_dir, job_duration=0)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    dl1 = tmp_path / "dl1"
+    dl1.mkdir()
+    dl1.joinpath("run1.h5").write_bytes(b"0" * 100)
+    dl1.joinpath("run2.h5").write_bytes(b"0" * 300)
+
+    cmd = 'sbatch --parsable --wrap="echo"'
+    jobid = sp.run(cmd, shell=True, stdout=sp.PIPE, encoding="utf-8", check=True).stdout.strip()
+    with ProductionDB(tmp_path / "prod.sqlite") as db, ResourceHistory(tmp_path / "history.sqlite") as history:
+        db.add_jobs("merge_dl1", {jobid: cmd})
+        db.add_unit("merge_dl1", [dl1], [tmp_path / "merged.h5"], jobid)
+        assert record_production(history, db, "prod") == 1
+        record = history.records("merge_dl1")[0]
+        assert record["jobid"] == jobid
+        assert record["input_bytes"] == 400
@@ -0,0 +1,143 @@
+import os
+import json
+import subprocess
+from pathlib import Path
+
+from lstmcpipe.io.stage_cache import StageCache, restore_stage, cached_command, normalize_command
+
+
+def make_production(root, content=b"dl1"):
+    input_dir = root / "dl1"
+    input_dir.mkdir(parents=True)
+    for i in range(2):
+        (input_dir / f"dl1_gamma_{i}.h5").write_bytes(content)
+    (input_dir / "split_tt_1234.e").write_text("slurm log")
+    config = root / "lstchain_config.json"
+    config.write_text('{"tailcut": 8}')
+    return input_dir, config
+
+
+def test_normalize_command():
+    cmd = "lstchain_merge_hdf5_files -d /prod1/dl1 -o /prod1/dl1/merged.h5 -c /prod1/config.json"
+    assert (
+        normalize_command(cmd, ["/prod1/dl1"], ["/prod1/dl1/merged.h5"], ["/prod1/config.json"])
+        == "lstchain_merge_hdf5_files -d <input0> -o <output0> -c <config0>"
+    )
+
+
+def test_stage_cache_commit_and_restore(tmp_path):
+    cache = StageCache(tmp_path / "cache")
+    input_dir, config = make_production(tmp_path / "prod1")
+    output = tmp_path / "prod1" / "merged.h5"
+    output.write_bytes(b"merged")
+
+    cmd = f"merge -d {input_dir} -o {output} -c {config}"
+    spec = cache.make_spec("merge_dl1", [input_dir], [output], cmd, [config], "source env;")
+    key = cache.compute_key(spec)
+    assert cache.lookup(key) is None
+
+    # all the array tasks of the submission must be done, the markers of another submission are not counted
+    array_spec = dict(spec, task_ids=[0, 3, 7])
+    cache.commit(array_spec, key, task_id=0, submission="previous")
+    cache.commit(array_spec, key, task_id=3, submission="previous")
+    cache.commit(array_spec, key, task_id=0, submission="current")
+    cache.commit(array_spec, key, task_id=7, submission="current")
+    assert cache.lookup(key) is None
+    # task 3 resubmitted (e.g. by the supervisor) in the same submission
+    cache.commit(array_spec, key, task_id=3, submission="current")
+    assert cache.lookup(key)["outputs"] == ["file"]
+
+    # the slurm logs of the input dir are not part of the key
+    (input_dir / "split_tt_5678.o").write_text("other slurm log")
+    assert cache.compute_key(spec) == key
+
+    # a second production with hardlinked inputs gets the same key
+    input_dir_2 = tmp_path / "prod2" / "dl1"
+    input_dir_2.mkdir(parents=True)
+    for file in input_dir.glob("*.h5"):
+        os.link(file, input_dir_2 / file.name)
+    config_2 = tmp_path / "prod2" / "config.json"
+    config_2.write_text(config.read_text())
+    output_2 = tmp_path / "prod2" / "merged.h5"
+    spec_2 = cache.make_spec(
+        "merge_dl1", [input_dir_2], [output_2], f"merge -d {input_dir_2} -o {output_2} -c {config_2}", [config_2]
+    )
+    spec_2["source_environment"] = "source env;"
+    assert cache.compute_key(spec_2) == key
+    assert cache.restore(key, [output_2])
+    assert output_2.read_bytes() == b"merged"
+
+    # a change of the config changes the key
+    config_2.write_text('{"tailcut": 10}')
+    assert cache.compute_key(spec_2) != key
+
+
+def test_restore_stage(tmp_path):
+    batch_config = {"source_environment": "source env;", "stage_cache": (tmp_path / "cache").as_posix()}
+    input_dir, config = make_production(tmp_path / "prod1")
+    output_dir = tmp_path / "prod1" / "models"
+    cmd = f"train -i {input_dir} -o {output_dir}"
+
+    assert restore_stage({"source_environment": ""}, "train_pipe", [input_dir], [output_dir], cmd) == (False, None)
+
+    # stage with dependencies: the job looks up the cache itself
+    restored, spec = restore_stage(batch_config, "train_pipe", [input_dir], [output_dir], cmd, dependencies="1234")
+    assert not restored and "key" not in spec
+    assert cached_command(batch_config, spec, cmd).startswith("lstmcpipe_stage_cache restore ")
+
+    restored, spec = restore_stage(batch_config, "train_pipe", [input_dir], [output_dir], cmd)
+    assert not restored
+    wrapped = cached_command(batch_config, spec, cmd)
+    assert wrapped.startswith(f"{cmd} && lstmcpipe_stage_cache commit ")
+    spec_file = wrapped.split()[-1]
+    with open(spec_file) as f:
+        assert json.load(f)["key"] == spec["key"]
+
+    # the job ran and committed its outputs
+    output_dir.mkdir()
+    (output_dir / "cls_gh.sav").write_bytes(b"model")
+    StageCache(batch_config["stage_cache"]).commit(spec, spec["key"])
+
+    new_output_dir = tmp_path / "prod2" / "models"
+    new_cmd = f"train -i {input_dir} -o {new_output_dir}"
+    restored, _ = restore_stage(batch_config, "train_pipe", [input_dir], [new_output_dir], new_cmd)
+    assert restored
+    assert (new_output_dir / "cls_gh.sav").read_bytes() == b"model"
+
+
+def test_cached_command_in_manifest(tmp_path):
+    """a cached single-unit command run as a task of a job array stores its outputs"""
+    batch_config = {"source_environment": "", "stage_cache": (tmp_path / "cache").as_posix()}
+    input_dir, config = make_production(tmp_path / "prod1")
+    output = tmp_path / "prod1" / "dl2.h5"
+    cmd = f"cp {input_dir / 'dl1_gamma_0.h5'} {output}"
+    restored, spec = restore_stage(batch_config, "dl1_to_dl2", [input_dir], [output], cmd)
+    assert not restored
+
+    manifest = tmp_path / "dl1_to_dl2.manifest"
+    manifest.write_text("echo other unit\n" + cached_command(batch_config, spec, cmd) + "\n")
+    env = dict(os.environ, SLURM_ARRAY_TASK_ID="1", SLURM_ARRAY_TASK_COUNT="2")
+    subprocess.run(["lstmcpipe_run_manifest", str(manifest)], env=env, check=True)
+    assert output.read_bytes() == b"dl1"
+    assert StageCache(batch_config["stage_cache"]).lookup(spec["key"])["outputs"] == ["file"]
+
+
+def test_cached_command_array(tmp_path):
+    """the tasks of an array only read the spec, and the outputs are stored once all of them are done"""
+    batch_config = {"source_environment": "", "stage_cache": (tmp_path / "cache").as_posix()}
+    input_dir, config = make_production(tmp_path / "prod1")
+    output_dir = tmp_path / "prod1" / "dl1_out"
+    cmd = f"mkdir -p {output_dir} && cp {input_dir}/dl1_gamma_$SLURM_ARRAY_TASK_ID.h5 {output_dir}"
+    restored, spec = restore_stage(batch_config, "r0_to_dl1", [input_dir], [output_dir], cmd, dependencies="12")
+    wrapped = cached_command(batch_config, spec, cmd, task_ids=range(2))
+    spec_file = Path(wrapped.split()[2])
+    spec_content = spec_file.read_text()
+    assert json.loads(spec_content)["task_ids"] == [0, 1]
+
+    for task in [1, 0]:
+        env = dict(os.environ, SLURM_ARRAY_TASK_ID=str(task), SLURM_ARRAY_TASK_COUNT="2")
+        subprocess.run(wrapped, shell=True, env=env, check=True)
+        key = StageCache(batch_config["stage_cache"]).compute_key(spec)
+        assert (StageCache(batch_config["stage_cache"]).lookup(key) is None) == (task == 1)
+    assert spec_file.read_text() == spec_content
+    assert list(spec_file.parent.iterdir()) == [spec_file]
@@ -0,0 +1,211 @@
+import os
+import sys
+import stat
+import time
+import subprocess as sp
+
+import pytest
+
+from ..staging import ScratchStaging, NoStaging, Prefetcher, move_with_checksum, file_checksum
+
+
+def test_move_with_checksum(tmp_path, monkeypatch):
+    source, destination = tmp_path / "local.h5", tmp_path / "shared" / "out.h5"
+    destination.parent.mkdir()
+    source.write_bytes(os.urandom(1000))
+    checksum = file_checksum(source)
+    assert move_with_checksum(source, destination) == checksum
+    assert file_checksum(destination) == checksum
+    assert not source.exists()
+    assert list(destination.parent.iterdir()) == [destination]
+
+    # a corrupted copy never appears under its final name
+    source.write_bytes(os.urandom(1000))
+    monkeypatch.setattr("lstmcpipe.io.staging.file_checksum", lambda path: -1)
+    with pytest.raises(OSError):
+        move_with_checksum(source, tmp_path / "shared" / "corrupted.h5")
+    assert list(destination.parent.iterdir()) == [destination]
+    assert source.exists()
+
+
+def test_scratch_staging(tmp_path):
+    inputs, outputs = tmp_path / "inputs", tmp_path / "outputs"
+    inputs.mkdir()
+    for name in ["a.simtel.gz", "b.simtel.gz"]:
+        inputs.joinpath(name).write_text(name)
+
+    with pytest.raises(RuntimeError):
+        with ScratchStaging(outputs, scratch_dir=tmp_path / "scratch") as staging:
+            for name in ["a.simtel.gz", "b.simtel.gz"]:
+                local_file = staging.stage_in(inputs / name)
+                assert local_file.parent == staging.input_dir
+                output = staging.local_output_dir.joinpath(name.replace(".simtel.gz", ".h5"))
+                output.write_text(local_file.read_text())
+                # nothing on the shared filesystem before the end of the task
+                assert not outputs.joinpath(output.name).exists()
+                if name == "b.simtel.gz":
+                    raise RuntimeError("b failed")
+                staging.finish(output)
+                staging.release(local_file)
+
+    # the finished output is moved back even if a later file failed, the unfinished one is not
+    assert sorted(path.name for path in outputs.iterdir()) == ["a.h5"]
+    assert outputs.joinpath("a.h5").read_text() == "a.simtel.gz"
+    # inputs are untouched and the scratch is cleaned
+    assert len(list(inputs.iterdir())) == 2
+    assert list(tmp_path.joinpath("scratch").iterdir()) == []
+
+
+def test_write_behind(tmp_path, monkeypatch):
+    outputs = tmp_path / "outputs"
+    with ScratchStaging(outputs, scratch_dir=tmp_path / "scratch", stage_inputs=False, write_behind=True) as staging:
+        # inputs are read from the shared filesystem
+        assert staging.stage_in(tmp_path / "run.simtel.gz") == tmp_path / "run.simtel.gz"
+        for i in range(3):
+            staging.local_output_dir.joinpath(f"{i}.h5").write_text(str(i))
+            staging.finish(staging.local_output_dir / f"{i}.h5")
+        # moved in the background, while the next files are processed
+        deadline = time.time() + 10
+        while not outputs.joinpath("2.h5").exists() and time.time() < deadline:
+            time.sleep(0.01)
+        assert outputs.joinpath("2.h5").read_text() == "2"
+        staging.local_output_dir.joinpath("3.h5").write_text("3")
+        assert staging.collect() == [staging.local_output_dir / "3.h5"]
+    assert sorted(path.name for path in outputs.iterdir()) == ["0.h5", "1.h5", "2.h5", "3.h5"]
+
+    # a failed move fails the task once the other outputs are moved
+    def failing_move(source, destination):
+        if source.name == "0.h5":
+            raise OSError("disk quota exceeded")
+        os.replace(source, destination)
+
+    monkeypatch.setattr("lstmcpipe.io.staging.move_with_checksum", failing_move)
+    with pytest.raises(OSError, match="1 outputs could not be moved"):
+        with ScratchStaging(tmp_path / "failed", scratch_dir=tmp_path / "scratch", write_behind=True) as staging:
+            for i in range(2):
+                staging.local_output_dir.joinpath(f"{i}.h5").write_text(str(i))
+                staging.finish(staging.local_output_dir / f"{i}.h5")
+    assert [path.name for path in tmp_path.joinpath("failed").iterdir()] == ["1.h5"]
+    assert list(tmp_path.joinpath("scratch").iterdir()) == []
+
+
+def test_no_staging(tmp_path):
+    with NoStaging(tmp_path / "out") as staging:
+        assert staging.stage_in(tmp_path / "a.h5") == tmp_path / "a.h5"
+        assert staging.local_output_dir == tmp_path / "out"
+        staging.release(tmp_path / "a.h5")
+    assert tmp_path.joinpath("out").is_dir()
+
+
+class RecordingStaging(ScratchStaging):
+    """ScratchStaging recording the number of local copies held at the same time"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_held = 0
+
+    def prefetch(self, file):
+        local_file = super().prefetch(file)
+        self.max_held = max(self.max_held, len(list(self.input_dir.iterdir())))
+        return local_file
+
+
+def test_prefetcher(tmp_path):
+    files = []
+    for i in range(6):
+        files.append(tmp_path / f"run{i}.simtel.gz")
+        files[-1].write_bytes(b"0" * 100)
+
+    with RecordingStaging(tmp_path / "out", scratch_dir=tmp_path / "scratch") as staging:
+        processed = []
+        with Prefetcher(files, staging, depth=2) as prefetcher:
+            for file, local_file in prefetcher:
+                # the next files are being prefetched meanwhile
+                time.sleep(0.05)
+                assert local_file.read_bytes() == b"0" * 100
+                processed.append(file)
+                prefetcher.release(local_file)
+        assert processed == files
+        assert staging.max_held == 3
+
+        # the size cap holds fewer files than the depth
+        staging.max_held = 0
+        with Prefetcher(files, staging, depth=4, max_bytes=250) as prefetcher:
+            for file, local_file in prefetcher:
+                time.sleep(0.02)
+                prefetcher.release(local_file)
+        assert staging.max_held == 2
+
+    # a missing input fails when it is reached
+    with NoStaging(tmp_path / "out") as staging, Prefetcher(files + [tmp_path / "missing"], staging) as prefetcher:
+        with pytest.raises(FileNotFoundError):
+            for file, local_file in prefetcher:
+                assert local_file == file
+                prefetcher.release(local_file)
+
+
+def test_core_script_staging(tmp_path):
+    """script_batch_filelist_cta with a fake ctapipe-stage1 recording where it writes"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    fake = bin_dir / "ctapipe-stage1"
+    fake.write_text(
+        f"#!{sys.executable}\n"
+        "import sys\n"
+        "args = dict(arg.lstrip('-').split('=', 1) for arg in sys.argv[1:])\n"
+        "open(args['output'], 'w').write(args['input'])\n"
+    )
+    fake.chmod(fake.stat().st_mode | stat.S_IEXEC)
+    r0 = tmp_path / "r0"
+    r0.mkdir()
+    filelist = tmp_path / "files.list"
+    filelist.write_text("".join(f"{r0 / f'run{i}.simtel.gz'}\n" for i in range(3)))
+    for i in range(3):
+        r0.joinpath(f"run{i}.simtel.gz").write_text("r0")
+
+    env = dict(os.environ, PATH=f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    env.pop("SLURM_ARRAY_TASK_ID", None)
+    cmd = [
+        "lstmcpipe_cta_core_r0_dl1",
+        "-f",
+        str(filelist),
+        "-o",
+        str(tmp_path / "dl1"),
+        "-c",
+        "",
+        "--scratch-staging",
+        "--scratch-dir",
+        str(tmp_path / "scratch"),
+        "--prefetch-depth",
+        "1",
+        "--write-behind",
+    ]
+    sp.run(cmd, env=env, check=True, cwd=tmp_path)
+
+    outputs = sorted(tmp_path.joinpath("dl1").iterdir())
+    assert [path.name for path in outputs] == [f"run{i}.dl1.h5" for i in range(3)]
+    # processed from the local copies
+    assert all(path.read_text().startswith(str(tmp_path / "scratch")) for path in outputs)
+    assert list(tmp_path.joinpath("scratch").iterdir()) == []
+
+
+def test_prefetcher_without_depth(tmp_path, monkeypatch):
+    """pool modes without prefetch stage the files when they are reached, without reading them"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    warmed = []
+    monkeypatch.setattr("lstmcpipe.io.staging.warm_page_cache", warmed.append)
+    files = []
+    for i in range(4):
+        files.append(tmp_path / f"run{i}.simtel.gz")
+        files[-1].write_bytes(b"0" * 10)
+
+    max_held = 0
+    with NoStaging(tmp_path / "out") as staging, ThreadPoolExecutor(2) as pool:
+        with Prefetcher(files, staging, depth=0, n_processing=2) as prefetcher:
+            for file, local_file in prefetcher:
+                assert local_file == file
+                max_held = max(max_held, len(prefetcher._held))
+                pool.submit(lambda local_file: time.sleep(0.05) or prefetcher.release(local_file), local_file)
+    assert warmed == []
+    assert max_held == 2
@@ -17,6 +17,7 @@
 #   [-conf_cta CTA_CONFIG_FILE]
 #
 
+import sys
 import argparse
 from pathlib import Path
 from lstmcpipe.logging import setup_logging
@@ -26,9 +27,13 @@ from lstmcpipe.io.lstmcpipe_tree_path import (
     create_log_files,
     update_scancel_file,
 )
+from lstmcpipe.io.production_db import ProductionDB, create_production_db
 from lstmcpipe.utils import (
     batch_mc_production_check,
 )
+from lstmcpipe.dag import JobDag
+from lstmcpipe.planner import plan_production, get_stage_rates, format_plan
+from lstmcpipe.executors import get_executor
 from lstmcpipe.stages import (
     batch_process_dl1,
     batch_train_test_splitting,
@@ -39,6 +44,7 @@ from lstmcpipe.stages import (
     batch_dl2_to_sensitivity,
     batch_plot_rf_features,
 )
+from lstmcpipe.stages.mc_train_test_splitting import virtual_split, physical_split_paths
 
 
 def build_argparser():
@@ -91,6 +97,33 @@ def build_argparser():
         default=None,
     )
 
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Keep the complete dl1 files of a previous run and only process the missing or corrupted ones",
+    )
+
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Only print the planned jobs, core-hours, output volume and wall time of the production, "
+        "without submitting anything",
+    )
+    parser.add_argument(
+        "--plan-slots",
+        type=int,
+        dest="plan_slots",
+        default=100,
+        help="Number of concurrent slots to estimate the wall time of the production with --plan. Default: 100",
+    )
+    parser.add_argument(
+        "--plan-db",
+        type=str,
+        dest="plan_db",
+        default=None,
+        help="Production database of a previous production, to estimate the output/input size ratios with --plan",
+    )
+
     parser.add_argument("--debug", action="store_true", help="print debug messages to stderr")
     parser.add_argument(
         "--log-file",
@@ -104,6 +137,25 @@ def build_argparser():
     return parser
 
 
+def print_plan(lstmcpipe_config, n_slots=100, db_path=None):
+    """
+    Print the plan of a production, see `lstmcpipe.planner`
+
+    Parameters
+    ----------
+    lstmcpipe_config: dict
+    n_slots: int
+        Number of concurrent slots to estimate the wall time
+    db_path: str or None
+        Production database of a previous production, to estimate the output/input size ratios of the stages
+    """
+    db = ProductionDB(db_path) if db_path is not None else None
+    rates = get_stage_rates(lstmcpipe_config["batch_config"], db=db)
+    if db is not None:
+        db.close()
+    print(format_plan(plan_production(lstmcpipe_config, rates=rates).report(n_slots)))
+
+
 def main():
     """
     Main lstmcpipe script. This will launch the selected stages and start the processing.
@@ -122,6 +174,10 @@ def main():
         same for ctapipe
     --config_file_rat / -conf_rta
         same for HIPERTA
+    --plan
+        Only print the plan of the production (jobs, core-hours, output volume, wall time), nothing is submitted.
+    --plan-slots / --plan-db
+        Number of concurrent slots and database of a previous production used by --plan.
     --log-file
         Optional: path to a file where lstmcpipe logging will be written to.
     --debug
@@ -134,6 +190,9 @@ def main():
     log.info("Starting lstmcpipe processing script")
     # Read MC production configuration file
     lstmcpipe_config = load_config(args.config_mc_prod)
+    if args.plan:
+        print_plan(lstmcpipe_config, n_slots=args.plan_slots, db_path=args.plan_db)
+        return
     query_continue("Are you sure ?")
 
     # Load variables
@@ -144,7 +203,13 @@ def main():
 
     # Create log files and log directory
     logs_files, scancel_file, logs_dir = create_log_files(prod_id)
+    # jobs, files and logs are recorded in the production database, the YAML log files are exported after each stage
+    production_db = create_production_db(logs_dir, prod_id)
+    logs_files["db"] = production_db
     all_job_ids = {}
+    # each unit of a stage only waits for the jobs producing its inputs.
+    # The job ids of the previous stages passed below are only used for inputs produced by no known job.
+    dag = JobDag(db=production_db)
 
     # 1 STAGE --> R0/1 to DL1 or reprocessing of existing dl1a files
     r0_to_dl1 = "r0_to_dl1" in stages_to_run
@@ -172,6 +237,8 @@ def main():
             workflow_kind=workflow_kind,
             new_production=r0_to_dl1,
             logs=logs_files,
+            resume=args.resume,
+            dag=dag,
         )
 
         update_scancel_file(scancel_file, jobs_from_dl1_processing)
@@ -183,12 +250,25 @@ def main():
         jobs_from_dl1_processing = None
 
     # 2.1 STAGE --> Train, test splitting
-    if "train_test_split" in stages_to_run:
+    # a virtual split (only writing filelists) is done by the merging jobs, ctapipe-merge cannot read filelists.
+    # Only the splits whose train and test dirs are merged are virtual, the other ones are run.
+    split_paths = lstmcpipe_config["stages"].get("train_test_split", []) if "train_test_split" in stages_to_run else []
+    split = None
+    if (
+        split_paths
+        and "merge_dl1" in stages_to_run
+        and batch_config.get("virtual_train_test_split", False)
+        and workflow_kind in ["lstchain", "hiperta"]
+    ):
+        split = virtual_split(split_paths, lstmcpipe_config["stages"]["merge_dl1"])
+        split_paths = physical_split_paths(split_paths, split)
+    if split_paths:
         jobs_from_splitting = batch_train_test_splitting(
-            lstmcpipe_config["stages"]["train_test_split"],
+            split_paths,
             jobids_from_r0dl1=jobs_from_dl1_processing,
             batch_config=batch_config,
             logs=logs_files,
+            dag=dag,
         )
 
         update_scancel_file(scancel_file, jobs_from_splitting)
@@ -209,6 +289,8 @@ def main():
             batch_config=batch_config,
             workflow_kind=workflow_kind,
             logs=logs_files,
+            virtual_split=split,
+            dag=dag,
         )
 
         update_scancel_file(scancel_file, jobs_from_merge)
@@ -224,6 +306,7 @@ def main():
             config_file=Path(args.config_file_lst).resolve().as_posix(),
             batch_config=batch_config,
             logs=logs_files,
+            dag=dag,
         )
 
         update_scancel_file(scancel_file, job_from_train_pipe)
@@ -236,6 +319,7 @@ def main():
             batch_config,
             job_from_train_pipe,
             logs=logs_files,
+            dag=dag,
         )
         update_scancel_file(scancel_file, job_from_plot_rf_feat)
         all_job_ids.update({"plot_rf_feat": job_from_plot_rf_feat})
@@ -245,13 +329,8 @@ def main():
 
     # 4 STAGE --> DL1 to DL2 stage
     if "dl1_to_dl2" in stages_to_run:
-        jobs_dependency_for_dl1_dl2 = jobs_from_merge
-        if job_from_train_pipe is not None:
-            jobs_dependency_for_dl1_dl2 = (
-                ",".join([jobs_dependency_for_dl1_dl2, job_from_train_pipe])
-                if jobs_dependency_for_dl1_dl2 is not None
-                else job_from_train_pipe
-            )
+        # stages restored from the stage cache have no job id
+        jobs_dependency_for_dl1_dl2 = ",".join(filter(None, [jobs_from_merge, job_from_train_pipe]))
 
         jobs_from_dl1_dl2 = batch_dl1_to_dl2(
             lstmcpipe_config["stages"]["dl1_to_dl2"],
@@ -259,6 +338,7 @@ def main():
             jobs_dependency_for_dl1_dl2,
             batch_config=batch_config,
             logs=logs_files,
+            dag=dag,
         )
 
         update_scancel_file(scancel_file, jobs_from_dl1_dl2)
@@ -274,6 +354,7 @@ def main():
             jobs_from_dl1_dl2,
             batch_config=batch_config,
             logs=logs_files,
+            dag=dag,
         )
 
         update_scancel_file(scancel_file, jobs_from_dl2_irf)
@@ -286,6 +367,7 @@ def main():
             jobs_from_dl1_dl2,
             batch_config=batch_config,
             logs=logs_files,
+            dag=dag,
         )
 
         update_scancel_file(scancel_file, jobs_from_dl2_sensitivity)
@@ -299,11 +381,21 @@ def main():
         prod_config_file=args.config_mc_prod,
         batch_config=batch_config,
         logs_files=logs_files,
+        executor=get_executor(batch_config),
     )
 
     update_scancel_file(scancel_file, jobid_check)
+    production_db.close()
     log.info("Finished lstmcpipe processing script. All jobs have been submitted")
 
+    executor = get_executor(batch_config)
+    if executor.name != "slurm":
+        log.info(f"Waiting for the {executor.name} jobs to finish")
+        if not executor.wait():
+            log.error("Some jobs failed, see their .e and .o log files")
+            sys.exit(1)
+        log.info("All the jobs finished successfully")
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+
+# Monitoring of a running production.
+# The states of the jobs recorded in the production database are polled with sacct, asynchronously and at a bounded
+# rate, to report the progress of each stage, the throughput, the projected completion time and the critical path
+# (the chain of jobs that determines the completion time).
+
+import re
+import math
+import time
+import asyncio
+import logging
+from datetime import datetime
+
+from .utils import slurm_time_to_seconds
+
+log = logging.getLogger(__name__)
+
+SACCT_FIELDS = ["jobid", "state", "start", "end", "elapsed"]
+
+RUNNING_STATES = {"RUNNING", "COMPLETING", "CONFIGURING", "STAGE_OUT", "RESIZING"}
+PENDING_STATES = {"PENDING", "REQUEUED", "REQUEUE_HOLD", "REQUEUE_FED", "SUSPENDED", "SUBMITTED"}
+COMPLETED_STATES = {"COMPLETED"}
+# any other state (FAILED, TIMEOUT, OUT_OF_MEMORY, CANCELLED, NODE_FAIL...) is a failure
+
+_ARRAY_PATTERN = re.compile(r"--array=([\d,\-]+)(?:%(\d+))?")
+_PENDING_TASKS_PATTERN = re.compile(r"^(\d+)_\[([^\]]+)\]$")
+
+
+def state_category(state):
+    """
+    `completed`, `running`, `pending` or `failed`
+    """
+    state = state.split()[0].rstrip("+") if state else "PENDING"
+    if state in COMPLETED_STATES:
+        return "completed"
+    if state in RUNNING_STATES:
+        return "running"
+    if state in PENDING_STATES:
+        return "pending"
+    return "failed"
+
+
+def parse_sacct_time(value):
+    """
+    Timestamp of a sacct date, None if unknown
+    """
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_sacct(output):
+    """
+    Parse the output of `sacct -P -n -o jobid,state,start,end,elapsed`.
+    The pending tasks of an array reported together (e.g. `12_[3-9%2]`) are expanded.
+
+    Returns
+    -------
+    dict: {jobid or `jobid_task`: {"state", "start", "end", "elapsed"}}, times as timestamps, elapsed in seconds
+    """
+    units = {}
+    for line in output.splitlines():
+        fields = line.strip().split("|")
+        if len(fields) < len(SACCT_FIELDS) or "." in fields[0]:
+            # job steps (`jobid.batch`) are ignored
+            continue
+        jobid, state, start, end, elapsed = fields[: len(SACCT_FIELDS)]
+        unit = {
+            "state": state.split()[0] if state else "PENDING",
+            "start": parse_sacct_time(start),
+            "end": parse_sacct_time(end),
+            "elapsed": slurm_time_to_seconds(elapsed) if elapsed else 0,
+        }
+        pending = _PENDING_TASKS_PATTERN.match(jobid)
+        if pending:
+            array_jobid, spec = pending.groups()
+            for task in expand_array(spec.split("%")[0]):
+                units[f"{array_jobid}_{task}"] = dict(unit)
+        else:
+            units[jobid] = unit
+    return units
+
+
+def expand_array(spec):
+    """
+    Task ids of an array specification such as `0-9` or `1,3,5-7`
+    """
+    tasks = []
+    for item in spec.split(","):
+        first, _, last = item.partition("-")
+        tasks.extend(range(int(first), int(last or first) + 1))
+    return tasks
+
+
+async def _sacct(jobids, semaphore):
+    cmd = ["sacct", "-X", "-P", "-n", f"--format={','.join(SACCT_FIELDS)}", "-j", ",".join(jobids)]
+    async with semaphore:
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        log.warning(f"sacct failed ({process.returncode}): {stderr.decode().strip()}")
+        return {}
+    return parse_sacct(stdout.decode())
+
+
+async def poll_states(jobids, max_concurrent=2, chunk_size=200):
+    """
+    States of the jobs (and of their array tasks), from sacct calls on chunks of job ids.
+
+    Parameters
+    ----------
+    jobids: list of str
+    max_concurrent: int
+        Maximum number of sacct calls running at the same time
+    chunk_size: int
+        Number of job ids per sacct call
+
+    Returns
+    -------
+    dict: as returned by `parse_sacct`
+    """
+    semaphore = asyncio.Semaphore(max_concurrent)
+    chunks = [jobids[i : i + chunk_size] for i in range(0, len(jobids), chunk_size)]
+    units = {}
+    for result in await asyncio.gather(*[_sacct(chunk, semaphore) for chunk in chunks]):
+        units.update(result)
+    return units
+
+
+def array_parallelism(command):
+    """
+    Maximum number of tasks running at the same time of a job, from its sbatch command (1 if not an array)
+    """
+    match = _ARRAY_PATTERN.search(command or "")
+    if match is None:
+        return 1
+    return int(match.group(2)) if match.group(2) else len(expand_array(match.group(1)))
+
+
+class ProductionStatus:
+    """
+    Progress of a production from the jobs of its database and their polled states.
+
+    Parameters
+    ----------
+    jobs: list of dict
+        Jobs of the production, as returned by `lstmcpipe.io.production_db.ProductionDB.jobs`
+    units: dict
+        States of the jobs and array tasks, as returned by `parse_sacct`.
+        Jobs not reported by sacct are considered pending.
+    tasks: dict
+        {jobid: list of task ids} known for the array jobs, used when sacct does not report them yet
+    output_files: dict
+        {jobid or `jobid_task`: number of output files}
+    now: float
+        Timestamp of the report
+    replaced: set of str
+        Failed jobs or array tasks that were resubmitted, ignored
+    """
+
+    def __init__(self, jobs, units, tasks=None, output_files=None, now=None, replaced=()):
+        self.jobs = {job["jobid"]: job for job in jobs}
+        self.now = time.time() if now is None else now
+        self.output_files = output_files or {}
+        tasks = tasks or {}
+        self.units = {jobid: {} for jobid in self.jobs}
+        reported = set()
+        for unit_id, unit in units.items():
+            jobid = unit_id.partition("_")[0]
+            reported.add(jobid)
+            if jobid in self.units and unit_id not in replaced:
+                self.units[jobid][unit_id] = unit
+        for jobid in set(replaced).intersection(self.jobs):
+            # resubmitted job
+            del self.units[jobid]
+            del self.jobs[jobid]
+        for jobid, job_units in self.units.items():
+            if jobid not in reported:
+                ids = [f"{jobid}_{task}" for task in tasks.get(jobid, [])] or [jobid]
+                job_units.update({unit_id: {"state": "PENDING", "start": None, "end": None} for unit_id in ids})
+        self.durations = self._stage_durations()
+        self._ends = {}
+
+    def _stage_durations(self):
+        """
+        Mean duration of the completed units of each stage, and of all the stages (None key)
+        """
+        elapsed = {}
+        for jobid, job_units in self.units.items():
+            for unit in job_units.values():
+                if state_category(unit["state"]) == "completed" and unit.get("elapsed"):
+                    elapsed.setdefault(self.jobs[jobid]["stage"], []).append(unit["elapsed"])
+        durations = {stage: sum(values) / len(values) for stage, values in elapsed.items()}
+        all_values = [value for values in elapsed.values() for value in values]
+        durations[None] = sum(all_values) / len(all_values) if all_values else None
+        return durations
+
+    def stage_duration(self, stage):
+        return self.durations.get(stage, self.durations[None])
+
+    def stages(self):
+        """
+        Number of units of each stage per state category, and completed units per hour.
+
+        Returns
+        -------
+        dict: {stage: {"total", "completed", "running", "pending", "failed", "tasks_per_hour"}}
+        """
+        summary = {}
+        for jobid, job_units in self.units.items():
+            stage = summary.setdefault(
+                self.jobs[jobid]["stage"],
+                {"total": 0, "completed": 0, "running": 0, "pending": 0, "failed": 0, "start": None, "end": None},
+            )
+            for unit in job_units.values():
+                stage["total"] += 1
+                category = state_category(unit["state"])
+                stage[category] += 1
+                if unit["start"] is not None:
+                    stage["start"] = unit["start"] if stage["start"] is None else min(stage["start"], unit["start"])
+                if category == "completed" and unit["end"] is not None:
+                    stage["end"] = unit["end"] if stage["end"] is None else max(stage["end"], unit["end"])
+        for stage in summary.values():
+            start, end = stage.pop("start"), stage.pop("end")
+            if start is None:
+                hours = 0
+            else:
+                hours = ((end if stage["completed"] == stage["total"] else self.now) - start) / 3600
+            stage["tasks_per_hour"] = stage["completed"] / hours if hours > 0 else 0.0
+        return summary
+
+    def files_per_hour(self):
+        """
+        Output files of the completed units per hour since the start of the first job
+        """
+        starts = [unit["start"] for units in self.units.values() for unit in units.values()]
+        starts = [start for start in starts if start is not None]
+        if not starts:
+            return 0.0
+        n_files = 0
+        for jobid, job_units in self.units.items():
+            # the outputs can be recorded for the array tasks or for the whole job
+            completed = [unit_id for unit_id, unit in job_units.items() if state_category(unit["state"]) == "completed"]
+            n_files += sum(self.output_files.get(unit_id, 0) for unit_id in completed if unit_id != jobid)
+            if len(completed) == len(job_units):
+                n_files += self.output_files.get(jobid, 0)
+        hours = (self.now - min(starts)) / 3600
+        return n_files / hours if hours > 0 else 0.0
+
+    def job_states(self):
+        """
+        States of the jobs and of their array tasks. The state of an array job is FAILED if one of its tasks failed,
+        else RUNNING if one of them is running, COMPLETED if all of them completed and PENDING otherwise.
+
+        Returns
+        -------
+        dict: {jobid or `jobid_task`: state}
+        """
+        states = {}
+        for jobid, job_units in self.units.items():
+            states.update({unit_id: unit["state"] for unit_id, unit in job_units.items()})
+            if jobid not in job_units:
+                categories = {state_category(unit["state"]) for unit in job_units.values()}
+                for category, state in (("failed", "FAILED"), ("running", "RUNNING"), ("pending", "PENDING")):
+                    if category in categories:
+                        states[jobid] = state
+                        break
+                else:
+                    states[jobid] = "COMPLETED"
+        return states
+
+    def dependencies(self, jobid):
+        """
+        Jobs of the production a job waits for
+        """
+        deps = [dep.partition("_")[0] for dep in self.jobs[jobid]["dependencies"].split(",") if dep]
+        return [dep for dep in dict.fromkeys(deps) if dep in self.jobs]
+
+    def job_end(self, jobid):
+        """
+        Projected end of a job. None if it cannot be estimated yet (no completed unit in the production).
+        Failed units are counted as ended: they block the jobs depending on them, which is reported separately.
+        """
+        if jobid not in self._ends:
+            self._ends[jobid] = self._estimate_end(jobid)
+        return self._ends[jobid]
+
+    def _estimate_end(self, jobid):
+        job = self.jobs[jobid]
+        duration = self.stage_duration(job["stage"])
+        ends, n_pending = [], 0
+        for unit in self.units[jobid].values():
+            category = state_category(unit["state"])
+            if category in ("completed", "failed"):
+                ends.append(unit["end"] or self.now)
+            elif category == "running":
+                if duration is None:
+                    return None
+                ends.append(max(self.now, (unit["start"] or self.now) + duration))
+            else:
+                n_pending += 1
+        if n_pending:
+            if duration is None:
+                return None
+            ready = self.now
+            for dep in self.dependencies(jobid):
+                dep_end = self.job_end(dep)
+                if dep_end is None:
+                    return None
+                ready = max(ready, dep_end)
+            batches = math.ceil(n_pending / array_parallelism(job.get("command")))
+            ends.append(ready + batches * duration)
+        return max(ends) if ends else self.now
+
+    def completion(self):
+        """
+        Projected completion time of the production and its critical path.
+
+        Returns
+        -------
+        (float or None, list of str): completion timestamp, and job ids of the critical path in execution order
+        """
+        ends = {jobid: self.job_end(jobid) for jobid in self.jobs}
+        if not ends or any(end is None for end in ends.values()):
+            return None, []
+        jobid = max(ends, key=ends.get)
+        path = [jobid]
+        while True:
+            deps = self.dependencies(jobid)
+            if not deps:
+                break
+            jobid = max(deps, key=ends.get)
+            path.append(jobid)
+        return ends[path[0]], path[::-1]
+
+    def report(self):
+        """
+        Machine-readable report
+
+        Returns
+        -------
+        dict
+        """
+        eta, critical_path = self.completion()
+        stages = self.stages()
+        return {
+            "time": self.now,
+            "stages": stages,
+            "files_per_hour": self.files_per_hour(),
+            "finished": all(s["completed"] + s["failed"] == s["total"] for s in stages.values()),
+            "failed": sum(s["failed"] for s in stages.values()),
+            "projected_completion": eta,
+            "remaining_seconds": max(0.0, eta - self.now) if eta is not None else None,
+            "critical_path": [
+                {"jobid": jobid, "stage": self.jobs[jobid]["stage"], "projected_end": self.job_end(jobid)}
+                for jobid in critical_path
+            ],
+        }
+
+
+def format_report(report):
+    """
+    Human-readable report
+    """
+
+    def format_time(timestamp):
+        return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M") if timestamp is not None else "unknown"
+
+    lines = [
+        f"{'stage':<28}{'total':>8}{'done':>8}{'running':>9}{'pending':>9}{'failed':>8}{'tasks/h':>10}",
+    ]
+    for name, stage in report["stages"].items():
+        lines.append(
+            f"{name:<28}{stage['total']:>8}{stage['completed']:>8}{stage['running']:>9}{stage['pending']:>9}"
+            f"{stage['failed']:>8}{stage['tasks_per_hour']:>10.1f}"
+        )
+    lines.append(f"Output files per hour: {report['files_per_hour']:.1f}")
+    if report["finished"]:
+        lines.append("All the jobs are finished")
+    else:
+        lines.append(f"Projected completion: {format_time(report['projected_completion'])}")
+        path = [
+            f"{job['stage']} {job['jobid']} ({format_time(job['projected_end'])})" for job in report["critical_path"]
+        ]
+        lines.append(f"Critical path: {' -> '.join(path)}")
+    if report["failed"]:
+        lines.append(f"WARNING: {report['failed']} failed tasks, the jobs depending on them will not start")
+    return "\n".join(lines)
+
+
+def production_status(db, units, now=None):
+    """
+    `ProductionStatus` of the jobs recorded in a production database
+
+    Parameters
+    ----------
+    db: `lstmcpipe.io.production_db.ProductionDB`
+    units: dict
+        as returned by `poll_states`
+    now: float or None
+    """
+    jobs = db.jobs()
+    tasks, output_files = {}, {}
+    for row in db.query("SELECT jobid, task FROM tasks ORDER BY task"):
+        tasks.setdefault(row["jobid"], []).append(row["task"])
+    for row in db.query("SELECT jobid, COUNT(*) AS n FROM files WHERE direction = 'output' GROUP BY jobid"):
+        output_files[row["jobid"]] = row["n"]
+    return ProductionStatus(
+        jobs, units, tasks=tasks, output_files=output_files, now=now, replaced=set(db.resubmissions())
+    )
+
+
+async def monitor(db, interval=120, once=False, max_concurrent=2, chunk_size=200, callback=print, formatter=None):
+    """
+    Poll the states of the jobs of a production and report its progress until all the jobs are finished.
+    The polled states are saved in the database.
+
+    Parameters
+    ----------
+    db: `lstmcpipe.io.production_db.ProductionDB`
+    interval: float
+        Minimum time in seconds between two polls
+    once: bool
+        Report only once
+    max_concurrent: int
+        Maximum number of sacct calls running at the same time
+    chunk_size: int
+        Number of job ids per sacct call
+    callback: callable
+        Called with each formatted report
+    formatter: callable or None
+        Formatting of the report dict, `format_report` if None
+
+    Returns
+    -------
+    dict: last report
+    """
+    formatter = format_report if formatter is None else formatter
+    while True:
+        start = time.monotonic()
+        jobids = [job["jobid"] for job in db.jobs()]
+        units = await poll_states(jobids, max_concurrent=max_concurrent, chunk_size=chunk_size)
+        status = production_status(db, units)
+        db.set_states(status.job_states())
+        report = status.report()
+        callback(formatter(report))
+        if once or report["finished"]:
+            return report
+        await asyncio.sleep(max(0.0, interval - (time.monotonic() - start)))
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+# Dry-run planning of a production.
+# The inputs of the stages of a lstmcpipe config are scanned (in parallel, as stat calls are latency-bound on shared
+# filesystems) and the jobs, core-hours and output volume of the production are estimated from per-stage throughputs
+# and output/input size ratios, without submitting anything. The inputs produced by the production itself are
+# estimated from the planned outputs of the stages producing them.
+
+import os
+import math
+import heapq
+import fnmatch
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .dag import JobDag, flatten_paths, is_related
+from .utils import SbatchLstMCStage
+from .io.stage_cache import INPUT_DIR_PATTERNS
+from .io.resource_history import get_resource_history
+from .stages.mc_process_dl1 import DEFAULT_DL1_THROUGHPUT_MBPS, dl1_target_bytes_per_job
+
+log = logging.getLogger(__name__)
+
+# stages in the order they are run by lstmcpipe
+STAGE_ORDER = [
+    "r0_to_dl1",
+    "dl1ab",
+    "train_test_split",
+    "merge_dl1",
+    "train_pipe",
+    "dl1_to_dl2",
+    "dl2_to_irfs",
+    "dl2_to_sensitivity",
+]
+
+# names of the stages in `SbatchLstMCStage`, for their default number of cpus
+SBATCH_STAGES = {"train_test_split": "train_test_splitting", "dl2_to_sensitivity": "dl2_sens"}
+
+# files of the input directories of the stages
+INPUT_PATTERNS = {"r0_to_dl1": ("*.simtel.gz",), "dl1ab": ("*.h5",)}
+
+# MB of input processed per second by a job and output/input size ratio of the stages, orders of magnitude
+DEFAULT_STAGE_RATES = {
+    "r0_to_dl1": {"throughput_MBps": DEFAULT_DL1_THROUGHPUT_MBPS, "size_ratio": 0.3},
+    "dl1ab": {"throughput_MBps": 5.0, "size_ratio": 1.0},
+    "train_test_split": {"throughput_MBps": 200.0, "size_ratio": 1.0},
+    "merge_dl1": {"throughput_MBps": 50.0, "size_ratio": 0.5},
+    "train_pipe": {"throughput_MBps": 0.5, "size_ratio": 0.2},
+    "dl1_to_dl2": {"throughput_MBps": 5.0, "size_ratio": 0.3},
+    "dl2_to_irfs": {"throughput_MBps": 20.0, "size_ratio": 0.001},
+    "dl2_to_sensitivity": {"throughput_MBps": 20.0, "size_ratio": 0.001},
+}
+
+
+def scan_path(path, patterns=INPUT_DIR_PATTERNS):
+    """
+    Number of files and bytes of a file, or of the files matching `patterns` in a directory and its subdirectories.
+
+    Returns
+    -------
+    (int, int) or None: None if the path does not exist
+    """
+    if os.path.isfile(path):
+        return 1, os.path.getsize(path)
+    if not os.path.isdir(path):
+        return None
+    n_files, n_bytes = 0, 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                n_files += 1
+                n_bytes += os.path.getsize(os.path.join(root, name))
+    return n_files, n_bytes
+
+
+def scan_paths(paths, patterns=INPUT_DIR_PATTERNS, n_threads=16):
+    """
+    `scan_path` of several paths, in a thread pool.
+
+    Returns
+    -------
+    dict: {path: (n_files, n_bytes) or None}
+    """
+    paths = list(dict.fromkeys(paths))
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        return dict(zip(paths, pool.map(lambda path: scan_path(path, patterns), paths)))
+
+
+def stage_cpus(stage):
+    """
+    Default number of cpus of the jobs of a stage
+    """
+    options = SbatchLstMCStage(stage, "true").stage_default_options(SBATCH_STAGES.get(stage, stage))
+    return int(options.get("cpus-per-task", 1))
+
+
+def get_stage_rates(batch_config=None, db=None):
+    """
+    Throughputs and size ratios of the stages.
+    The defaults are replaced by the throughputs measured in the resource history (`resource_history` entry of the
+    batch config) and by the size ratios of the files of a previous production.
+
+    Parameters
+    ----------
+    batch_config: dict or None
+    db: `lstmcpipe.io.production_db.ProductionDB` or None
+        Database of a previous production, whose files still exist
+
+    Returns
+    -------
+    dict: {stage: {"throughput_MBps", "size_ratio"}}
+    """
+    rates = {stage: dict(stage_rates) for stage, stage_rates in DEFAULT_STAGE_RATES.items()}
+
+    history = get_resource_history(batch_config)
+    if history is not None:
+        with history:
+            for stage in history.stages():
+                records = [r for r in history.records(stage) if r["input_bytes"]]
+                elapsed = sum(r["elapsed_s"] for r in records)
+                if stage in rates and elapsed > 0:
+                    rates[stage]["throughput_MBps"] = sum(r["input_bytes"] for r in records) / elapsed / 1e6
+
+    if db is not None:
+        files = db.query("SELECT DISTINCT stage, direction, path FROM files WHERE jobid != ''")
+        for stage in rates:
+            patterns = INPUT_PATTERNS.get(stage, INPUT_DIR_PATTERNS)
+            sizes = {}
+            for direction in ["input", "output"]:
+                paths = [row["path"] for row in files if row["stage"] == stage and row["direction"] == direction]
+                scanned = scan_paths(paths, patterns if direction == "input" else INPUT_DIR_PATTERNS).values()
+                sizes[direction] = sum(scan[1] for scan in scanned if scan is not None)
+            if sizes["input"] > 0 and sizes["output"] > 0:
+                rates[stage]["size_ratio"] = sizes["output"] / sizes["input"]
+    return rates
+
+
+def stage_units(stage, entries):
+    """
+    (inputs, outputs) of the units of a stage from its entries in the lstmcpipe config
+    """
+    units = []
+    for paths in entries:
+        inputs = [paths["input"], paths["path_model"]] if stage == "dl1_to_dl2" else paths["input"]
+        units.append((flatten_paths(inputs), flatten_paths(paths["output"])))
+    return units
+
+
+def plan_production(lstmcpipe_config, rates=None, n_threads=16):
+    """
+    Plan the units of the stages to run of a lstmcpipe config.
+
+    Parameters
+    ----------
+    lstmcpipe_config: dict
+        Loaded lstmcpipe config, see `lstmcpipe.config.load_config`
+    rates: dict or None
+        Throughputs and size ratios of the stages, see `get_stage_rates`
+    n_threads: int
+        Number of threads scanning the inputs
+
+    Returns
+    -------
+    `ProductionPlan`
+    """
+    rates = get_stage_rates(lstmcpipe_config.get("batch_config")) if rates is None else rates
+    batch_config = lstmcpipe_config.get("batch_config") or {}
+    stages_to_run = [stage for stage in STAGE_ORDER if stage in lstmcpipe_config["stages_to_run"]]
+    virtual_split = batch_config.get("virtual_train_test_split", False)
+
+    # inputs existing before the production, scanned at once
+    planned = {stage: stage_units(stage, lstmcpipe_config["stages"][stage]) for stage in stages_to_run}
+    scans = {}
+    for stage, units in planned.items():
+        paths = [path for inputs, _ in units for path in inputs]
+        scans[stage] = scan_paths(paths, INPUT_PATTERNS.get(stage, INPUT_DIR_PATTERNS), n_threads)
+
+    dag = JobDag()
+    plan_units = []
+    for stage in stages_to_run:
+        for inputs, outputs in planned[stage]:
+            n_files, n_bytes, dependencies = 0, 0, set()
+            for path in inputs:
+                producers = dag.producers(path)
+                for node in producers:
+                    producer = plan_units[int(node["jobid"])]
+                    dependencies.add(int(node["jobid"]))
+                    related = [out for out in producer["outputs"] if is_related(path, out)]
+                    n_files += producer["output_files"] * len(related) // len(producer["outputs"])
+                    n_bytes += producer["output_bytes"] * len(related) // len(producer["outputs"])
+                if not producers and scans[stage][path] is not None:
+                    n_files += scans[stage][path][0]
+                    n_bytes += scans[stage][path][1]
+                elif not producers:
+                    log.warning(f"{path} ({stage} input) does not exist and is not produced by the production")
+
+            n_tasks = 1
+            if stage in ["r0_to_dl1", "dl1ab"] and n_files:
+                target_bytes = dl1_target_bytes_per_job(batch_config, stage)
+                if target_bytes:
+                    n_tasks = max(1, min(n_files, math.ceil(n_bytes / target_bytes)))
+                else:
+                    files_per_job = 50 if stage == "dl1ab" or n_files >= 50 else 20
+                    n_tasks = math.ceil(n_files / files_per_job)
+            duration = n_bytes / 1e6 / rates[stage]["throughput_MBps"]
+            if stage == "train_test_split" and virtual_split:
+                # the virtual split is done by the merging jobs
+                duration = 0
+            unit = {
+                "stage": stage,
+                "inputs": inputs,
+                "outputs": outputs,
+                "input_files": n_files,
+                "input_bytes": n_bytes,
+                "output_files": n_files if stage in ["r0_to_dl1", "dl1ab", "train_test_split"] else len(outputs),
+                "output_bytes": int(n_bytes * rates[stage]["size_ratio"]),
+                "n_tasks": n_tasks,
+                "task_duration": duration / n_tasks,
+                "cpus": stage_cpus(stage),
+                "dependencies": sorted(dependencies),
+            }
+            dag.add(stage, inputs, outputs, str(len(plan_units)))
+            plan_units.append(unit)
+    return ProductionPlan(plan_units)
+
+
+def schedule(units, n_slots):
+    """
+    End time of the units, with their tasks run on `n_slots` concurrent slots as soon as their dependencies are done,
+    in the order of the units (list scheduling).
+
+    Returns
+    -------
+    list of float
+    """
+    slots = [0.0] * max(1, n_slots)
+    ends = []
+    for unit in units:
+        ready = max((ends[dep] for dep in unit["dependencies"]), default=0.0)
+        end = ready
+        for _ in range(unit["n_tasks"]):
+            start = max(ready, heapq.heappop(slots))
+            heapq.heappush(slots, start + unit["task_duration"])
+            end = max(end, start + unit["task_duration"])
+        ends.append(end)
+    return ends
+
+
+class ProductionPlan:
+    """
+    Planned units of a production.
+
+    Parameters
+    ----------
+    units: list of dict
+        Units in submission order, with their inputs and outputs, their input files and bytes, their output files and
+        bytes, their number of array tasks, the duration and cpus of a task and the indices of the units they depend on
+    """
+
+    def __init__(self, units):
+        self.units = units
+
+    def stages(self):
+        """
+        Summary of the planned stages
+
+        Returns
+        -------
+        dict: {stage: {"units", "tasks", "input_files", "input_bytes", "output_bytes", "core_hours", "depends_on"}}
+        """
+        stages = {}
+        for unit in self.units:
+            summary = stages.setdefault(
+                unit["stage"],
+                {
+                    "units": 0,
+                    "tasks": 0,
+                    "input_files": 0,
+                    "input_bytes": 0,
+                    "output_bytes": 0,
+                    "core_hours": 0.0,
+                    "depends_on": [],
+                },
+            )
+            summary["units"] += 1
+            summary["tasks"] += unit["n_tasks"]
+            summary["input_files"] += unit["input_files"]
+            summary["input_bytes"] += unit["input_bytes"]
+            summary["output_bytes"] += unit["output_bytes"]
+            summary["core_hours"] += unit["n_tasks"] * unit["task_duration"] * unit["cpus"] / 3600
+            for dep in unit["dependencies"]:
+                if self.units[dep]["stage"] not in summary["depends_on"]:
+                    summary["depends_on"].append(self.units[dep]["stage"])
+        return stages
+
+    def report(self, n_slots=100):
+        """
+        Plan of the production, with the wall time estimated on `n_slots` concurrent slots
+
+        Returns
+        -------
+        dict
+        """
+        stages = self.stages()
+        return {
+            "stages": stages,
+            "jobs": sum(stage["tasks"] for stage in stages.values()),
+            "core_hours": sum(stage["core_hours"] for stage in stages.values()),
+            "output_bytes": sum(stage["output_bytes"] for stage in stages.values()),
+            "n_slots": n_slots,
+            "wall_time": max(schedule(self.units, n_slots), default=0.0),
+        }
+
+
+def format_plan(report):
+    """
+    Human-readable plan
+    """
+    lines = [
+        f"{'stage':<20} {'units':>7} {'jobs':>7} {'in files':>9} {'in GB':>10} {'out GB':>10} {'core-h':>10}  "
+        "depends on"
+    ]
+    for stage, summary in report["stages"].items():
+        lines.append(
+            f"{stage:<20} {summary['units']:>7} {summary['tasks']:>7} {summary['input_files']:>9} "
+            f"{summary['input_bytes'] / 1e9:>10.1f} {summary['output_bytes'] / 1e9:>10.1f} "
+            f"{summary['core_hours']:>10.1f}  {', '.join(summary['depends_on']) or '-'}"
+        )
+    lines.append(
+        f"{report['jobs']} jobs, {report['core_hours']:.1f} core-hours, {report['output_bytes'] / 1e12:.3f} TB of "
+        f"outputs, estimated wall time on {report['n_slots']} slots: {report['wall_time'] / 3600:.1f} h"
+    )
+    return "\n".join(lines)
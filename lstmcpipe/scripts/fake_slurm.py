@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+"""
+Emulation of the slurm commands used by lstmcpipe (sbatch, sacct, squeue), to run the orchestration without a cluster.
+
+`install` writes `sbatch`, `sacct` and `squeue` executables in a directory to put first in the PATH.
+Submitted jobs are recorded in a state directory but not run: their states are simulated from their submission time,
+their dependencies and a configurable job duration. sbatch answers after a configurable latency.
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shlex
+import argparse
+from pathlib import Path
+from datetime import datetime
+
+SLURM_COMMANDS = ["sbatch", "sacct", "squeue"]
+DEFAULT_SACCT_FIELDS = ["jobid", "jobname", "state", "exitcode"]
+
+
+def install(bin_dir, state_dir, submit_latency=0.0, job_duration=0.0):
+    """
+    Write the fake slurm executables in `bin_dir`.
+
+    Parameters
+    ----------
+    bin_dir: str or Path
+        Directory to put first in the PATH
+    state_dir: str or Path
+        Directory where the submitted jobs are recorded
+    submit_latency: float
+        Time in seconds taken by each sbatch call
+    job_duration: float
+        Simulated duration in seconds of each job (or array task)
+    """
+    bin_dir, state_dir = Path(bin_dir).resolve(), Path(state_dir).resolve()
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    with open(state_dir.joinpath("config.json"), "w") as f:
+        json.dump({"submit_latency": submit_latency, "job_duration": job_duration}, f)
+    for command in SLURM_COMMANDS:
+        shim = bin_dir.joinpath(command)
+        shim.write_text(
+            "#!/bin/sh\n"
+            f'exec {shlex.quote(sys.executable)} -m lstmcpipe.scripts.fake_slurm '
+            f'--state-dir {shlex.quote(state_dir.as_posix())} {command} "$@"\n'
+        )
+        shim.chmod(0o755)
+
+
+def load_config(state_dir):
+    with open(Path(state_dir, "config.json")) as f:
+        return json.load(f)
+
+
+def load_jobs(state_dir):
+    """
+    Submitted jobs, in submission order
+    """
+    jobs_file = Path(state_dir, "jobs.jsonl")
+    if not jobs_file.exists():
+        return []
+    with open(jobs_file) as f:
+        return [json.loads(line) for line in f]
+
+
+def parse_options(args):
+    """
+    Parse sbatch-like options: `--key=value`, `--flag` and `-k value`.
+
+    Returns
+    -------
+    dict: {key: value}, flags have the value True
+    """
+    short_options = {"p": "partition", "A": "account", "J": "job-name", "o": "output", "e": "error", "d": "dependency"}
+    options = {}
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg.startswith("--"):
+            key, sep, value = arg[2:].partition("=")
+            options[key] = value if sep else True
+        elif arg.startswith("-") and len(arg) >= 2:
+            key = short_options.get(arg[1], arg[1])
+            options[key] = arg[2:] if len(arg) > 2 else (args.pop(0) if args else True)
+    return options
+
+
+def parse_array(array):
+    """
+    (task ids, maximum number of tasks running at the same time) of a slurm array specification such as `0-9%4`
+    """
+    spec, _, parallel = str(array).partition("%")
+    tasks = []
+    for item in spec.split(","):
+        first, _, last = item.partition("-")
+        tasks.extend(range(int(first), int(last or first) + 1))
+    return tasks, int(parallel) if parallel else len(tasks)
+
+
+def sbatch(state_dir, args):
+    """
+    Record a job and print its id.
+    """
+    config = load_config(state_dir)
+    options = parse_options(args)
+    if "wrap" not in options:
+        print("sbatch: error: only --wrap jobs are supported", file=sys.stderr)
+        return 1
+
+    dependencies = []
+    dependency = options.get("dependency")
+    if dependency:
+        kind, _, jobids = str(dependency).partition(":")
+        if kind != "afterok":
+            print(f"sbatch: error: unsupported dependency type {kind}", file=sys.stderr)
+            return 1
+        # the production check job separates the job ids with commas
+        dependencies = [jobid for jobid in jobids.replace(",", ":").split(":") if jobid]
+
+    time.sleep(config.get("submit_latency", 0))
+
+    state_dir = Path(state_dir)
+    with open(state_dir.joinpath("lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        counter_file = state_dir.joinpath("next_jobid")
+        jobid = int(counter_file.read_text()) if counter_file.exists() else 1
+        if any(int(dep.split("_")[0]) >= jobid for dep in dependencies):
+            print("sbatch: error: Batch job submission failed: Job dependency problem", file=sys.stderr)
+            return 1
+        record = {
+            "jobid": str(jobid),
+            "name": options.get("job-name", "wrap"),
+            "partition": options.get("partition", ""),
+            "submit": time.time(),
+            "dependencies": dependencies,
+            "array": options.get("array"),
+            "options": {k: v for k, v in options.items() if k != "wrap"},
+            "wrap": options["wrap"],
+        }
+        with open(state_dir.joinpath("jobs.jsonl"), "a") as f:
+            f.write(json.dumps(record) + "\n")
+        counter_file.write_text(str(jobid + 1))
+
+    print(jobid if "parsable" in options else f"Submitted batch job {jobid}")
+    return 0
+
+
+class Simulation:
+    """
+    Simulated timeline of the submitted jobs: a job (or array task) starts once submitted and its dependencies ended,
+    and runs for `job_duration` seconds. The tasks of an array run by batches of its `%` limit.
+    """
+
+    def __init__(self, jobs, job_duration):
+        self.jobs = {job["jobid"]: job for job in jobs}
+        self.job_duration = job_duration
+        self._ends = {}
+
+    def tasks(self, jobid):
+        """
+        Ids of the tasks of a job (the job itself if not an array)
+        """
+        array = self.jobs[jobid]["array"]
+        if not array:
+            return [jobid]
+        return [f"{jobid}_{task}" for task in parse_array(array)[0]]
+
+    def start(self, task_id):
+        jobid, _, task = task_id.partition("_")
+        job = self.jobs[jobid]
+        ready = max([job["submit"]] + [self.end(dep) for dep in job["dependencies"]])
+        if not task:
+            return ready
+        tasks, parallel = parse_array(job["array"])
+        return ready + (tasks.index(int(task)) // parallel) * self.job_duration
+
+    def end(self, task_id):
+        if task_id not in self._ends:
+            if "_" not in task_id and self.jobs[task_id]["array"]:
+                self._ends[task_id] = max(self.end(task) for task in self.tasks(task_id))
+            else:
+                self._ends[task_id] = self.start(task_id) + self.job_duration
+        return self._ends[task_id]
+
+    def state(self, task_id, now):
+        if now < self.start(task_id):
+            return "PENDING"
+        if now < self.end(task_id):
+            return "RUNNING"
+        return "COMPLETED"
+
+    def field(self, task_id, field, now):
+        job = self.jobs[task_id.partition("_")[0]]
+        state = self.state(task_id, now)
+        values = {
+            "jobid": task_id,
+            "jobname": job["name"],
+            "partition": job["partition"],
+            "state": state,
+            "exitcode": "0:0",
+            "submit": format_time(job["submit"]),
+            "start": format_time(self.start(task_id)) if state != "PENDING" else "Unknown",
+            "end": format_time(self.end(task_id)) if state == "COMPLETED" else "Unknown",
+            "elapsed": format_elapsed(max(0.0, min(now, self.end(task_id)) - self.start(task_id))),
+            "alloccpus": "1",
+            "totalcpu": format_elapsed(max(0.0, min(now, self.end(task_id)) - self.start(task_id))),
+            "maxrss": "0K" if state == "COMPLETED" else "",
+        }
+        return values.get(field.lower(), "")
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def format_elapsed(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def selected_tasks(simulation, jobids):
+    """
+    Task ids of the selected jobs (all the jobs if `jobids` is empty)
+    """
+    tasks = []
+    for jobid in jobids or list(simulation.jobs):
+        if "_" in jobid:
+            tasks.append(jobid)
+        elif jobid in simulation.jobs:
+            tasks.extend(simulation.tasks(jobid))
+    return tasks
+
+
+def sacct(state_dir, args):
+    """
+    Print the simulated accounting information of the jobs.
+    Supported options: `-j/--jobs`, `-o/--format`, `-P/--parsable2`, `-n/--noheader`; others are ignored.
+    """
+    parser = argparse.ArgumentParser(prog="sacct", add_help=False)
+    parser.add_argument("-j", "--jobs", default="")
+    parser.add_argument("-o", "--format", default=",".join(DEFAULT_SACCT_FIELDS))
+    parser.add_argument("-P", "--parsable2", action="store_true")
+    parser.add_argument("-n", "--noheader", action="store_true")
+    args, _ = parser.parse_known_args(args)
+
+    simulation = Simulation(load_jobs(state_dir), load_config(state_dir).get("job_duration", 0))
+    fields = [field.split("%")[0] for field in args.format.split(",") if field]
+    now = time.time()
+    tasks = selected_tasks(simulation, [jobid for jobid in args.jobs.split(",") if jobid])
+    rows = [[simulation.field(task, field, now) for field in fields] for task in tasks]
+    if not args.noheader:
+        rows.insert(0, [field.capitalize() for field in fields])
+    for row in rows:
+        print("|".join(row) if args.parsable2 else " ".join(f"{value:>12}" for value in row))
+    return 0
+
+
+def squeue(state_dir, args):
+    """
+    Print the pending and running jobs. Supported options: `-j/--jobs` and `-h/--noheader`; others are ignored.
+    """
+    parser = argparse.ArgumentParser(prog="squeue", add_help=False)
+    parser.add_argument("-j", "--jobs", default="")
+    parser.add_argument("-h", "--noheader", action="store_true")
+    args, _ = parser.parse_known_args(args)
+
+    simulation = Simulation(load_jobs(state_dir), load_config(state_dir).get("job_duration", 0))
+    now = time.time()
+    if not args.noheader:
+        print(f"{'JOBID':>12} {'NAME':>16} {'STATE':>10}")
+    for task in selected_tasks(simulation, [jobid for jobid in args.jobs.split(",") if jobid]):
+        state = simulation.state(task, now)
+        if state != "COMPLETED":
+            print(f"{task:>12} {simulation.field(task, 'jobname', now):>16} {state:>10}")
+    return 0
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else list(args)
+    state_dir = os.environ.get("LSTMCPIPE_FAKE_SLURM_DIR")
+    if args[:1] == ["--state-dir"]:
+        state_dir, args = args[1], args[2:]
+
+    # slurm commands are dispatched without parsing their options here
+    commands = {"sbatch": sbatch, "sacct": sacct, "squeue": squeue}
+    if args and args[0] in commands:
+        if state_dir is None:
+            sys.exit("--state-dir or LSTMCPIPE_FAKE_SLURM_DIR is required")
+        return commands[args[0]](state_dir, args[1:])
+
+    parser = argparse.ArgumentParser(description="Fake slurm commands used to benchmark the lstmcpipe orchestration")
+    parser.add_argument("--state-dir", type=Path, default=state_dir, help="Default: $LSTMCPIPE_FAKE_SLURM_DIR")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    install_parser = subparsers.add_parser("install", help="Write the fake slurm executables in a directory")
+    install_parser.add_argument("bin_dir", type=Path)
+    install_parser.add_argument("--submit-latency", type=float, default=0.0, help="Duration of a sbatch call (s)")
+    install_parser.add_argument("--job-duration", type=float, default=0.0, help="Simulated duration of a job (s)")
+    for command in commands:
+        subparsers.add_parser(command, help=f"Fake {command}")
+    args = parser.parse_args(args)
+    if args.state_dir is None:
+        parser.error("--state-dir or LSTMCPIPE_FAKE_SLURM_DIR is required")
+
+    install(args.bin_dir, args.state_dir, args.submit_latency, args.job_duration)
+    print(f"export PATH={args.bin_dir.resolve()}:$PATH")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,7 @@ import argparse
 from os.path import join, basename
 from os import environ
 from lstmcpipe.utils import rerun_cmd
+from lstmcpipe.io.staging import add_staging_arguments, staging_from_args, prefetcher_from_args
 
 
 def main():
@@ -33,6 +34,7 @@ def main():
         help="ctapipe-stage1 configuration file argument.",
         required=True,
     )
+    add_staging_arguments(parser)
     args = parser.parse_args()
 
     task_id = int(environ.get("SLURM_ARRAY_TASK_ID", -1))
@@ -44,15 +46,22 @@ def main():
     print("Processing files in: ", file_for_this_job)
 
     with open(file_for_this_job, "r") as filelist:
-        for file in filelist:
-            file = file.strip("\n")
+        files = [file.strip("\n") for file in filelist if file.strip("\n")]
+
+    with staging_from_args(args.output_dir, args) as staging, prefetcher_from_args(
+        files, staging, args
+    ) as prefetcher:
+        for _, local_file in prefetcher:
+            file = local_file.as_posix()
 
             # ctapipe takes the output filename
             # so we need to construct it first
-            output = join(args.output_dir, basename(file.replace(".simtel.gz", ".dl1.h5")))
+            output = join(staging.local_output_dir, basename(file.replace(".simtel.gz", ".dl1.h5")))
 
             cmd = ["ctapipe-stage1", f"--input={file}", f"--output={output}"]
             if args.config_file:
                 cmd.append("--config={}".format(args.config_file))
 
             rerun_cmd(cmd, output, max_ntry=2)
+            staging.finish(output)
+            prefetcher.release(local_file)
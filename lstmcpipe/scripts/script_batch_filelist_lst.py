@@ -1,9 +1,89 @@
 #!/usr/bin/env python
 
 import argparse
+import threading
 from os import environ
 from pathlib import Path
-from lstmcpipe.utils import rerun_cmd
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from lstmcpipe.utils import rerun_cmd, rerun_func
+from lstmcpipe.io.staging import (
+    add_staging_arguments,
+    staging_from_args,
+    prefetcher_from_args,
+    NoStaging,
+    Prefetcher,
+)
+
+# set in each worker of the process pool by `_init_worker`
+_worker_r0_to_dl1 = None
+_worker_config = None
+
+
+def _init_worker(config_file):
+    """
+    Import lstchain and read the config once per worker process,
+    so that the import and numba compilation costs are paid once per worker and not once per file.
+    """
+    global _worker_r0_to_dl1, _worker_config
+    from lstchain.reco import r0_to_dl1
+    from lstchain.io.config import read_configuration_file
+
+    r0_to_dl1.allowed_tels = {1, 2, 3, 4}
+    _worker_r0_to_dl1 = r0_to_dl1
+    _worker_config = {} if config_file is None else read_configuration_file(Path(config_file).absolute())
+
+
+def _process_file(file, outfile):
+    return rerun_func(
+        _worker_r0_to_dl1.r0_to_dl1,
+        outfile,
+        file,
+        output_filename=outfile,
+        custom_config=_worker_config,
+        max_ntry=2,
+    )
+
+
+def output_filename(file, output_dir):
+    return Path(output_dir).joinpath('dl1_' + Path(file).name.replace('.simtel.gz', '.h5'))
+
+
+def process_files_in_pool(files, output_dir, config_file, n_workers, staging=None, prefetcher=None):
+    """
+    Process files with lstchain r0_to_dl1 in a pool of `n_workers` processes.
+    All files are processed even if some fail; a RuntimeError listing the failures is raised at the end.
+    With a `lstmcpipe.io.staging.ScratchStaging`, the files are processed on the local scratch, and a
+    `lstmcpipe.io.staging.Prefetcher` feeds the pool with the next files as the previous ones are processed.
+    """
+    staging = NoStaging(output_dir) if staging is None else staging
+    prefetcher = Prefetcher(files, staging, depth=0, n_processing=n_workers) if prefetcher is None else prefetcher
+    Path(staging.local_output_dir).mkdir(exist_ok=True, parents=True)
+    failures = {}
+    lock = threading.Lock()
+
+    def done(file, local_file, outfile, future):
+        # run by the pool when a file is processed, so that the prefetcher can go on meanwhile
+        with lock:
+            try:
+                future.result()
+                staging.finish(outfile)
+            except Exception as e:
+                failures[file] = e
+        prefetcher.release(local_file)
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(config_file,)) as pool:
+        with prefetcher:
+            for file, local_file in prefetcher:
+                outfile = output_filename(local_file, staging.local_output_dir)
+                future = pool.submit(_process_file, local_file, outfile.as_posix())
+                future.add_done_callback(partial(done, file, local_file, outfile))
+
+    if failures:
+        raise RuntimeError(
+            f"{len(failures)}/{len(files)} files failed:\n" + "\n".join(f"{f}: {e}" for f, e in failures.items())
+        )
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -34,6 +114,16 @@ def main():
         help="lstchain_mc_r0_to_dl1 configuration file argument.",
         required=True,
     )
+    parser.add_argument(
+        "--n-workers",
+        "-n",
+        type=int,
+        dest="n_workers",
+        help="Number of worker processes. If set, the files are processed in a process pool "
+        "calling lstchain directly instead of one lstchain_mc_r0_to_dl1 subprocess per file.",
+        default=None,
+    )
+    add_staging_arguments(parser)
     args = parser.parse_args()
 
     task_id = int(environ.get("SLURM_ARRAY_TASK_ID", -1))
@@ -44,21 +134,32 @@ def main():
         file_for_this_job = args.file_list[task_id]
     print("Processing files in: ", file_for_this_job)
 
-    # lstchain takes the output dir and constructs filenanmes itself
     with open(file_for_this_job, "r") as filelist:
-        for file in filelist:
-            file = Path(file.strip("\n"))
-
-            cmd = [
-                "lstchain_mc_r0_to_dl1",
-                f"--input-file={file}",
-                f"--output-dir={args.output_dir}",
-            ]
-            if args.config_file:
-                cmd.append("--config={}".format(args.config_file))
-
-            outfile = args.output_dir.joinpath('dl1_' + file.name.replace('.simtel.gz', '.h5')).as_posix()
-            rerun_cmd(cmd, outfile, max_ntry=2)
+        files = [Path(file.strip("\n")) for file in filelist if file.strip("\n")]
+
+    with staging_from_args(args.output_dir, args) as staging:
+        if args.n_workers:
+            prefetcher = prefetcher_from_args(files, staging, args, n_processing=args.n_workers)
+            process_files_in_pool(
+                files, args.output_dir, args.config_file, args.n_workers, staging=staging, prefetcher=prefetcher
+            )
+            return
+
+        # lstchain takes the output dir and constructs filenanmes itself
+        with prefetcher_from_args(files, staging, args) as prefetcher:
+            for file, local_file in prefetcher:
+                cmd = [
+                    "lstchain_mc_r0_to_dl1",
+                    f"--input-file={local_file}",
+                    f"--output-dir={staging.local_output_dir}",
+                ]
+                if args.config_file:
+                    cmd.append("--config={}".format(args.config_file))
+
+                outfile = output_filename(local_file, staging.local_output_dir)
+                rerun_cmd(cmd, outfile.as_posix(), max_ntry=2)
+                staging.finish(outfile)
+                prefetcher.release(local_file)
 
 
 if __name__ == "__main__":
@@ -5,6 +5,7 @@ from os import environ
 from os.path import basename
 from pathlib import Path
 from lstmcpipe.utils import rerun_cmd
+from lstmcpipe.io.staging import add_staging_arguments, staging_from_args, prefetcher_from_args
 
 
 def main():
@@ -36,6 +37,7 @@ def main():
         help="lstchain_mc_r0_to_dl1 configuration file argument.",
         required=True,
     )
+    add_staging_arguments(parser)
     args = parser.parse_args()
 
     task_id = int(environ.get("SLURM_ARRAY_TASK_ID", -1))
@@ -46,11 +48,15 @@ def main():
         file_for_this_job = args.file_list[task_id]
     print("Processing files in: ", file_for_this_job)
 
-    # lstchain takes the output dir and constructs filenanmes itself
     with open(file_for_this_job, "r") as filelist:
-        for file in filelist:
-            file = file.strip("\n")
-            output = args.output_dir.joinpath(basename(file))
+        files = [file.strip("\n") for file in filelist if file.strip("\n")]
+
+    # lstchain takes the output dir and constructs filenanmes itself
+    with staging_from_args(args.output_dir, args) as staging, prefetcher_from_args(
+        files, staging, args
+    ) as prefetcher:
+        for _, file in prefetcher:
+            output = staging.local_output_dir.joinpath(basename(file))
             cmd = [
                 "lstchain_dl1ab",
                 "--no-image",
@@ -61,6 +67,8 @@ def main():
                 cmd.append("--config={}".format(args.config_file))
 
             rerun_cmd(cmd, output, max_ntry=2)
+            staging.finish(output)
+            prefetcher.release(file)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,120 @@
 #!/usr/bin/env python
 
 import argparse
+import threading
 import subprocess
 from os import environ
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from lstmcpipe.hiperta.hiperta_r0_to_dl1lstchain import (
+    run_hiperta,
+    reorganize,
+    reorganized_filename,
+    hiperta_output_filename,
+)
+from lstmcpipe.io.staging import add_staging_arguments, staging_from_args, prefetcher_from_args, NoStaging, Prefetcher
+
+
+def process_files_pipelined(
+    files,
+    output_dir,
+    config_file,
+    n_hiperta,
+    n_reorganizers,
+    keep_file=False,
+    debug_mode=False,
+    staging=None,
+    prefetcher=None,
+    reorganize_func=reorganize,
+):
+    """
+    Run hiperta_r0_dl1 and the reorganization of its outputs in two bounded pools, so that the native hiperta runs
+    of the next files overlap with the python reorganization of the previous ones.
+    hiperta_r0_dl1 runs in `n_hiperta` threads and the reorganizations in `n_reorganizers` processes; a hiperta
+    thread waits for a free reorganizer before taking the next file, so that at most `n_reorganizers` hiperta
+    outputs wait for their reorganization.
+    All files are processed even if some fail; a RuntimeError listing the failures is raised at the end.
+    The partial outputs of the failed files are removed.
+
+    Parameters
+    ----------
+    files: list of str or Path
+    output_dir: str or Path
+    config_file: str
+        hiperta_r0_dl1 configuration file
+    n_hiperta: int
+        number of hiperta_r0_dl1 run at the same time
+    n_reorganizers: int
+        number of reorganization processes
+    keep_file: bool
+        keep the hiperta dl1 files
+    debug_mode: bool
+        hiperta_r0_dl1 debug mode
+    staging: `lstmcpipe.io.staging.ScratchStaging` or `lstmcpipe.io.staging.NoStaging`
+    prefetcher: `lstmcpipe.io.staging.Prefetcher`
+    reorganize_func: callable
+        `reorganize_func(hiperta_file, reorganized_file, keep_file=keep_file)` run in the reorganization processes
+    """
+    staging = NoStaging(output_dir) if staging is None else staging
+    prefetcher = Prefetcher(files, staging, depth=0, n_processing=n_hiperta) if prefetcher is None else prefetcher
+    local_output_dir = Path(staging.local_output_dir)
+    local_output_dir.mkdir(exist_ok=True, parents=True)
+    failures = {}
+    lock = threading.Lock()
+    reorganizer_slots = threading.BoundedSemaphore(n_reorganizers)
+
+    def remove_outputs(local_file):
+        # remove the partial outputs of a failed file, so that they are neither collected nor kept
+        for output in (
+            hiperta_output_filename(local_file, local_output_dir),
+            reorganized_filename(local_file, local_output_dir),
+        ):
+            Path(output).unlink(missing_ok=True)
+
+    def reorganized(file, local_file, hiperta_file, future):
+        # run in the reorganization pool management thread once a file is reorganized
+        with lock:
+            try:
+                staging.finish(Path(future.result()))
+                if keep_file:
+                    staging.finish(Path(hiperta_file))
+            except Exception as e:
+                failures[file] = e
+                remove_outputs(local_file)
+        reorganizer_slots.release()
+
+    def run(file, local_file):
+        # run in the hiperta threads
+        try:
+            hiperta_file = run_hiperta(local_file, local_output_dir, config_file, debug_mode=debug_mode)
+        except Exception:
+            remove_outputs(local_file)
+            raise
+        finally:
+            prefetcher.release(local_file)
+        reorganizer_slots.acquire()
+        future = reorganizers.submit(
+            reorganize_func, hiperta_file, reorganized_filename(local_file, local_output_dir), keep_file=keep_file
+        )
+        future.add_done_callback(partial(reorganized, file, local_file, hiperta_file))
+
+    def hiperta_done(file, future):
+        if future.exception() is not None:
+            with lock:
+                failures[file] = future.exception()
+
+    # the hiperta threads are shut down first, so that they can still submit to the reorganizers
+    with ProcessPoolExecutor(max_workers=n_reorganizers) as reorganizers:
+        with ThreadPoolExecutor(max_workers=n_hiperta) as hiperta, prefetcher:
+            for file, local_file in prefetcher:
+                hiperta.submit(run, file, local_file).add_done_callback(partial(hiperta_done, file))
+
+    if failures:
+        raise RuntimeError(
+            f"{len(failures)}/{len(files)} files failed:\n" + "\n".join(f"{f}: {e}" for f, e in failures.items())
+        )
 
 
 def main():
@@ -48,6 +160,22 @@ def main():
         dest="debug_mode",
         help="Activate debug mode (add cleaned mask in the output hdf5). Set by default to False",
     )
+    parser.add_argument(
+        "--n-hiperta",
+        type=int,
+        dest="n_hiperta",
+        help="Number of hiperta_r0_dl1 run at the same time. If set, hiperta_r0_dl1 and the reorganization of its "
+        "outputs run in two pools (see --n-reorganizers) instead of one lstmcpipe_hiperta_r0_to_dl1lstchain per file.",
+        default=None,
+    )
+    parser.add_argument(
+        "--n-reorganizers",
+        type=int,
+        dest="n_reorganizers",
+        help="Number of reorganization processes, with --n-hiperta. 1 by default.",
+        default=1,
+    )
+    add_staging_arguments(parser)
     args = parser.parse_args()
 
     task_id = int(environ.get("SLURM_ARRAY_TASK_ID", -1))
@@ -59,22 +187,54 @@ def main():
     print("Processing files in: ", file_for_this_job)
 
     with open(file_for_this_job, "r") as filelist:
-        for file in filelist:
-            file = file.strip("\n")
-
-            cmd = [
-                "lstmcpipe_hiperta_r0_to_dl1lstchain",
-                f"--infile={file}",
-                f"--outdir={args.output_dir}",
-                f"--config={args.config_file}",
-            ]
-
-            if args.keep_file:
-                cmd.append("--keep_file")
-            if args.debug_mode:
-                cmd.append("--debug_mode")
-
-            subprocess.run(cmd)
+        files = [file.strip("\n") for file in filelist if file.strip("\n")]
+
+    with staging_from_args(args.output_dir, args) as staging:
+        if args.n_hiperta:
+            prefetcher = prefetcher_from_args(files, staging, args, n_processing=args.n_hiperta)
+            process_files_pipelined(
+                files,
+                args.output_dir,
+                args.config_file,
+                args.n_hiperta,
+                args.n_reorganizers,
+                keep_file=args.keep_file,
+                debug_mode=args.debug_mode,
+                staging=staging,
+                prefetcher=prefetcher,
+            )
+            return
+
+        failures = []
+        with prefetcher_from_args(files, staging, args) as prefetcher:
+            for file, local_file in prefetcher:
+                cmd = [
+                    "lstmcpipe_hiperta_r0_to_dl1lstchain",
+                    f"--infile={local_file}",
+                    f"--outdir={staging.local_output_dir}",
+                    f"--config={args.config_file}",
+                ]
+
+                if args.keep_file:
+                    cmd.append("--keep_file")
+                if args.debug_mode:
+                    cmd.append("--debug_mode")
+
+                if subprocess.run(cmd).returncode == 0:
+                    # the output names are set by hiperta, all the files written so far are complete
+                    staging.collect()
+                else:
+                    failures.append(file)
+                    # remove the partial outputs, so that they are neither collected with the next file nor kept
+                    for output in (
+                        hiperta_output_filename(local_file, staging.local_output_dir),
+                        reorganized_filename(local_file, staging.local_output_dir),
+                    ):
+                        Path(output).unlink(missing_ok=True)
+                prefetcher.release(local_file)
+
+    if failures:
+        raise RuntimeError(f"{len(failures)}/{len(files)} files failed:\n" + "\n".join(failures))
 
 
 if __name__ == "__main__":
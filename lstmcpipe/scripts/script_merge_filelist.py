@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import argparse
+from pathlib import Path, PurePath
+
+from lstchain.io import auto_merge_h5files, get_dataset_keys
+from lstchain.io.io import dl1_mon_tel_catB_cal_key, dl1_mon_tel_catB_ped_key, dl1_mon_tel_catB_flat_key
+
+# as in lstchain_merge_hdf5_files
+default_keys_to_copy = [dl1_mon_tel_catB_cal_key, dl1_mon_tel_catB_ped_key, dl1_mon_tel_catB_flat_key]
+
+
+def read_filelist(filelist):
+    """
+    Read a list of files written by `lstmcpipe_train_test_split` (one file per line)
+
+    Parameters
+    ----------
+    filelist: Path
+
+    Returns
+    -------
+    list of str
+    """
+    with open(filelist) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def select_files(file_list, pattern="*.h5", run_number=None):
+    """
+    Files of a filelist matching the `--pattern` and `--run-number` options of `lstchain_merge_hdf5_files`.
+    The glob pattern is matched from the end of the paths, e.g. `*/*.h5` matches the .h5 files in any directory.
+
+    Parameters
+    ----------
+    file_list: list of str
+    pattern: str
+    run_number: int or None
+
+    Returns
+    -------
+    list of str
+    """
+    files = [file for file in file_list if PurePath(file).match(pattern)]
+    if run_number:
+        files = [file for file in files if f"Run{run_number:05d}" in file]
+    return sorted(files)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge the HDF5 files of a filelist, e.g. written by a virtual train/test split."
+    )
+    parser.add_argument("--file-list", "-f", type=Path, dest="file_list", required=True, help="List of files to merge")
+    parser.add_argument("--output-file", "-o", type=Path, dest="output_file", required=True, help="Merged file")
+    # same options as lstchain_merge_hdf5_files
+    parser.add_argument("--no-image", action="store_true", dest="no_image", help="Do not merge the images")
+    parser.add_argument(
+        "--run-number", "-r", type=int, dest="run_number", help="Merge only the files of this run", default=None
+    )
+    parser.add_argument(
+        "--pattern", "-p", dest="pattern", default="*.h5", help="Glob pattern the files of the list must match"
+    )
+    parser.add_argument(
+        "--no-progress", action="store_true", dest="no_progress", help="Do not display the progress bar"
+    )
+    parser.add_argument("--skip-checks", action="store_true", dest="skip_checks", help="Skip checks when merging files")
+    parser.add_argument(
+        "--keys-to-copy",
+        nargs="*",
+        dest="keys_to_copy",
+        default=[],
+        help="List of duplicated keys to be copied and not to be merged",
+    )
+    args = parser.parse_args()
+
+    file_list = select_files(read_filelist(args.file_list), args.pattern, args.run_number)
+    if not file_list:
+        raise ValueError(f"No file to merge in {args.file_list}")
+
+    nodes_keys = None
+    if args.no_image:
+        nodes_keys = [k for k in get_dataset_keys(file_list[0]) if "image" not in k]
+
+    args.output_file.parent.mkdir(exist_ok=True, parents=True)
+    auto_merge_h5files(
+        file_list,
+        args.output_file.as_posix(),
+        nodes_keys=nodes_keys,
+        keys_to_copy=default_keys_to_copy + args.keys_to_copy,
+        progress_bar=not args.no_progress,
+        run_checks=not args.skip_checks,
+    )
+
+
+if __name__ == "__main__":
+    main()
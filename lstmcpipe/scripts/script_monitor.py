@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import sys
+import json
+import asyncio
+import argparse
+from pathlib import Path
+
+from lstmcpipe import prod_logs
+from lstmcpipe.monitor import monitor
+from lstmcpipe.io.production_db import ProductionDB, production_db_path
+
+
+def build_argparser():
+    parser = argparse.ArgumentParser(
+        description="Report the progress of a production: tasks per stage and state, throughput, projected "
+        "completion time and critical path. The job states are polled with sacct."
+    )
+    parser.add_argument(
+        "prod_id",
+        nargs="?",
+        default=None,
+        help="Production id, to find its database in the lstmcpipe logs directory",
+    )
+    parser.add_argument("--db", type=Path, default=None, help="Production database (instead of the production id)")
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=120,
+        help="Minimum time in seconds between two polls of the jobs. Default: 120",
+    )
+    parser.add_argument("--once", action="store_true", help="Report once instead of until all the jobs are finished")
+    parser.add_argument(
+        "--max-concurrent",
+        type=int,
+        default=2,
+        help="Maximum number of sacct calls running at the same time. Default: 2",
+    )
+    parser.add_argument("--chunk-size", type=int, default=200, help="Number of job ids per sacct call. Default: 200")
+    parser.add_argument("--json", action="store_true", help="Print the reports as json, one per line")
+    return parser
+
+
+def main():
+    parser = build_argparser()
+    args = parser.parse_args()
+    if args.db is None:
+        if args.prod_id is None:
+            parser.error("a production id or --db is required")
+        args.db = production_db_path(prod_logs.joinpath(f"logs_{args.prod_id}"), args.prod_id)
+    if not args.db.exists():
+        parser.error(f"No production database {args.db}")
+
+    with ProductionDB(args.db) as db:
+        report = asyncio.run(
+            monitor(
+                db,
+                interval=args.interval,
+                once=args.once,
+                max_concurrent=args.max_concurrent,
+                chunk_size=args.chunk_size,
+                callback=lambda text: print(text, flush=True),
+                formatter=json.dumps if args.json else None,
+            )
+        )
+    sys.exit(1 if report["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
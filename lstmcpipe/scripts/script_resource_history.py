@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import argparse
+from pathlib import Path
+
+from lstmcpipe import prod_logs
+from lstmcpipe.logging import setup_logging
+from lstmcpipe.io.production_db import ProductionDB, production_db_path
+from lstmcpipe.io.resource_history import ResourceHistory, record_production
+
+
+def build_argparser():
+    parser = argparse.ArgumentParser(
+        description="Resources used by the jobs of previous productions, used to size the slurm jobs of the next ones "
+        "(`resource_history` entry of the lstmcpipe config)."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record = subparsers.add_parser("record", help="Record the usage of the completed jobs of a production")
+    record.add_argument("prod_id", help="Production id")
+    record.add_argument("history", type=Path, help="Resource history file")
+    record.add_argument("--db", type=Path, default=None, help="Production database. Default: in the production logs")
+
+    show = subparsers.add_parser("show", help="Show the resources predicted per stage")
+    show.add_argument("history", type=Path, help="Resource history file")
+    show.add_argument("--margin", type=float, default=1.5, help="Safety margin. Default: 1.5")
+    return parser
+
+
+def main():
+    args = build_argparser().parse_args()
+    setup_logging()
+    with ResourceHistory(args.history) as history:
+        if args.command == "record":
+            db_path = args.db or production_db_path(prod_logs.joinpath(f"logs_{args.prod_id}"), args.prod_id)
+            with ProductionDB(db_path) as db:
+                record_production(history, db, args.prod_id)
+        else:
+            for stage in history.stages():
+                n_records = len(history.records(stage))
+                print(f"{stage}: {n_records} jobs, {history.predict(stage, margin=args.margin)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+import sys
+import argparse
+import subprocess
+from os import environ
+from pathlib import Path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs the command of a manifest file (one command per line) corresponding to the slurm array task."
+    )
+    parser.add_argument("manifest", type=Path, help="Manifest file written by lstmcpipe")
+    parser.add_argument(
+        "--task-id",
+        type=int,
+        dest="task_id",
+        help="Line of the manifest to run. Default: SLURM_ARRAY_TASK_ID",
+        default=None,
+    )
+    args = parser.parse_args()
+
+    task_id = args.task_id if args.task_id is not None else int(environ.get("SLURM_ARRAY_TASK_ID", 0))
+    with open(args.manifest) as manifest:
+        commands = [line.rstrip("\n") for line in manifest if line.strip()]
+
+    cmd = commands[task_id]
+    print(f"Running task {task_id}: {cmd}", flush=True)
+    # each line is a job of its own: it must not see the array (e.g. the stage cache waits for all the array tasks)
+    env = dict(environ, SLURM_ARRAY_TASK_ID="0", SLURM_ARRAY_TASK_COUNT="1")
+    sys.exit(subprocess.run(cmd, shell=True, env=env).returncode)
+
+
+if __name__ == "__main__":
+    main()
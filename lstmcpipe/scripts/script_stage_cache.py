@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import json
+import argparse
+from os import environ
+from pathlib import Path
+
+from lstmcpipe.io.stage_cache import StageCache
+
+
+def restore(spec_file):
+    """
+    Compute the key of the stage described in `spec_file` and restore its outputs from the cache.
+    The spec is only read, as it is shared by all the tasks of the job.
+
+    Returns
+    -------
+    int: 0 if the outputs were restored (the command must not be run), 1 otherwise
+    """
+    spec = load_spec(spec_file)
+    cache = cache_of_spec(spec_file)
+    key = cache.compute_key(spec)
+    if cache.restore(key, spec["outputs"]):
+        print(f"Outputs restored from cache entry {key}")
+        return 0
+    return 1
+
+
+def commit(spec_file):
+    """
+    Store the outputs of the stage described in `spec_file` in the cache once all the array tasks are done.
+    The key is computed now if it was not known at submission: the inputs have not changed since the job started.
+    """
+    spec = load_spec(spec_file)
+    cache = cache_of_spec(spec_file)
+    cache.commit(
+        spec,
+        spec.get("key") or cache.compute_key(spec),
+        task_id=int(environ.get("SLURM_ARRAY_TASK_ID", 0)),
+        # one spec file is written per submission
+        submission=Path(spec_file).stem,
+    )
+    return 0
+
+
+def load_spec(spec_file):
+    with open(spec_file) as f:
+        return json.load(f)
+
+
+def cache_of_spec(spec_file):
+    # specs are written in <cache_dir>/specs/
+    return StageCache(Path(spec_file).resolve().parent.parent)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Restore stage outputs from the lstmcpipe stage cache or fill it.")
+    parser.add_argument(
+        "action",
+        choices=["restore", "commit"],
+        help="restore: link the cached outputs (exit code 1 if not in cache). "
+        "commit: store the outputs once the job is done.",
+    )
+    parser.add_argument("spec_file", type=Path, help="Stage spec written by lstmcpipe in the cache directory")
+    args = parser.parse_args()
+
+    if args.action == "restore":
+        exit(restore(args.spec_file))
+    else:
+        exit(commit(args.spec_file))
+
+
+if __name__ == "__main__":
+    main()
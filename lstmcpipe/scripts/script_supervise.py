@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import asyncio
+import argparse
+from pathlib import Path
+
+from lstmcpipe import prod_logs
+from lstmcpipe.logging import setup_logging
+from lstmcpipe.supervisor import supervise, ResourceLimits
+from lstmcpipe.io.production_db import ProductionDB, production_db_path
+
+
+def build_argparser():
+    parser = argparse.ArgumentParser(
+        description="Supervise a production: the jobs and array tasks killed by slurm for lack of memory or time, or "
+        "because of their node, are resubmitted with more resources and the jobs waiting for them are made to wait "
+        "for the resubmitted ones."
+    )
+    parser.add_argument("prod_id", help="Production id")
+    parser.add_argument("--db", type=Path, default=None, help="Production database. Default: in the production logs")
+    parser.add_argument("--interval", type=float, default=300, help="Time in seconds between two polls. Default: 300")
+    parser.add_argument("--once", action="store_true", help="Check the jobs once instead of until they are finished")
+    parser.add_argument("--mem-factor", type=float, default=2, help="Memory factor after OUT_OF_MEMORY. Default: 2")
+    parser.add_argument("--time-factor", type=float, default=2, help="Time limit factor after TIMEOUT. Default: 2")
+    parser.add_argument("--max-mem", default="256G", help="Maximum memory of a resubmitted job. Default: 256G")
+    parser.add_argument(
+        "--max-time",
+        default="7-00:00:00",
+        help="Maximum time limit of a resubmitted job, also capped by the maximum time of its partition. "
+        "Default: 7-00:00:00",
+    )
+    parser.add_argument("--max-attempts", type=int, default=2, help="Maximum resubmissions of a task. Default: 2")
+    parser.add_argument(
+        "--default-mem",
+        default="4G",
+        help="Memory of the jobs submitted without --mem (cluster default). Default: 4G",
+    )
+    parser.add_argument(
+        "--default-time",
+        default="1-00:00:00",
+        help="Time limit of the jobs submitted without --time (partition default). Default: 1-00:00:00",
+    )
+    return parser
+
+
+def main():
+    args = build_argparser().parse_args()
+    setup_logging()
+    log_dir = prod_logs.joinpath(f"logs_{args.prod_id}")
+    db_path = args.db or production_db_path(log_dir, args.prod_id)
+    scancel_file = log_dir.joinpath(f"scancel_{args.prod_id}.sh")
+    limits = ResourceLimits(
+        mem_factor=args.mem_factor,
+        time_factor=args.time_factor,
+        max_mem=args.max_mem,
+        max_time=args.max_time,
+        max_attempts=args.max_attempts,
+        default_mem=args.default_mem,
+        default_time=args.default_time,
+    )
+    with ProductionDB(db_path) as db:
+        replacements = asyncio.run(
+            supervise(
+                db,
+                interval=args.interval,
+                once=args.once,
+                limits=limits,
+                scancel_file=scancel_file if scancel_file.exists() else None,
+            )
+        )
+    for old, new in replacements.items():
+        print(f"{old} resubmitted as {new}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 
+import os
+import re
+import uuid
 import shutil
+import hashlib
 import argparse
 from pathlib import Path
-from sklearn.model_selection import train_test_split
+from concurrent.futures import ThreadPoolExecutor
 
 parser = argparse.ArgumentParser(
     description="Script to move a directory and its content after creating the destination" " directory."
@@ -33,12 +37,20 @@ parser.add_argument(
     help="Output directory for train dataset",
 )
 
-parser.add_argument("--ratio", "-r", type=float, dest="ratio", help="Train-test splitting ratio", default=0.5)
+parser.add_argument(
+    "--ratio", "-r", type=float, dest="ratio", help="Train-test splitting ratio (fraction of test runs)", default=0.5
+)
 
 parser.add_argument(
     "--log_dir", "-l", type=Path, dest="log_dir", help="Directory to store training and testing filelists"
 )
 
+parser.add_argument(
+    "--virtual",
+    action="store_true",
+    help="Only write the training and testing filelists, without moving the files",
+)
+
 
 def write_filelist(filelist, outdir, dataset=""):
     """
@@ -53,15 +65,19 @@ def write_filelist(filelist, outdir, dataset=""):
     dataset : str
         'training' or 'testing' dataset list
     """
-    with open(outdir.joinpath(f"{dataset}.list"), "w+") as newfile:
+    # written atomically as several jobs can write the same lists in case of a virtual split
+    tmp_file = outdir.joinpath(f".{dataset}.list.{uuid.uuid4().hex}")
+    with open(tmp_file, "w+") as newfile:
         for file in filelist:
             newfile.write(file)
             newfile.write("\n")
+    os.replace(tmp_file, outdir.joinpath(f"{dataset}.list"))
 
 
-def move_files(filelist, outdir):
+def move_files(filelist, outdir, n_threads=16):
     """
-    Move all files within filelist to outdir
+    Move all files within filelist to outdir.
+    Renames are run in a thread pool as they are latency-bound on shared filesystems.
 
     Parameters
     ----------
@@ -69,24 +85,97 @@ def move_files(filelist, outdir):
         list of files to be written
     outdir : Path
         Output directory Path
+    n_threads : int
     """
-    for file in filelist:
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        # consume the results to raise errors
+        list(pool.map(lambda file: move_file(file, outdir), filelist))
+
+
+def move_file(file, outdir):
+    try:
+        os.rename(file, Path(outdir, Path(file).name))
+    except OSError:
+        # e.g. input and output directories on different filesystems
         shutil.move(file, outdir)
 
 
+RUN_NUMBER_PATTERN = re.compile(r"[Rr]un_?(\d+)")
+
+
+def split_key(filename):
+    """
+    Key of a file in the splitting: its run number, or its name if it does not contain a run number
+    """
+    match = RUN_NUMBER_PATTERN.search(filename)
+    return str(int(match.group(1))) if match else filename
+
+
+def is_test_file(filename, ratio):
+    """
+    Deterministic assignment of a file to the testing dataset, from a hash of its run number
+    (or of its name if it does not contain a run number).
+    All the files of a run go to the same dataset and the assignment does not depend on the other files.
+
+    Parameters
+    ----------
+    filename : str
+    ratio : float
+        Fraction of runs going to the testing dataset
+
+    Returns
+    -------
+    bool
+    """
+    digest = hashlib.sha256(split_key(filename).encode()).digest()
+    return int.from_bytes(digest[:8], "big") / 2**64 < ratio
+
+
+def split_files(input_dir, ratio):
+    """
+    Split the .h5 files of a directory into training and testing datasets.
+
+    Parameters
+    ----------
+    input_dir : Path
+    ratio : float
+        Fraction of runs going to the testing dataset
+
+    Returns
+    -------
+    train, test : list of str
+
+    Raises
+    ------
+    ValueError
+        If 0 < ratio < 1 and one of the datasets is empty (e.g. a small production whose runs all hash to the same
+        dataset). The assignment of a run only depends on its run number, runs are never moved to the other dataset.
+    """
+    train, test = [], []
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".h5") and entry.is_file():
+                (test if is_test_file(entry.name, ratio) else train).append(entry.path)
+    if 0 < ratio < 1 and bool(train) != bool(test):
+        full, empty = ("testing", "training") if test else ("training", "testing")
+        n_runs = len({split_key(os.path.basename(path)) for path in train + test})
+        raise ValueError(
+            f"The {len(train) + len(test)} .h5 files ({n_runs} runs) of {input_dir} all go to the {full} dataset with "
+            f"a test ratio of {ratio}: the {empty} dataset would be empty. Add runs or change the ratio."
+        )
+    return sorted(train), sorted(test)
+
+
 def main():
     args = parser.parse_args()
 
-    file_list = [
-        file.resolve().as_posix()
-        for file in Path(args.input_dir).iterdir()
-        if file.is_file() and file.name.endswith(".h5")
-    ]
-
-    train, test = train_test_split(file_list, random_state=42, test_size=float(args.ratio), shuffle=True)
+    train, test = split_files(Path(args.input_dir).resolve(), float(args.ratio))
 
+    args.log_dir.mkdir(exist_ok=True, parents=True)
     write_filelist(train, args.log_dir, dataset="training")
     write_filelist(test, args.log_dir, dataset="testing")
+    if args.virtual:
+        return
     move_files(train, args.outdir_train)
     move_files(test, args.outdir_test)
 
@@ -0,0 +1,137 @@
+import os
+import sys
+import stat
+import time
+
+import pytest
+
+from lstmcpipe.scripts.script_batch_filelist_rta import process_files_pipelined, main
+
+
+def fake_reorganize(hiperta_file, reorganized_file, keep_file=False):
+    start = time.time()
+    time.sleep(0.3)
+    with open(hiperta_file) as f, open(reorganized_file, "w") as out:
+        out.write(f"{f.read()} {start} {time.time()}")
+    if not keep_file:
+        os.remove(hiperta_file)
+    return reorganized_file
+
+
+def failing_reorganize(hiperta_file, reorganized_file, keep_file=False):
+    with open(reorganized_file, "w") as out:
+        out.write("partial")
+    if "broken" in reorganized_file:
+        raise OSError(f"cannot reorganize {hiperta_file}")
+    return fake_reorganize(hiperta_file, reorganized_file, keep_file=keep_file)
+
+
+@pytest.fixture
+def fake_hiperta(tmp_path, monkeypatch):
+    """hiperta_r0_dl1 writing its start and end times in its output, and failing on `bad` files after writing a part
+    of their output"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    fake = bin_dir / "hiperta_r0_dl1"
+    fake.write_text(
+        f"#!{sys.executable}\n"
+        "import os, sys, time\n"
+        "infile, outdir = sys.argv[sys.argv.index('-i') + 1], sys.argv[sys.argv.index('-o') + 1]\n"
+        "start = time.time()\n"
+        "time.sleep(0.3)\n"
+        "output = open(os.path.join(outdir, 'dl1_' + os.path.basename(infile)), 'w')\n"
+        "if 'bad' in infile:\n"
+        "    output.write('partial')\n"
+        "    sys.exit(3)\n"
+        "output.write(f'{start} {time.time()}')\n"
+    )
+    fake.chmod(fake.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    return fake
+
+
+def test_process_files_pipelined(tmp_path, fake_hiperta):
+    r0 = tmp_path / "r0"
+    r0.mkdir()
+    files = [r0 / f"run{i}.simtel.gz" for i in range(4)]
+    for file in files:
+        file.write_text("r0")
+
+    process_files_pipelined(files, tmp_path / "dl1", "config.txt", 1, 1, reorganize_func=fake_reorganize)
+
+    outputs = sorted((tmp_path / "dl1").iterdir())
+    assert [path.name for path in outputs] == [f"dl1v06_reorganized_run{i}.simtel.gz" for i in range(4)]
+    times = [[float(t) for t in path.read_text().split()] for path in outputs]
+    # the reorganization of a file overlaps with hiperta on the next one
+    for (_, _, reorganize_start, reorganize_end), (hiperta_start, hiperta_end, _, _) in zip(times, times[1:]):
+        assert reorganize_start < hiperta_end and hiperta_start < reorganize_end
+
+
+def test_process_files_pipelined_failure(tmp_path, fake_hiperta):
+    files = [tmp_path / "good.simtel.gz", tmp_path / "bad.simtel.gz"]
+    for file in files:
+        file.write_text("r0")
+    with pytest.raises(RuntimeError, match="1/2 files failed") as error:
+        process_files_pipelined(
+            files, tmp_path / "dl1", "config.txt", 2, 1, keep_file=True, reorganize_func=fake_reorganize
+        )
+    assert "bad.simtel.gz" in str(error.value)
+    assert "exit status 3" in str(error.value)
+    # the other file is processed, and its hiperta file kept
+    assert sorted(path.name for path in (tmp_path / "dl1").iterdir()) == [
+        "dl1_good.simtel.gz",
+        "dl1v06_reorganized_good.simtel.gz",
+    ]
+
+
+def test_process_files_pipelined_failure_outputs_removed(tmp_path, fake_hiperta):
+    """the partial outputs of the files failing in hiperta or in the reorganization are not kept"""
+    files = [tmp_path / f"{name}.simtel.gz" for name in ["good", "bad", "broken"]]
+    for file in files:
+        file.write_text("r0")
+    with pytest.raises(RuntimeError, match="2/3 files failed") as error:
+        process_files_pipelined(
+            files, tmp_path / "dl1", "config.txt", 2, 2, keep_file=True, reorganize_func=failing_reorganize
+        )
+    assert "cannot reorganize" in str(error.value)
+    assert sorted(path.name for path in (tmp_path / "dl1").iterdir()) == [
+        "dl1_good.simtel.gz",
+        "dl1v06_reorganized_good.simtel.gz",
+    ]
+
+
+@pytest.mark.parametrize("staging_args", [[], ["--scratch-staging"]])
+def test_serial_failure_outputs_removed(tmp_path, monkeypatch, staging_args):
+    """the partial outputs of a failed file are neither moved to the output directory nor kept"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    fake = bin_dir / "lstmcpipe_hiperta_r0_to_dl1lstchain"
+    fake.write_text(
+        f"#!{sys.executable}\n"
+        "import os, sys\n"
+        "args = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] if '=' in arg)\n"
+        "name = os.path.basename(args['infile'])\n"
+        "open(os.path.join(args['outdir'], 'dl1_' + name), 'w').write('partial')\n"
+        "if 'bad' in name:\n"
+        "    sys.exit(3)\n"
+        "os.rename(os.path.join(args['outdir'], 'dl1_' + name),"
+        " os.path.join(args['outdir'], 'dl1v06_reorganized_' + name))\n"
+    )
+    fake.chmod(fake.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("TMPDIR", str(tmp_path / "scratch"))
+    monkeypatch.delenv("SLURM_ARRAY_TASK_ID", raising=False)
+
+    files = [tmp_path / "bad.simtel.gz", tmp_path / "good.simtel.gz"]
+    for file in files:
+        file.write_text("r0")
+    file_list = tmp_path / "files.txt"
+    file_list.write_text("\n".join(str(file) for file in files))
+    output_dir = tmp_path / "dl1"
+    monkeypatch.setattr(
+        sys, "argv", ["script", "-f", str(file_list), "-o", str(output_dir), "-c", "config.txt"] + staging_args
+    )
+
+    with pytest.raises(RuntimeError, match="1/2 files failed"):
+        main()
+    assert [path.name for path in output_dir.iterdir()] == ["dl1v06_reorganized_good.simtel.gz"]
@@ -0,0 +1,48 @@
+import os
+import subprocess as sp
+
+from lstmcpipe.scripts import fake_slurm
+from lstmcpipe.benchmarks.orchestration import run_benchmark
+
+
+def run(cmd, bin_dir):
+    env = dict(os.environ, PATH=f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    return sp.run(cmd, shell=True, env=env, stdout=sp.PIPE, stderr=sp.PIPE, encoding="utf-8")
+
+
+def test_fake_slurm(tmp_path):
+    bin_dir, state_dir = tmp_path / "bin", tmp_path / "state"
+    fake_slurm.install(bin_dir, state_dir, job_duration=1000)
+
+    array = run('sbatch --parsable --array=0-2%2 -J r0_dl1 --wrap="echo run"', bin_dir).stdout.strip()
+    assert array == "1"
+    job = run(f'sbatch --parsable --dependency=afterok:{array}_1 --wrap="echo merge"', bin_dir).stdout.strip()
+    assert job == "2"
+    failed = run('sbatch --dependency=afterok:12 --wrap="echo merge"', bin_dir)
+    assert failed.returncode == 1 and "Job dependency problem" in failed.stderr
+
+    lines = run("sacct -P -n --format=jobid,jobname,state", bin_dir).stdout.splitlines()
+    assert lines == [
+        "1_0|r0_dl1|RUNNING",
+        "1_1|r0_dl1|RUNNING",
+        "1_2|r0_dl1|PENDING",
+        "2|wrap|PENDING",
+    ]
+    assert len(run("squeue -h -j 2", bin_dir).stdout.splitlines()) == 1
+    assert fake_slurm.load_jobs(state_dir)[1]["dependencies"] == ["1_1"]
+
+
+def test_orchestration_benchmark(tmp_path):
+    results = run_benchmark(tmp_path, n_pointings=1, n_files=2, array_stages=["merge_dl1"])
+    # r0_to_dl1 x3, merge_dl1 arrays x3 (one per dl1 job they wait for), train_pipe, RF plot, dl1_to_dl2, dl2_to_irfs
+    # and the production check
+    assert results["n_jobs"] == 11
+    assert results["n_tasks"] == 11
+
+    all_jobs = fake_slurm.load_jobs(tmp_path / "fake_slurm")
+    merges = {job["jobid"]: job for job in all_jobs if job["name"] == "merge"}
+    assert all(len(job["dependencies"]) == 1 for job in merges.values())
+    jobs = {job["name"]: job for job in all_jobs}
+    # the training only waits for the merging of its own files
+    assert len(jobs["train_pipe"]["dependencies"]) == 2
+    assert all(jobid.split("_")[0] in merges for jobid in jobs["train_pipe"]["dependencies"])
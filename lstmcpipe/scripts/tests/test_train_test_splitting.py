@@ -0,0 +1,82 @@
+import pytest
+
+from lstmcpipe.scripts.script_train_test_splitting import is_test_file, split_files, move_files
+
+
+def test_is_test_file():
+    # all the files of a run are in the same dataset
+    assert is_test_file("dl1_gamma_run12___off0.4.h5", 0.5) == is_test_file("dl1_gamma_run12___off0.4_bis.h5", 0.5)
+    assert is_test_file("dl1_LST-1.Run00101.0000.h5", 0.5) == is_test_file("dl1_LST-1.Run00101.0001.h5", 0.5)
+    assert not is_test_file("dl1_gamma_run12.h5", 0)
+    assert is_test_file("dl1_gamma_run12.h5", 1)
+
+    n_runs = 2000
+    n_test = sum(is_test_file(f"dl1_proton_run{run}.h5", 0.3) for run in range(n_runs))
+    assert abs(n_test / n_runs - 0.3) < 0.05
+
+
+def test_split_files(tmp_path):
+    input_dir = tmp_path / "dl1"
+    input_dir.mkdir()
+    for run in range(50):
+        (input_dir / f"dl1_gamma_run{run}.h5").touch()
+    (input_dir / "split_tt_1234.e").touch()
+
+    train, test = split_files(input_dir, 0.5)
+    assert len(train) + len(test) == 50
+    assert train and test
+
+    # adding files does not change the assignment of the others
+    for run in range(50, 60):
+        (input_dir / f"dl1_gamma_run{run}.h5").touch()
+    train_2, test_2 = split_files(input_dir, 0.5)
+    assert set(train) <= set(train_2) and set(test) <= set(test_2)
+
+    train_dir = tmp_path / "train"
+    train_dir.mkdir()
+    move_files(train, train_dir)
+    assert sorted(f.name for f in train_dir.iterdir()) == sorted(f.split("/")[-1] for f in train)
+
+
+def test_virtual_split(tmp_path, monkeypatch):
+    from lstmcpipe.scripts import script_train_test_splitting
+
+    input_dir = tmp_path / "dl1"
+    input_dir.mkdir()
+    for run in range(10):
+        (input_dir / f"dl1_gamma_run{run}.h5").touch()
+    args = ["-i", input_dir, "--otrain", tmp_path / "train", "--otest", tmp_path / "test", "-l", tmp_path / "lists"]
+    monkeypatch.setattr("sys.argv", ["lstmcpipe_train_test_split"] + [str(a) for a in args] + ["--virtual"])
+    script_train_test_splitting.main()
+
+    train = (tmp_path / "lists" / "training.list").read_text().split()
+    test = (tmp_path / "lists" / "testing.list").read_text().split()
+    assert (train, test) == split_files(input_dir, 0.5)
+    # no file moved and no temporary list left
+    assert len(list(input_dir.iterdir())) == 10
+    assert sorted(f.name for f in (tmp_path / "lists").iterdir()) == ["testing.list", "training.list"]
+
+
+def test_merge_filelist_select_files():
+    pytest.importorskip("lstchain")
+    from lstmcpipe.scripts.script_merge_filelist import select_files
+
+    files = ["/dl1/node_b/dl1_LST-1.Run00101.0000.h5", "/dl1/dl1_LST-1.Run00102.0000.h5", "/dl1/training.list"]
+    assert select_files(files) == sorted(files[:2])
+    assert select_files(files, pattern="node_*/*.h5") == files[:1]
+    assert select_files(files, run_number=102) == files[1:2]
+
+
+def test_split_files_small_production(tmp_path):
+    input_dir = tmp_path / "dl1"
+    input_dir.mkdir()
+    for name in ["dl1_gamma_run1.h5", "dl1_gamma_run1_bis.h5", "dl1_gamma_run3.h5"]:
+        (input_dir / name).touch()
+    # both runs are in the same dataset with these ratios: runs are not moved to fill the other one
+    for ratio, empty in [(0.1, "testing"), (0.9, "training")]:
+        assert is_test_file("dl1_gamma_run1.h5", ratio) == is_test_file("dl1_gamma_run3.h5", ratio)
+        with pytest.raises(ValueError, match=f"2 runs.*the {empty} dataset would be empty"):
+            split_files(input_dir, ratio)
+
+    assert split_files(input_dir, 0)[1] == []
+    assert split_files(input_dir, 1)[0] == []
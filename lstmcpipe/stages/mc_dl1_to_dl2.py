@@ -3,15 +3,26 @@
 import shutil
 import logging
 from pathlib import Path
-from ..utils import save_log_to_file, SbatchLstMCStage
+from ..utils import (
+    save_logs,
+    SbatchLstMCStage,
+    use_job_array,
+    submit_command_arrays,
+    map_submissions,
+)
+from ..dag import JobDag
+from ..executors import get_executor
 from ..io.data_management import check_and_make_dir_without_verification
+from ..io.stage_cache import restore_stage, cached_command
+from ..io.resource_history import learned_slurm_options
 
 log = logging.getLogger(__name__)
 
 
-def batch_dl1_to_dl2(dict_paths, config_file, jobid_from_training, batch_config, logs):
+def batch_dl1_to_dl2(dict_paths, config_file, jobid_from_training, batch_config, logs, dag=None):
     """
     Function to batch the dl1_to_dl2 stage once the lstchain train_pipe batched jobs have finished.
+    If `dl1_to_dl2` is in the `array_stages` of the batch config, all the jobs are batched as a single slurm array.
 
     Parameters
     ----------
@@ -21,12 +32,14 @@ def batch_dl1_to_dl2(dict_paths, config_file, jobid_from_training, batch_config,
         Path to a configuration file. If none is given, a standard configuration is applied
     jobid_from_training : str
         string containing the jobid from the jobs batched in the train_pipe stage, to be passed to the
-        dl1_to_dl2 function (as a slurm dependency)
+        dl1_to_dl2 function (as a slurm dependency) if the jobs producing the dl1 file or the models are not in the dag
     batch_config : dict
         Dictionary containing the (full) source_environment and the slurm_account strings to be passed to
         dl1_dl2 function
     logs: dict
         Dictionary with logs files
+    dag: `lstmcpipe.dag.JobDag` or None
+        Jobs of the production. Each job only waits for the jobs producing its dl1 file and its models.
 
     Returns
     -------
@@ -38,28 +51,133 @@ def batch_dl1_to_dl2(dict_paths, config_file, jobid_from_training, batch_config,
     jobid_for_dl2_to_dl3 = []
     debug_log = {}
     log.info("==== START batch dl1_to_dl2_workflow ==== \n")
-    for paths in dict_paths:
-        job_logs, jobid = dl1_to_dl2(
-            paths["input"],
-            paths["output"],
-            path_models=paths["path_model"],
-            config_file=config_file,
-            wait_jobid_train_pipe=jobid_from_training,
-            batch_configuration=batch_config,
-            extra_slurm_options=paths.get("extra_slurm_options", None),
+    dag = JobDag() if dag is None else dag
+    dependencies = [
+        dag.dependencies([paths["input"], paths["path_model"]], barrier=jobid_from_training) for paths in dict_paths
+    ]
+    if use_job_array(batch_config, "dl1_to_dl2"):
+        commands, extra_slurm_options, resource_options, submitted = [], [], [], []
+        for paths, wait_jobs in zip(dict_paths, dependencies):
+            cmd = dl1_to_dl2_command(
+                paths["input"],
+                paths["output"],
+                path_models=paths["path_model"],
+                config_file=config_file,
+                batch_configuration=batch_config,
+                wait_jobid_train_pipe=wait_jobs,
+            )
+            if not cmd:
+                dag.add("dl1_to_dl2", [paths["input"], paths["path_model"]], paths["output"])
+                debug_log[f'**CACHED** {paths["output"]}'] = 'restored from the stage cache'
+                continue
+            commands.append(cmd)
+            extra_slurm_options.append(paths.get("extra_slurm_options", None))
+            resource_options.append(learned_slurm_options(batch_config, "dl1_to_dl2", paths["input"]))
+            submitted.append((paths, wait_jobs))
+
+        if commands:
+            # the tasks with the same dependencies are batched in the same array
+            log_dl1_to_dl2, task_ids = submit_command_arrays(
+                "dl1_to_dl2",
+                commands,
+                Path(logs["log_file"]).parent.joinpath("job_arrays"),
+                batch_config,
+                slurm_dependencies=[wait_jobs for _, wait_jobs in submitted],
+                extra_slurm_options=extra_slurm_options,
+                executor=get_executor(batch_config),
+                resource_options=resource_options,
+            )
+            jobid_for_dl2_to_dl3 = list(log_dl1_to_dl2)
+            for task_id, cmd, (paths, wait_jobs) in zip(task_ids, commands, submitted):
+                dag.add("dl1_to_dl2", [paths["input"], paths["path_model"]], paths["output"], task_id)
+                debug_log[task_id] = f"dl1_to_dl2 task that depends on : {wait_jobs} training job: {cmd}"
+
+    else:
+        submissions = map_submissions(
+            lambda paths, wait_jobs: dl1_to_dl2(
+                paths["input"],
+                paths["output"],
+                path_models=paths["path_model"],
+                config_file=config_file,
+                wait_jobid_train_pipe=wait_jobs,
+                batch_configuration=batch_config,
+                extra_slurm_options=paths.get("extra_slurm_options", None),
+            ),
+            dict_paths,
+            batch_config,
+            dependencies,
         )
-
-        log_dl1_to_dl2.update(job_logs)
-        jobid_for_dl2_to_dl3.append(jobid)
-        debug_log[jobid] = f"dl1_to_dl2 jobid that depends on : {jobid_from_training} training job"
+        for paths, wait_jobs, (job_logs, jobid) in zip(dict_paths, dependencies, submissions):
+            dag.add("dl1_to_dl2", [paths["input"], paths["path_model"]], paths["output"], jobid)
+            if not jobid:
+                debug_log[f'**CACHED** {paths["output"]}'] = 'restored from the stage cache'
+                continue
+            log_dl1_to_dl2.update(job_logs)
+            jobid_for_dl2_to_dl3.append(jobid)
+            debug_log[jobid] = f"dl1_to_dl2 jobid that depends on : {wait_jobs} training job"
 
     jobid_for_dl2_to_dl3 = ",".join(jobid_for_dl2_to_dl3)
-    save_log_to_file(log_dl1_to_dl2, logs["log_file"], workflow_step="dl1_to_dl2")
-    save_log_to_file(debug_log, logs["debug_file"], workflow_step="dl1_to_dl2")
+    save_logs(logs, "dl1_to_dl2", log_dl1_to_dl2, debug_log)
     log.info("==== END batch dl1_to_dl2_workflow ====")
     return jobid_for_dl2_to_dl3
 
 
+def dl1_to_dl2_command(
+    input_file,
+    output_dir,
+    path_models,
+    config_file,
+    batch_configuration,
+    wait_jobid_train_pipe=None,
+):
+    """
+    Prepare the output directory and compose the lstchain_dl1_to_dl2 command of a dl1 file.
+
+    Parameters
+    ----------
+    input_file : str
+        FILE DL1 path
+    output_dir : str
+        DIR Dl2 path
+    path_models : str
+        DIR trained models path
+    config_file : str
+        Path to a configuration file. If none is given, a standard configuration is applied
+    batch_configuration : dict
+        Dictionary containing the (full) source_environment and the slurm_account strings
+    wait_jobid_train_pipe : str
+        Comma-separated string with the batched jobid from the train stage
+
+    Returns
+    -------
+    cmd : str
+        command to be batched. Empty if the dl2 file was restored from the stage cache.
+    """
+    log.info(f"Working on DL1 files in {Path(input_file).parent.as_posix()}")
+    check_and_make_dir_without_verification(output_dir)
+    log.info(f"Output dir: {output_dir}")
+    cmd = f"lstchain_dl1_to_dl2 -f {input_file} -p {path_models} -o {output_dir}"
+    if config_file is not None:
+        cmd += f" -c {Path(config_file).resolve().as_posix()}"
+        shutil.copyfile(config_file, Path(output_dir).joinpath(Path(config_file).name))
+
+    # name given by lstchain_dl1_to_dl2 to the output file
+    output_file = Path(output_dir).joinpath(Path(input_file).name.replace("dl1", "dl2", 1))
+    restored, cache_spec = restore_stage(
+        batch_configuration,
+        "dl1_to_dl2",
+        [input_file, path_models],
+        [output_file],
+        cmd,
+        config_files=[config_file],
+        dependencies=wait_jobid_train_pipe,
+    )
+    if restored:
+        log.info(f"{output_file} restored from the stage cache")
+        return ""
+    return cached_command(batch_configuration, cache_spec, cmd)
+
+
 def dl1_to_dl2(
     input_file,
     output_dir,
@@ -98,15 +216,20 @@ def dl1_to_dl2(
         log dictionary containing {jobid: batch_cmd} information
 
     jobid_dl1_to_dl2 : str
-        batched job_id to be passed to later stages
+        batched job_id to be passed to later stages. Empty if the dl2 file was restored from the stage cache.
 
     """
-    log.info(f"Working on DL1 files in {Path(input_file).parent.as_posix()}")
-    check_and_make_dir_without_verification(output_dir)
-    log.info(f"Output dir: {output_dir}")
-    cmd = f"lstchain_dl1_to_dl2 -f {input_file} -p {path_models} -o {output_dir}"
-    if config_file is not None:
-        cmd += f" -c {Path(config_file).resolve().as_posix()}"
+    cmd = dl1_to_dl2_command(
+        input_file,
+        output_dir,
+        path_models,
+        config_file,
+        batch_configuration,
+        wait_jobid_train_pipe=wait_jobid_train_pipe,
+    )
+    if not cmd:
+        return {}, ""
+
     sbatch_dl1_dl2 = SbatchLstMCStage(
         "dl1_to_dl2",
         wrap_command=cmd,
@@ -116,11 +239,11 @@ def dl1_to_dl2(
         extra_slurm_options=extra_slurm_options,
         slurm_account=batch_configuration["slurm_account"],
         source_environment=batch_configuration["source_environment"],
+        executor=get_executor(batch_configuration),
+        resource_options=learned_slurm_options(batch_configuration, "dl1_to_dl2", input_file),
     )
 
     jobid_dl1_to_dl2 = sbatch_dl1_dl2.submit()
     log_dl1_to_dl2 = {jobid_dl1_to_dl2: sbatch_dl1_dl2.slurm_command}
     log.info(f"Submitted batch job {jobid_dl1_to_dl2}")
-    if config_file is not None:
-        shutil.copyfile(config_file, Path(output_dir).joinpath(Path(config_file).name))
     return log_dl1_to_dl2, jobid_dl1_to_dl2
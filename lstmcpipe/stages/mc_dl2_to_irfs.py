@@ -6,14 +6,23 @@
 import shutil
 import logging
 from pathlib import Path
-from ..utils import save_log_to_file, SbatchLstMCStage
+from ..utils import (
+    save_logs,
+    SbatchLstMCStage,
+    use_job_array,
+    submit_command_arrays,
+    map_submissions,
+)
+from ..dag import JobDag
+from ..executors import get_executor
 from ..io.data_management import check_and_make_dir_without_verification
+from ..io.stage_cache import restore_stage, cached_command
 
 
 log = logging.getLogger(__name__)
 
 
-def batch_dl2_to_irfs(dict_paths, config_file, job_ids_from_dl1_dl2, batch_config, logs):
+def batch_dl2_to_irfs(dict_paths, config_file, job_ids_from_dl1_dl2, batch_config, logs, dag=None):
     """
     Batches the dl2_to_irfs stage (lstchain lstchain_create_irf_files script) once the dl1_to_dl2 stage had finished.
 
@@ -25,12 +34,14 @@ def batch_dl2_to_irfs(dict_paths, config_file, job_ids_from_dl1_dl2, batch_confi
         Path to lstchain-like config file
     job_ids_from_dl1_dl2: str
         Comma-separated string with the job ids from the dl1_to_dl2 stage to be used as a slurm dependency
-        to schedule the current stage
+        to schedule the current stage if the jobs producing the dl2 files are not in the dag
     batch_config : dict
         Dictionary containing the (full) source_environment and the slurm_account strings to be passed to
         dl2_to_irfs function
     logs: dict
         Dictionary with logs files
+    dag: `lstmcpipe.dag.JobDag` or None
+        Jobs of the production. Each job only waits for the jobs producing its dl2 files.
 
     Returns
     -------
@@ -43,35 +54,146 @@ def batch_dl2_to_irfs(dict_paths, config_file, job_ids_from_dl1_dl2, batch_confi
     jobid_for_check = []
     debug_log = {}
 
-    for paths in dict_paths:
-        job_logs, jobid = dl2_to_irfs(
-            paths["input"]["gamma_file"],  # gamma_file must always be provided
-            paths["input"].get("electron_file", None),  # electron_file might be missing in case of point-like IRFs
-            paths["input"].get("proton_file", None),  # proton_file might be missing in case of point-like IRFs
-            paths["output"],
-            config_file=config_file,
-            options=paths.get("options", None),
-            batch_configuration=batch_config,
-            wait_jobs_dl1dl2=job_ids_from_dl1_dl2,
-            extra_slurm_options=paths.get("extra_slurm_options", None),
-        )
+    dag = JobDag() if dag is None else dag
+    dependencies = [dag.dependencies(paths["input"], barrier=job_ids_from_dl1_dl2) for paths in dict_paths]
+    if use_job_array(batch_config, "dl2_to_irfs"):
+        commands, extra_slurm_options, submitted = [], [], []
+        for paths, wait_jobs in zip(dict_paths, dependencies):
+            cmd = dl2_to_irfs_command(
+                paths["input"]["gamma_file"],
+                paths["input"].get("electron_file", None),
+                paths["input"].get("proton_file", None),
+                paths["output"],
+                config_file=config_file,
+                options=paths.get("options", None),
+                batch_configuration=batch_config,
+                wait_jobs_dl1dl2=wait_jobs,
+            )
+            if not cmd:
+                dag.add("dl2_to_irfs", paths["input"], paths["output"])
+                debug_log[f'**CACHED** {paths["output"]}'] = 'restored from the stage cache'
+                continue
+            commands.append(cmd)
+            extra_slurm_options.append(paths.get("extra_slurm_options", None))
+            submitted.append((paths, wait_jobs))
+
+        if commands:
+            # the tasks with the same dependencies are batched in the same array
+            log_dl2_to_irfs, task_ids = submit_command_arrays(
+                "dl2_to_irfs",
+                commands,
+                Path(logs["log_file"]).parent.joinpath("job_arrays"),
+                batch_config,
+                slurm_dependencies=[wait_jobs for _, wait_jobs in submitted],
+                extra_slurm_options=extra_slurm_options,
+                executor=get_executor(batch_config),
+            )
+            jobid_for_check = list(log_dl2_to_irfs)
+            for task_id, cmd, (paths, _) in zip(task_ids, commands, submitted):
+                dag.add("dl2_to_irfs", paths["input"], paths["output"], task_id)
+                debug_log[task_id] = f"dl2_to_irfs task that depends of the dl1_to_dl2 stage: {cmd}"
 
-        log_dl2_to_irfs.update(log_dl2_to_irfs)
-        jobid_for_check.append(jobid)
-        debug_log[jobid] = (
-            f"jobid from dl2_to_irfs stage that depends of the dl1_to_dl2 stage " f"job_ids; {job_ids_from_dl1_dl2}"
+    else:
+        submissions = map_submissions(
+            lambda paths, wait_jobs: dl2_to_irfs(
+                paths["input"]["gamma_file"],  # gamma_file must always be provided
+                paths["input"].get("electron_file", None),  # electron_file might be missing in case of point-like IRFs
+                paths["input"].get("proton_file", None),  # proton_file might be missing in case of point-like IRFs
+                paths["output"],
+                config_file=config_file,
+                options=paths.get("options", None),
+                batch_configuration=batch_config,
+                wait_jobs_dl1dl2=wait_jobs,
+                extra_slurm_options=paths.get("extra_slurm_options", None),
+            ),
+            dict_paths,
+            batch_config,
+            dependencies,
         )
+        for paths, wait_jobs, (job_logs, jobid) in zip(dict_paths, dependencies, submissions):
+            dag.add("dl2_to_irfs", paths["input"], paths["output"], jobid)
+            if not jobid:
+                debug_log[f'**CACHED** {paths["output"]}'] = 'restored from the stage cache'
+                continue
+            log_dl2_to_irfs.update(job_logs)
+            jobid_for_check.append(jobid)
+            debug_log[jobid] = (
+                f"jobid from dl2_to_irfs stage that depends of the dl1_to_dl2 stage " f"job_ids; {wait_jobs}"
+            )
 
     jobid_for_check = ",".join(jobid_for_check)
 
-    save_log_to_file(log_dl2_to_irfs, logs["log_file"], workflow_step="dl2_to_irfs")
-    save_log_to_file(debug_log, logs["debug_file"], workflow_step="dl2_to_irfs")
+    save_logs(logs, "dl2_to_irfs", log_dl2_to_irfs, debug_log)
 
     log.info("==== END batch mc_dl2_to_irfs ====")
 
     return jobid_for_check
 
 
+def dl2_to_irfs_command(
+    gamma_file,
+    electron_file,
+    proton_file,
+    outfile,
+    config_file,
+    options,
+    batch_configuration,
+    wait_jobs_dl1dl2,
+):
+    """
+    Prepare the output directory and compose the lstchain `lstchain_create_irf_files` command.
+
+    Parameters
+    ----------
+    gamma_file: str
+    electron_file: str
+    proton_file: str
+    outfile: str
+    config_file: str
+        Path to a configuration file. If none is given, a standard configuration is applied
+    options: str  | None
+        options to pass to lstchain_create_irf_files as a string
+    batch_configuration : dict
+    wait_jobs_dl1dl2: str
+        Comma separated string with the job ids of previous stages (dl1_to_dl2 stage)
+
+    Returns
+    -------
+    cmd: str
+        command to be batched. Empty if the IRF file was restored from the stage cache.
+    """
+    output_dir = Path(outfile).parent
+
+    check_and_make_dir_without_verification(output_dir)
+
+    options = '' if options is None else options
+    cmd = f"lstchain_create_irf_files {options} -g {gamma_file} -o {outfile} "
+    if proton_file is not None:
+        cmd += f" -p {proton_file}"
+    if electron_file is not None:
+        cmd += f" -e {electron_file}"
+    if config_file:
+        cmd += f" --config={config_file}"
+        # Copy config into working dir
+        shutil.copyfile(config_file, Path(output_dir).joinpath(Path(config_file).name))
+
+    log.info(f"Output dir IRF of {gamma_file}: {output_dir}")
+
+    restored, cache_spec = restore_stage(
+        batch_configuration,
+        "dl2_to_irfs",
+        [f for f in [gamma_file, proton_file, electron_file] if f is not None],
+        [outfile],
+        cmd,
+        config_files=[config_file] if config_file else [],
+        dependencies=wait_jobs_dl1dl2,
+    )
+    if restored:
+        log.info(f"{outfile} restored from the stage cache")
+        return ""
+    return cached_command(batch_configuration, cache_spec, cmd)
+
+
 def dl2_to_irfs(
     gamma_file,
     electron_file,
@@ -112,22 +234,23 @@ def dl2_to_irfs(
         Dictionary-wise log containing {'job_id': 'batched_cmd'} items
     job_id_dl2_irfs: str
         Job-id of the batched job to be passed to the last (MC prod check) stage of the workflow.
+        Empty if the IRF file was restored from the stage cache.
     """
     output_dir = Path(outfile).parent
     log_dl2_to_irfs = {}
 
-    check_and_make_dir_without_verification(output_dir)
-
-    options = '' if options is None else options
-    cmd = f"lstchain_create_irf_files {options} -g {gamma_file} -o {outfile} "
-    if proton_file is not None:
-        cmd += f" -p {proton_file}"
-    if electron_file is not None:
-        cmd += f" -e {electron_file}"
-    if config_file:
-        cmd += f" --config={config_file}"
-
-    log.info(f"Output dir IRF of {gamma_file}: {output_dir}")
+    cmd = dl2_to_irfs_command(
+        gamma_file,
+        electron_file,
+        proton_file,
+        outfile,
+        config_file,
+        options,
+        batch_configuration,
+        wait_jobs_dl1dl2,
+    )
+    if not cmd:
+        return log_dl2_to_irfs, ""
 
     sbatch_dl2_irfs = SbatchLstMCStage(
         "dl2_to_irfs",
@@ -138,6 +261,7 @@ def dl2_to_irfs(
         extra_slurm_options=extra_slurm_options,
         slurm_account=batch_configuration["slurm_account"],
         source_environment=batch_configuration["source_environment"],
+        executor=get_executor(batch_configuration),
     )
 
     job_id_dl2_irfs = sbatch_dl2_irfs.submit()
@@ -145,8 +269,4 @@ def dl2_to_irfs(
 
     log.info(f"Submitted batch job {job_id_dl2_irfs}")
 
-    # Copy config into working dir
-    if config_file:
-        shutil.copyfile(config_file, Path(output_dir).joinpath(Path(config_file).name))
-
     return log_dl2_to_irfs, job_id_dl2_irfs
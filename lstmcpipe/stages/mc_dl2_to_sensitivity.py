@@ -2,12 +2,15 @@
 
 import logging
 from pathlib import Path
-from ..utils import save_log_to_file, SbatchLstMCStage
+from ..utils import save_logs, SbatchLstMCStage, map_submissions
+from ..dag import JobDag
+from ..executors import get_executor
+from ..io.stage_cache import restore_stage, cached_command
 
 log = logging.getLogger(__name__)
 
 
-def batch_dl2_to_sensitivity(dict_paths, job_ids_from_dl1_dl2, batch_config, logs):
+def batch_dl2_to_sensitivity(dict_paths, job_ids_from_dl1_dl2, batch_config, logs, dag=None):
     """
     Batches the dl2_to_sensitivity stage (`stages.script_dl2_to_sensitivity` based in the pyIRF iib) once the
     dl1_to_dl2 stage had finished.
@@ -18,12 +21,14 @@ def batch_dl2_to_sensitivity(dict_paths, job_ids_from_dl1_dl2, batch_config, log
         Core dictionary with {stage: PATHS} information
     job_ids_from_dl1_dl2: str
         Comma-separated string with the job ids from the dl1_to_dl2 stage to be used as a slurm dependency
-        to schedule the current stage
+        to schedule the current stage if the jobs producing the dl2 files are not in the dag
     batch_config : dict
         Dictionary containing the (full) source_environment and the slurm_account strings to be passed to
         dl2_to_sensitivity function
     logs: dict
         Dictionary with logs files
+    dag: `lstmcpipe.dag.JobDag` or None
+        Jobs of the production. Each job only waits for the jobs producing its dl2 files.
 
     Returns
     -------
@@ -34,26 +39,31 @@ def batch_dl2_to_sensitivity(dict_paths, job_ids_from_dl1_dl2, batch_config, log
     log_dl2_to_sensitivity = {}
     jobid_for_check = []
     debug_log = {}
-    for paths in dict_paths:
-        job_logs, jobid = dl2_to_sensitivity(
+    dag = JobDag() if dag is None else dag
+    dependencies = [dag.dependencies(paths["input"], barrier=job_ids_from_dl1_dl2) for paths in dict_paths]
+    submissions = map_submissions(
+        lambda paths, wait_jobs: dl2_to_sensitivity(
             paths["input"],
             paths["output"],
             batch_configuration=batch_config,
-            wait_jobs_dl1_dl2=job_ids_from_dl1_dl2,
+            wait_jobs_dl1_dl2=wait_jobs,
             extra_slurm_options=paths.get("extra_slurm_options", None),
-        )
-
+        ),
+        dict_paths,
+        batch_config,
+        dependencies,
+    )
+    for paths, wait_jobs, (job_logs, jobid) in zip(dict_paths, dependencies, submissions):
+        dag.add("dl2_to_sensitivity", paths["input"], paths["output"], jobid)
         jobid_for_check.append(jobid)
         log_dl2_to_sensitivity.update(job_logs)
         debug_log[jobid] = (
             f"Job_ids from the dl2_to_sensitivity stage and the plot_irfs script that depends on the "
-            f"dl1_to_dl2 stage job_ids; {job_ids_from_dl1_dl2} "
+            f"dl1_to_dl2 stage job_ids; {wait_jobs} "
         )
 
     jobid_for_check = ",".join(jobid_for_check)
-    save_log_to_file(log_dl2_to_sensitivity, logs["log_file"], "dl2_to_sensitivity")
-
-    save_log_to_file(debug_log, logs["debug_file"], "dl2_to_sensitivity")
+    save_logs(logs, "dl2_to_sensitivity", log_dl2_to_sensitivity, debug_log)
     log.info('==== END batch mc_dl2_to_sensitivity ====')
     return jobid_for_check
 
@@ -89,22 +99,34 @@ def dl2_to_sensitivity(input_paths, output, batch_configuration, wait_jobs_dl1_d
     e_file = input_paths["electron_file"]
     cmd_sens = f"lstmcpipe_dl2_to_sensitivity -g {g_file} -p {p_file} -e {e_file} -o {output}"
 
-    sbatch_dl2_sens = SbatchLstMCStage(
-        "dl2_sens",
-        wrap_command=cmd_sens,
-        slurm_error=Path(output).parent.joinpath("job_dl2_to_sensitivity_%j.e"),
-        slurm_output=Path(output).parent.joinpath("job_dl2_to_sensitivity_%j.o"),
-        slurm_dependencies=wait_jobs_dl1_dl2,
-        extra_slurm_options=extra_slurm_options,
-        slurm_account=batch_configuration["slurm_account"],
-        source_environment=batch_configuration["source_environment"],
+    log_dl2_to_sensitivity = {}
+    jobids_dl2_to_sensitivity = []
+
+    # the sensitivity file is taken from the stage cache if possible, its plot is always redone
+    restored, cache_spec = restore_stage(
+        batch_configuration, "dl2_sens", [g_file, p_file, e_file], [output], cmd_sens, dependencies=wait_jobs_dl1_dl2
     )
+    if restored:
+        log.info(f"Sensitivity file {output} restored from the stage cache")
+        job_id_dl2_sens = ""
+    else:
+        sbatch_dl2_sens = SbatchLstMCStage(
+            "dl2_sens",
+            wrap_command=cached_command(batch_configuration, cache_spec, cmd_sens),
+            slurm_error=Path(output).parent.joinpath("job_dl2_to_sensitivity_%j.e"),
+            slurm_output=Path(output).parent.joinpath("job_dl2_to_sensitivity_%j.o"),
+            slurm_dependencies=wait_jobs_dl1_dl2,
+            extra_slurm_options=extra_slurm_options,
+            slurm_account=batch_configuration["slurm_account"],
+            source_environment=batch_configuration["source_environment"],
+            executor=get_executor(batch_configuration),
+        )
 
-    job_id_dl2_sens = sbatch_dl2_sens.submit()
-    log_dl2_to_sensitivity = {job_id_dl2_sens: job_id_dl2_sens.slurm_command}
-    jobids_dl2_to_sensitivity = [job_id_dl2_sens]
-    log.info(f"Output dir of sensitivity file: {output}")
-    log.info(f"Submitted batch job {job_id_dl2_sens}")
+        job_id_dl2_sens = sbatch_dl2_sens.submit()
+        log_dl2_to_sensitivity[job_id_dl2_sens] = sbatch_dl2_sens.slurm_command
+        jobids_dl2_to_sensitivity.append(job_id_dl2_sens)
+        log.info(f"Output dir of sensitivity file: {output}")
+        log.info(f"Submitted batch job {job_id_dl2_sens}")
     cmd_plot_sens = f'lstmcpipe_plot_irfs -f {output} -o {output.replace(".fits.gz", ".png")}'
 
     sbatch_plot_sens = SbatchLstMCStage(
@@ -116,6 +138,7 @@ def dl2_to_sensitivity(input_paths, output, batch_configuration, wait_jobs_dl1_d
         extra_slurm_options=extra_slurm_options,
         slurm_account=batch_configuration["slurm_account"],
         source_environment=batch_configuration["source_environment"],
+        executor=get_executor(batch_configuration),
         backend="export MPLBACKEND=Agg; ",
     )
 
@@ -2,15 +2,28 @@
 
 import logging
 from pathlib import Path
-from ..utils import save_log_to_file, SbatchLstMCStage
+from ..utils import (
+    save_logs,
+    SbatchLstMCStage,
+    use_job_array,
+    submit_command_arrays,
+    map_submissions,
+)
+from ..dag import JobDag, is_related
+from ..executors import get_executor
+from ..io.stage_cache import restore_stage, cached_command
+from ..io.resource_history import learned_slurm_options
 
 log = logging.getLogger(__name__)
 
 
-def batch_merge_dl1(dict_paths, batch_config, logs, jobid_from_splitting, workflow_kind="lstchain"):
+def batch_merge_dl1(
+    dict_paths, batch_config, logs, jobid_from_splitting, workflow_kind="lstchain", virtual_split=None, dag=None
+):
     """
     Function to batch the onsite_mc_merge_and_copy function once the all the r0_to_dl1 jobs (batched by particle type)
     have finished.
+    If `merge_dl1` is in the `array_stages` of the batch config, all the jobs are batched as a single slurm array.
 
     Batch 8 merge_and_copy_dl1 jobs ([train, test] x particle) + the move_dl1 and move_dir jobs (2 per particle).
 
@@ -26,6 +39,12 @@ def batch_merge_dl1(dict_paths, batch_config, logs, jobid_from_splitting, workfl
     logs: dict
         Dictionary with logs files
     jobid_from_splitting: str
+        Jobs to wait for if the jobs producing the files to merge are not in the dag
+    virtual_split: dict or None
+        Virtual train/test split, as returned by `lstmcpipe.stages.mc_train_test_splitting.virtual_split`.
+        Entries whose input is a train or test dir of the split merge the files of the corresponding filelist.
+    dag: `lstmcpipe.dag.JobDag` or None
+        Jobs of the production. Each merging job only waits for the jobs producing its input files.
 
     Returns
     -------
@@ -38,25 +57,151 @@ def batch_merge_dl1(dict_paths, batch_config, logs, jobid_from_splitting, workfl
     all_jobs_merge_stage = []
     debug_log = {}
     log.info('==== START batch merge_and_copy_dl1_workflow ====')
-    for paths in dict_paths:
-        job_logs, jobid_debug = merge_dl1(
-            paths["input"],
-            paths["output"],
-            merging_options=paths.get('options', None),
-            batch_configuration=batch_config,
-            wait_jobs_split=jobid_from_splitting,
-            workflow_kind=workflow_kind,
-            extra_slurm_options=paths.get("extra_slurm_options", None),
-        )
+    dag = JobDag() if dag is None else dag
+    # with a virtual split, the files to merge are the files to split
+    inputs = [(virtual_split_of(virtual_split, paths["input"]) or paths)["input"] for paths in dict_paths]
+    dependencies = [dag.dependencies(input_dir, barrier=jobid_from_splitting) for input_dir in inputs]
+    if use_job_array(batch_config, "merge_dl1"):
+        commands, extra_slurm_options, resource_options, submitted = [], [], [], []
+        for paths, input_dir, wait_jobs in zip(dict_paths, inputs, dependencies):
+            cmd = merge_dl1_command(
+                paths["input"],
+                paths["output"],
+                batch_configuration=batch_config,
+                wait_jobs_split=wait_jobs,
+                merging_options=paths.get('options', None),
+                workflow_kind=workflow_kind,
+                virtual_split=virtual_split_of(virtual_split, paths["input"]),
+            )
+            if not cmd:
+                dag.add("merge_dl1", input_dir, paths["output"])
+                debug_log[f'**CACHED** {paths["output"]}'] = 'restored from the stage cache'
+                continue
+            commands.append(cmd)
+            extra_slurm_options.append(paths.get("extra_slurm_options", None))
+            resource_options.append(learned_slurm_options(batch_config, "merge_dl1", paths["input"]))
+            submitted.append((input_dir, paths["output"], wait_jobs))
 
-        log_merge.update(job_logs)
-        all_jobs_merge_stage.append(jobid_debug)
-    save_log_to_file(log_merge, logs["log_file"], "merge_dl1")
-    save_log_to_file(debug_log, logs["debug_file"], workflow_step="merge_dl1")
+        if commands:
+            # the tasks with the same dependencies are batched in the same array
+            log_merge, task_ids = submit_command_arrays(
+                "merge_dl1",
+                commands,
+                Path(logs["log_file"]).parent.joinpath("job_arrays"),
+                batch_config,
+                slurm_dependencies=[wait_jobs for _, _, wait_jobs in submitted],
+                extra_slurm_options=extra_slurm_options,
+                executor=get_executor(batch_config),
+                resource_options=resource_options,
+            )
+            all_jobs_merge_stage = list(log_merge)
+            for task_id, cmd, (input_dir, output_file, _) in zip(task_ids, commands, submitted):
+                dag.add("merge_dl1", input_dir, output_file, task_id)
+                debug_log[task_id] = f"merge_dl1 task: {cmd}"
+
+    else:
+        submissions = map_submissions(
+            lambda paths, wait_jobs: merge_dl1(
+                paths["input"],
+                paths["output"],
+                merging_options=paths.get('options', None),
+                batch_configuration=batch_config,
+                wait_jobs_split=wait_jobs,
+                workflow_kind=workflow_kind,
+                extra_slurm_options=paths.get("extra_slurm_options", None),
+                virtual_split=virtual_split_of(virtual_split, paths["input"]),
+            ),
+            dict_paths,
+            batch_config,
+            dependencies,
+        )
+        for paths, input_dir, (job_logs, jobid_debug) in zip(dict_paths, inputs, submissions):
+            dag.add("merge_dl1", input_dir, paths["output"], jobid_debug)
+            if not jobid_debug:
+                debug_log[f'**CACHED** {paths["output"]}'] = 'restored from the stage cache'
+                continue
+            log_merge.update(job_logs)
+            all_jobs_merge_stage.append(jobid_debug)
+    save_logs(logs, "merge_dl1", log_merge, debug_log)
     log.info('==== END batch merge_and_copy_dl1_workflow ====')
     return ','.join(all_jobs_merge_stage)
 
 
+def virtual_split_of(virtual_split, input_dir):
+    """
+    Virtual split entry of a merging input dir, None if the files of input_dir are really there.
+
+    Raises
+    ------
+    ValueError if input_dir contains or is inside a train or test dir of the virtual split: its files are not there
+    """
+    if not virtual_split:
+        return None
+    input_dir = Path(input_dir).resolve()
+    if input_dir.as_posix() in virtual_split:
+        return virtual_split[input_dir.as_posix()]
+    for split_dir in virtual_split:
+        if is_related(input_dir, Path(split_dir)):
+            raise ValueError(
+                f"{input_dir} is merged as a directory but its files are only split virtually in {split_dir}. "
+                "Merge the train and test dirs of the split, or set virtual_train_test_split to False."
+            )
+    return None
+
+
+def merge_dl1_command(
+    input_dir,
+    output_file,
+    batch_configuration,
+    wait_jobs_split="",
+    merging_options=None,
+    workflow_kind="lstchain",
+    virtual_split=None,
+):
+    """
+    Compose the command merging the dl1 files of a directory.
+
+    Parameters
+    ----------
+    input_dir: str
+    output_file: str
+    batch_configuration: dict
+    wait_jobs_split: str
+    merging_options: dict
+    workflow_kind: str
+    virtual_split: dict or None
+        If given (entry of `lstmcpipe.stages.mc_train_test_splitting.virtual_split`), the job first writes the filelist
+        of the split and then merges the files of the list (lstchain and hiperta workflows only).
+
+    Returns
+    -------
+    cmd: str
+        command to be batched. Empty if the merged file was restored from the stage cache.
+    """
+    merging_options = "" if merging_options is None else merging_options
+    if virtual_split is not None:
+        cmd = (
+            f"{virtual_split['cmd']} && "
+            f"lstmcpipe_merge_filelist -f {virtual_split['filelist']} -o {output_file} {merging_options}"
+        )
+        # the files to merge are in the directory of the files to split
+        input_dir = virtual_split["input"]
+
+    elif workflow_kind in ["lstchain", "hiperta"]:
+        cmd = f'lstchain_merge_hdf5_files -d {input_dir} -o {output_file} {merging_options}'
+
+    else:
+        cmd = f'ctapipe-merge --input-dir {input_dir} --output {output_file} {merging_options}'
+
+    restored, cache_spec = restore_stage(
+        batch_configuration, "merge_dl1", [input_dir], [output_file], cmd, dependencies=wait_jobs_split
+    )
+    if restored:
+        log.info(f"\nMerged DL1 file {output_file} restored from the stage cache.")
+        return ""
+    return cached_command(batch_configuration, cache_spec, cmd)
+
+
 def merge_dl1(
     input_dir,
     output_file,
@@ -65,6 +210,7 @@ def merge_dl1(
     merging_options=None,
     workflow_kind="lstchain",
     extra_slurm_options=None,
+    virtual_split=None,
 ):
     """
 
@@ -78,19 +224,26 @@ def merge_dl1(
     workflow_kind: str
     extra_slurm_options: dict
         Extra slurm options to be passed to the sbatch command
+    virtual_split: dict or None
+        see `merge_dl1_command`
 
     Returns
     -------
     log_merge: dict
     jobid_merge: str
-
+        Empty if the output was restored from the stage cache
     """
-    merging_options = "" if merging_options is None else merging_options
-    if workflow_kind in ["lstchain", "hiperta"]:
-        cmd = f'lstchain_merge_hdf5_files -d {input_dir} -o {output_file} {merging_options}'
-
-    else:
-        cmd = f'ctapipe-merge --input-dir {input_dir} --output {output_file} {merging_options}'
+    cmd = merge_dl1_command(
+        input_dir,
+        output_file,
+        batch_configuration,
+        wait_jobs_split=wait_jobs_split,
+        merging_options=merging_options,
+        workflow_kind=workflow_kind,
+        virtual_split=virtual_split,
+    )
+    if not cmd:
+        return {}, ""
 
     sbatch_merge_dl1 = SbatchLstMCStage(
         "merge_dl1",
@@ -101,6 +254,8 @@ def merge_dl1(
         extra_slurm_options=extra_slurm_options,
         slurm_account=batch_configuration["slurm_account"],
         source_environment=batch_configuration["source_environment"],
+        executor=get_executor(batch_configuration),
+        resource_options=learned_slurm_options(batch_configuration, "merge_dl1", input_dir),
     )
 
     jobid_merge = sbatch_merge_dl1.submit()
@@ -2,16 +2,27 @@
 
 # Code to reduce R0 data to DL1 onsite (La Palma cluster)
 
+import os
+import heapq
 import shutil
 import logging
 from pathlib import Path
-from ..utils import save_log_to_file, SbatchLstMCStage
-from ..io.data_management import check_data_path, get_input_filelist
+from concurrent.futures import ThreadPoolExecutor
+from ..utils import save_logs, SbatchLstMCStage, slurm_time_to_seconds, map_submissions
+from ..dag import JobDag
+from ..executors import get_executor
+from ..io.data_management import check_data_path, get_input_filelist, is_complete_hdf5_file
+from ..io.stage_cache import restore_stage, cached_command
 
 log = logging.getLogger(__name__)
 
+# MB of simtel input processed per second by lstchain_mc_r0_to_dl1, order of magnitude measured on La Palma nodes
+DEFAULT_DL1_THROUGHPUT_MBPS = 0.25
 
-def batch_process_dl1(dict_paths, conf_file, batch_config, logs, workflow_kind="lstchain", new_production=True):
+
+def batch_process_dl1(
+    dict_paths, conf_file, batch_config, logs, workflow_kind="lstchain", new_production=True, resume=False, dag=None
+):
     """
     Batch the dl1 processing jobs by particle type.
 
@@ -30,6 +41,10 @@ def batch_process_dl1(dict_paths, conf_file, batch_config, logs, workflow_kind="
         Whether to analysis simtel or reprocess existing dl1 files.
     logs: dict
         Dictionary con logs files
+    resume: bool
+        Keep complete outputs of a previous run and only process the missing or corrupted ones.
+    dag: `lstmcpipe.dag.JobDag` or None
+        Jobs of the production, the jobs of this stage are added to it
 
     Returns
     -------
@@ -39,8 +54,10 @@ def batch_process_dl1(dict_paths, conf_file, batch_config, logs, workflow_kind="
     log_process_dl1 = {}
     debug_log = {}
     jobids_dl1_processing_stage = []
+    dag = JobDag() if dag is None else dag
     log.info(f"==== START {workflow_kind} dl1 processing ====")
     if new_production:
+        r0_paths = []
         for paths in dict_paths["r0_to_dl1"]:
             try:
                 check_data_path(paths["input"], glob="*.simtel.gz")
@@ -48,39 +65,61 @@ def batch_process_dl1(dict_paths, conf_file, batch_config, logs, workflow_kind="
                 debug_log["**EMPTY_R0_DIR**"] = f'{paths["input"]} directory does not contain any simtel.gz file'
 
                 continue
-            job_logs, jobid = r0_to_dl1(
+            r0_paths.append(paths)
+
+        submissions = map_submissions(
+            lambda paths: r0_to_dl1(
                 paths["input"],
                 paths["output"],
                 config_file=conf_file,
                 batch_config=batch_config,
                 workflow_kind=workflow_kind,
                 extra_slurm_options=paths.get("extra_slurm_options", None),
-            )
+                n_workers=batch_config.get("dl1_n_workers"),
+                target_bytes_per_job=dl1_target_bytes_per_job(batch_config),
+                resume=resume,
+            ),
+            r0_paths,
+            batch_config,
+        )
+        for paths, (job_logs, jobid) in zip(r0_paths, submissions):
+            dag.add("r0_to_dl1", paths["input"], paths["output"], jobid)
+            if not jobid:
+                debug_log[f'**COMPLETE_DL1_DIR** {paths["output"]}'] = 'all the dl1 files already exist'
+                continue
 
             log_process_dl1.update(job_logs)
             jobids_dl1_processing_stage.append(jobid)
             debug_log[jobid] = f'r0_dl1 job from input dir: {paths["input"]}'
     else:
-        for paths in dict_paths["dl1ab"]:
-            job_logs, jobid = reprocess_dl1(
+        submissions = map_submissions(
+            lambda paths: reprocess_dl1(
                 paths["input"],
                 paths["output"],
                 config_file=conf_file,
                 batch_config=batch_config,
                 workflow_kind=workflow_kind,
                 extra_slurm_options=paths.get("extra_slurm_options", None),
-            )
+                target_bytes_per_job=dl1_target_bytes_per_job(batch_config, "dl1ab"),
+                resume=resume,
+            ),
+            dict_paths["dl1ab"],
+            batch_config,
+        )
+        for paths, (job_logs, jobid) in zip(dict_paths["dl1ab"], submissions):
+            dag.add("dl1ab", paths["input"], paths["output"], jobid)
+            if not jobid:
+                debug_log[f'**COMPLETE_DL1_DIR** {paths["output"]}'] = 'all the dl1 files already exist'
+                continue
 
             log_process_dl1.update(job_logs)
             jobids_dl1_processing_stage.append(jobid)
             debug_log[jobid] = f'dl1ab job from input dir: {paths["input"]}'
     jobids_dl1_processing_stage = ",".join(jobids_dl1_processing_stage)
     if new_production:
-        save_log_to_file(log_process_dl1, logs["log_file"], "r0_to_dl1")
-        save_log_to_file(debug_log, logs["debug_file"], workflow_step="r0_to_dl1")
+        save_logs(logs, "r0_to_dl1", log_process_dl1, debug_log)
     else:
-        save_log_to_file(log_process_dl1, logs["log_file"], "dl1ab")
-        save_log_to_file(debug_log, logs["debug_file"], workflow_step="dl1ab")
+        save_logs(logs, "dl1ab", log_process_dl1, debug_log)
     log.info(f"==== END {workflow_kind} dl1 processing ====")
     return jobids_dl1_processing_stage
 
@@ -94,6 +133,9 @@ def r0_to_dl1(
     debug_mode=False,
     keep_rta_file=False,
     extra_slurm_options=None,
+    n_workers=None,
+    target_bytes_per_job=None,
+    resume=False,
 ):
     """
     R0 to DL1 MC onsite conversion.
@@ -115,6 +157,18 @@ def r0_to_dl1(
         One of the supported pipelines. Defines the command to be run on r0 files
     extra_slurm_options: dict
         Extra slurm options to be passed
+    n_workers: int or None
+        Number of worker processes used by each array task to process its sublist (lstchain and hiperta).
+        The lstchain array tasks request as many cpus. The hiperta array tasks run hiperta_r0_dl1 and the
+        reorganizations in two pools of `n_workers` and request twice as many cpus.
+        Default None: files are processed one after the other.
+    target_bytes_per_job: int or None
+        If given, input files are packed into sublists of about this many bytes.
+        Otherwise, the number of sublists is set from the number of files.
+    resume: bool
+        If False (default), the output directory is emptied first.
+        If True, complete dl1 files already in the output directory are kept and only the missing or corrupted
+        ones are processed.
 
     # HIPERTA ARGUMENTS
     keep_rta_file : bool
@@ -130,12 +184,15 @@ def r0_to_dl1(
     jobid2log : dict
         dictionary log containing {jobid: batch_cmd} information
     jobids_r0_dl1
-        A list of all the jobs sent for input dir
+        A list of all the jobs sent for input dir. Empty if there was nothing to process.
     """
     log.info(f'\nStarting R0 to DL1 processing for files in dir : {input_dir}')
     if workflow_kind == "lstchain":
         base_cmd = f"lstmcpipe_lst_core_r0_dl1 -c {config_file} "
         jobtype_id = "LST"
+        if n_workers:
+            base_cmd += f"--n-workers {n_workers} "
+            extra_slurm_options = {'cpus-per-task': n_workers, **(extra_slurm_options or {})}
     elif workflow_kind == "ctapipe":
         base_cmd = f"lstmcpipe_cta_core_r0_dl1 -c {config_file} "
         jobtype_id = "CTA"
@@ -145,6 +202,9 @@ def r0_to_dl1(
             base_cmd += " --keep_rta_file"
         if debug_mode:
             base_cmd += " --debug_mode"
+        if n_workers:
+            base_cmd += f" --n-hiperta {n_workers} --n-reorganizers {n_workers} "
+            extra_slurm_options = {'cpus-per-task': 2 * n_workers, **(extra_slurm_options or {})}
         jobtype_id = "RTA"
     else:
         base_cmd = ''
@@ -153,33 +213,45 @@ def r0_to_dl1(
         exit(-1)
     raw_files_list = get_input_filelist(input_dir, glob_pattern="*.simtel.gz")
     dl1_files_per_job = 20 if len(raw_files_list) < 50 else 50
-    with open("r0_to_dl1.list", "w+") as newfile:
-        for f in raw_files_list:
-            newfile.write(f)
-            newfile.write("\n")
     log.info(f"{len(raw_files_list)} raw R0 files")
     output_dir = Path(output_dir)
-    if output_dir.exists() and any(output_dir.iterdir()):
-        shutil.rmtree(output_dir)
+    if resume:
+        files_to_process = select_files_to_process(raw_files_list, output_dir, workflow_kind, "r0_to_dl1")
+        log.info(f"{len(raw_files_list) - len(files_to_process)} complete DL1 files kept in {output_dir}")
+    else:
+        files_to_process = raw_files_list
+        if output_dir.exists() and any(output_dir.iterdir()):
+            shutil.rmtree(output_dir)
     job_logs_dir = output_dir.joinpath("job_logs_r0dl1")
     Path(job_logs_dir).mkdir(exist_ok=True, parents=True)
+    with open(job_logs_dir.joinpath("r0_to_dl1.list"), "w+") as newfile:
+        for f in raw_files_list:
+            newfile.write(f)
+            newfile.write("\n")
     log.info(f"DL1 DATA DIR: {output_dir}")
+    restored, cache_spec = restore_stage(
+        batch_config, "r0_to_dl1", raw_files_list, [output_dir], base_cmd, config_files=[config_file]
+    )
+    if restored or not files_to_process:
+        return {}, ""
     jobid2log, jobids_r0_dl1 = submit_dl1_jobs(
         input_dir,
         output_dir,
-        base_cmd=base_cmd,
-        file_list=raw_files_list,
+        # staging does not change the outputs, it is not part of the cached command
+        base_cmd=base_cmd + dl1_staging_options(batch_config),
+        file_list=files_to_process,
         job_type_id=jobtype_id,
         dl1_files_per_batched_job=dl1_files_per_job,
         job_logs_dir=job_logs_dir,
         batch_config=batch_config,
         dl1_processing_type="r0_to_dl1",
         extra_slurm_options=extra_slurm_options,
+        target_bytes_per_job=target_bytes_per_job,
+        cache_spec=cache_spec,
     )
 
     if config_file is not None:
         shutil.copyfile(config_file, job_logs_dir.joinpath(Path(config_file).name))
-    shutil.move("r0_to_dl1.list", job_logs_dir)
     return jobid2log, jobids_r0_dl1
 
 
@@ -191,6 +263,8 @@ def reprocess_dl1(
     batch_config=None,
     dl1_files_per_job=50,
     extra_slurm_options=None,
+    target_bytes_per_job=None,
+    resume=False,
 ):
     """
     Reprocessing of existing dl1 files.
@@ -215,13 +289,19 @@ def reprocess_dl1(
         Number of dl1 files to be processed per job array that was batched.
     extra_slurm_options: dict
         Extra slurm options to be passed to the sbatch command
+    target_bytes_per_job: int or None
+        If given, input files are packed into sublists of about this many bytes.
+        Otherwise, the number of sublists is set from `dl1_files_per_job`.
+    resume: bool
+        If True, complete dl1 files already in the output directory are kept and only the missing or corrupted
+        ones are processed.
 
     Returns
     -------
     jobid2log : dict
         dictionary log containing {jobid: batch_cmd} information
     jobids_dl1_dl1
-        A list of all the jobs sent for input dir
+        A list of all the jobs sent for input dir. Empty if there was nothing to process.
     """
     log.info(f"Applying DL1ab on DL1 files in {input_dir}")
     if workflow_kind == "lstchain":
@@ -239,30 +319,41 @@ def reprocess_dl1(
     dl1ab_filelist = [file.resolve().as_posix() for file in Path(input_dir).glob("*.h5")]
 
     log.info(f"{len(dl1ab_filelist)} DL1 files")
-    with open("dl1ab.list", "w+") as newfile:
-        for f in dl1ab_filelist:
-            newfile.write(f)
-            newfile.write("\n")
     Path(output_dir).mkdir(exist_ok=True, parents=True)
     job_logs_dir = Path(output_dir).joinpath("job_logs_dl1ab")
     Path(job_logs_dir).mkdir(exist_ok=True)
+    with open(job_logs_dir.joinpath("dl1ab.list"), "w+") as newfile:
+        for f in dl1ab_filelist:
+            newfile.write(f)
+            newfile.write("\n")
     log.info(f"DL1ab destination DATA DIR: {output_dir}")
+    files_to_process = dl1ab_filelist
+    if resume:
+        files_to_process = select_files_to_process(dl1ab_filelist, output_dir, workflow_kind, "dl1ab")
+        log.info(f"{len(dl1ab_filelist) - len(files_to_process)} complete DL1 files kept in {output_dir}")
+    restored, cache_spec = restore_stage(
+        batch_config, "dl1ab", dl1ab_filelist, [output_dir], base_cmd, config_files=[config_file]
+    )
+    if restored or not files_to_process:
+        return {}, ""
     jobid2log, jobids_dl1_dl1 = submit_dl1_jobs(
         input_dir,
         output_dir,
-        base_cmd=base_cmd,
-        file_list=dl1ab_filelist,
+        # staging does not change the outputs, it is not part of the cached command
+        base_cmd=base_cmd + dl1_staging_options(batch_config),
+        file_list=files_to_process,
         job_type_id=jobtype_id,
         dl1_files_per_batched_job=dl1_files_per_job,
         job_logs_dir=job_logs_dir,
         batch_config=batch_config,
         dl1_processing_type="dl1ab",
         extra_slurm_options=extra_slurm_options,
+        target_bytes_per_job=target_bytes_per_job,
+        cache_spec=cache_spec,
     )
 
     if config_file is not None:
         shutil.copyfile(config_file, job_logs_dir.joinpath(Path(config_file).name))
-    shutil.move("dl1ab.list", job_logs_dir)
     return jobid2log, jobids_dl1_dl1
 
 
@@ -278,6 +369,8 @@ def submit_dl1_jobs(
     n_jobs_parallel=100,
     dl1_processing_type="r0_to_dl1",
     extra_slurm_options=None,
+    target_bytes_per_job=None,
+    cache_spec=None,
 ):
     """
     Compose sbatch command and batches it
@@ -309,6 +402,12 @@ def submit_dl1_jobs(
         String for job and filelist naming
     extra_slurm_options: dict
         Extra slurm options to be passed
+    target_bytes_per_job: int or None
+        If given, the number of sublists is set so that each one holds about this many bytes of input files.
+        Otherwise, it is set from `dl1_files_per_batched_job`.
+        In both cases, files are distributed so that sublists have balanced total sizes.
+    cache_spec: dict or None
+        Stage spec returned by `lstmcpipe.io.stage_cache.restore_stage` to store the outputs in the stage cache.
 
     Returns
     -------
@@ -316,21 +415,30 @@ def submit_dl1_jobs(
     jobid: str
 
     """
-    number_of_sublists = len(file_list) // dl1_files_per_batched_job + int(
-        len(file_list) % dl1_files_per_batched_job > 0
-    )
+    file_sizes = get_file_sizes(file_list)
+    if target_bytes_per_job:
+        number_of_sublists = -(-sum(file_sizes) // int(target_bytes_per_job))
+    else:
+        number_of_sublists = -(-len(file_list) // dl1_files_per_batched_job)
+    sublists = pack_files_by_size(file_list, file_sizes, number_of_sublists)
+
+    # sublists from a previous submission in the same directory must not be picked up again
+    for old_sublist in Path(job_logs_dir).glob(f"{dl1_processing_type}_*.sublist"):
+        old_sublist.unlink()
 
-    for i in range(number_of_sublists):
+    sublist_names = []
+    for i, sublist in enumerate(sublists):
         output_file = job_logs_dir.joinpath(f"{dl1_processing_type}_{i}.sublist").resolve().as_posix()
 
         with open(output_file, "w+") as out:
-            for line in file_list[i * dl1_files_per_batched_job:dl1_files_per_batched_job * (i + 1)]:
+            for line in sublist:
                 out.write(line)
                 out.write("\n")
-    log.info(f"{number_of_sublists} files generated for list of files at {input_dir}")
+        sublist_names.append(output_file)
+    log.info(f"{len(sublists)} files generated for list of files at {input_dir}")
 
-    sublist_names = [f.as_posix() for f in Path(job_logs_dir).glob("*.sublist")]
     cmd = f'{base_cmd} -f {" ".join(sublist_names)} --output_dir {output_dir}'
+    cmd = cached_command(batch_config, cache_spec, cmd, task_ids=range(len(sublist_names)))
     extra_slurm_default_options = {'partition': 'long', 'array': f"0-{len(sublist_names) - 1}%{n_jobs_parallel}"}
 
     if extra_slurm_options is not None:
@@ -343,6 +451,7 @@ def submit_dl1_jobs(
         slurm_output=job_logs_dir.joinpath("job_%A_%a.o").as_posix(),
         slurm_account=batch_config["slurm_account"],
         source_environment=batch_config["source_environment"],
+        executor=get_executor(batch_config),
         extra_slurm_options=extra_slurm_default_options,
     )
 
@@ -350,3 +459,174 @@ def submit_dl1_jobs(
     log.debug(f"Submitted batch job {jobid}")
     jobid2log = {jobid: sbatch_process_dl1.slurm_command}
     return jobid2log, jobid
+
+
+def dl1_target_bytes_per_job(batch_config, dl1_processing_type="r0_to_dl1"):
+    """
+    Target amount of input data per dl1 array task, from the `dl1_target_job_duration` (slurm time format)
+    and `dl1_throughput_MBps` (processing throughput in MB of input per second) entries of the batch config.
+    dl1ab processes dl1 files at a different rate and uses the `dl1ab_throughput_MBps` entry instead.
+    It keeps the splitting by number of files when this entry is not set.
+
+    Parameters
+    ----------
+    batch_config: dict
+    dl1_processing_type: str
+        `r0_to_dl1` or `dl1ab`
+
+    Returns
+    -------
+    int or None: None if no target duration (or no dl1ab throughput) is set
+    """
+    duration = batch_config.get("dl1_target_job_duration")
+    if not duration:
+        return None
+    if dl1_processing_type == "dl1ab":
+        throughput = batch_config.get("dl1ab_throughput_MBps")
+        if not throughput:
+            return None
+        throughput = float(throughput)
+    else:
+        throughput = float(batch_config.get("dl1_throughput_MBps") or DEFAULT_DL1_THROUGHPUT_MBPS)
+    return int(slurm_time_to_seconds(duration) * throughput * 1e6)
+
+
+def dl1_staging_options(batch_config):
+    """
+    Options of the core scripts enabling the node-local scratch staging (`dl1_scratch_staging` and `dl1_scratch_dir`
+    entries of the batch config), the write-behind of the outputs (`dl1_write_behind`) and the prefetch of the next
+    files (`dl1_prefetch_depth` and `dl1_prefetch_max_gb`), see `lstmcpipe.io.staging`
+    """
+    batch_config = batch_config or {}
+    options = ""
+    if batch_config.get("dl1_scratch_staging"):
+        options += "--scratch-staging "
+    if batch_config.get("dl1_write_behind"):
+        options += "--write-behind "
+    if options and batch_config.get("dl1_scratch_dir"):
+        options += f"--scratch-dir {batch_config['dl1_scratch_dir']} "
+    if batch_config.get("dl1_prefetch_depth"):
+        options += f"--prefetch-depth {batch_config['dl1_prefetch_depth']} "
+        if batch_config.get("dl1_prefetch_max_gb"):
+            options += f"--prefetch-max-gb {batch_config['dl1_prefetch_max_gb']} "
+    return options
+
+
+def get_file_sizes(file_list, n_threads=16):
+    """
+    Sizes of the files in bytes. Stat calls are run in a thread pool as they are latency-bound on shared filesystems.
+    """
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        return list(pool.map(os.path.getsize, file_list))
+
+
+def pack_files_by_size(file_list, file_sizes, n_sublists):
+    """
+    Distribute files in `n_sublists` sublists with balanced total sizes.
+    Largest files are placed first, each in the currently smallest sublist (LPT scheduling).
+    Sublists keep the original order of the files and empty sublists are dropped.
+
+    Parameters
+    ----------
+    file_list: list of str
+    file_sizes: list of int
+    n_sublists: int
+
+    Returns
+    -------
+    list of lists of str
+    """
+    n_sublists = max(1, min(int(n_sublists), len(file_list)))
+    bins = [(0, i) for i in range(n_sublists)]
+    assignment = [[] for _ in range(n_sublists)]
+    for index in sorted(range(len(file_list)), key=lambda i: file_sizes[i], reverse=True):
+        total, bin_index = heapq.heappop(bins)
+        assignment[bin_index].append(index)
+        heapq.heappush(bins, (total + file_sizes[index], bin_index))
+
+    return [[file_list[i] for i in sorted(indices)] for indices in assignment if indices]
+
+
+# minimum size of a dl1 file to be considered complete when resuming
+DL1_MIN_SIZE_BYTES = 10_000
+
+# nodes and root attributes written at the end of the processing of a file: the parameters are written early, a file
+# of a killed job would be considered complete with them only.
+# The simulated energy histogram is written last by lstchain and hiperta r0_to_dl1 and by ctapipe-stage1,
+# the metadata are written last by lstchain_dl1ab.
+DL1_COMPLETE_MARKERS = {
+    "lstchain": (["/dl1/event/telescope/parameters", "/simulation/thrown_event_distribution"], []),
+    "hiperta": (["/dl1/event/telescope/parameters", "/simulation/thrown_event_distribution"], []),
+    "ctapipe": (["/dl1/event/telescope/parameters", "/simulation/service/shower_distribution"], []),
+    "dl1ab": (["/dl1/event/telescope/parameters"], ["LSTCHAIN_VERSION"]),
+}
+
+
+def dl1_output_filename(input_file, output_dir, workflow_kind="lstchain", dl1_processing_type="r0_to_dl1"):
+    """
+    Name of the dl1 file produced by the core scripts (`script_batch_filelist_*`) for an input file.
+
+    Parameters
+    ----------
+    input_file: str or Path
+    output_dir: str or Path
+    workflow_kind: str
+    dl1_processing_type: str
+        `r0_to_dl1` or `dl1ab`
+
+    Returns
+    -------
+    Path
+    """
+    name = Path(input_file).name
+    if dl1_processing_type == "dl1ab":
+        return Path(output_dir, name)
+    if workflow_kind == "lstchain":
+        return Path(output_dir, "dl1_" + name.replace(".simtel.gz", ".h5"))
+    elif workflow_kind == "ctapipe":
+        return Path(output_dir, name.replace(".simtel.gz", ".dl1.h5"))
+    elif workflow_kind == "hiperta":
+        return Path(output_dir, "dl1v06_reorganized_" + name)
+    else:
+        raise ValueError(f"Unknown workflow {workflow_kind}")
+
+
+def select_files_to_process(
+    file_list, output_dir, workflow_kind="lstchain", dl1_processing_type="r0_to_dl1", min_size=DL1_MIN_SIZE_BYTES
+):
+    """
+    Select the input files whose dl1 output is missing or incomplete in output_dir.
+    Incomplete outputs are removed so that they can be produced again.
+
+    Parameters
+    ----------
+    file_list: list of str
+    output_dir: str or Path
+    workflow_kind: str
+    dl1_processing_type: str
+    min_size: int
+        Minimum size in bytes of a complete dl1 file
+
+    Returns
+    -------
+    list of str
+    """
+    outputs = [dl1_output_filename(f, output_dir, workflow_kind, dl1_processing_type) for f in file_list]
+    nodes, attrs = DL1_COMPLETE_MARKERS["dl1ab" if dl1_processing_type == "dl1ab" else workflow_kind]
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        complete = list(
+            pool.map(
+                lambda out: is_complete_hdf5_file(out, nodes, min_size=min_size, required_attrs=attrs),
+                outputs,
+            )
+        )
+
+    files_to_process = []
+    for file, output, is_complete in zip(file_list, outputs, complete):
+        if is_complete:
+            continue
+        if output.exists():
+            log.info(f"Removing incomplete dl1 file {output}")
+            output.unlink()
+        files_to_process.append(file)
+    return files_to_process
@@ -3,14 +3,18 @@
 import shutil
 import logging
 from pathlib import Path
-from ..utils import save_log_to_file, SbatchLstMCStage
+from ..utils import save_logs, SbatchLstMCStage, map_submissions
+from ..dag import JobDag
+from ..executors import get_executor
 from ..io.data_management import check_and_make_dir_without_verification
+from ..io.stage_cache import restore_stage, cached_command
+from ..io.resource_history import learned_slurm_options
 
 
 log = logging.getLogger(__name__)
 
 
-def batch_train_pipe(dict_paths, jobids_from_merge, config_file, batch_config, logs):
+def batch_train_pipe(dict_paths, jobids_from_merge, config_file, batch_config, logs, dag=None):
     """
     Function to batch the lstchain train_pipe once the proton and gamma-diffuse merge_and_copy_dl1 batched jobs have
     finished.
@@ -24,11 +28,14 @@ def batch_train_pipe(dict_paths, jobids_from_merge, config_file, batch_config, l
     jobids_from_merge : str
         string containing the jobids (***ONLY from proton and gamma-diffuse***) from the jobs batched in the
          merge_and_copy_dl1 stage, to be passed to the train_pipe function (as a slurm dependency)
+         if the jobs producing the training files are not in the dag
     batch_config : dict
         Dictionary containing the (full) source_environment and the slurm_account strings to be passed to
         the `train_pipe` function.
     logs: dict
         Dictionary with logs files
+    dag: `lstmcpipe.dag.JobDag` or None
+        Jobs of the production. Each training only waits for the jobs producing its training files.
 
     Returns
     -------
@@ -42,33 +49,39 @@ def batch_train_pipe(dict_paths, jobids_from_merge, config_file, batch_config, l
 
     log.info("==== START {} ====".format("batch mc_train_workflow"))
 
-    for paths in dict_paths:
-
-        gamma_dl1_train_file = paths["input"]["gamma"]
-        proton_dl1_train_file = paths["input"]["proton"]
-        models_dir = paths["output"]
-
-        job_logs, jobid = train_pipe(
-            gamma_dl1_train_file,
-            proton_dl1_train_file,
-            models_dir,
+    dag = JobDag() if dag is None else dag
+    dependencies = [dag.dependencies(paths["input"], barrier=jobids_from_merge) for paths in dict_paths]
+    submissions = map_submissions(
+        lambda paths, wait_jobs: train_pipe(
+            paths["input"]["gamma"],
+            paths["input"]["proton"],
+            paths["output"],
             config_file=config_file,
             batch_configuration=batch_config,
-            wait_jobs_dl1=jobids_from_merge,
+            wait_jobs_dl1=wait_jobs,
             extra_slurm_options=paths.get("extra_slurm_options", None),
-        )
+        ),
+        dict_paths,
+        batch_config,
+        dependencies,
+    )
+    for paths, wait_jobs, (job_logs, jobid) in zip(dict_paths, dependencies, submissions):
+        models_dir = paths["output"]
+        dag.add("train_pipe", paths["input"], models_dir, jobid)
 
+        if not jobid:
+            debug_train[f"**CACHED** {models_dir}"] = "restored from the stage cache"
+            continue
         log_train.update(job_logs)
         jobid_for_dl1_to_dl2.append(jobid)
 
         debug_train[jobid] = (
-            f"The single jobid from train_pipe that depends of {jobids_from_merge} - merge" f"_and_copy jobids"
+            f"The single jobid from train_pipe that depends of {wait_jobs} - merge" f"_and_copy jobids"
         )
 
     jobid_for_dl1_to_dl2 = ",".join(jobid_for_dl1_to_dl2)
 
-    save_log_to_file(log_train, logs["log_file"], workflow_step="train_pipe")
-    save_log_to_file(debug_train, logs["debug_file"], workflow_step="train_pipe")
+    save_logs(logs, "train_pipe", log_train, debug_train)
 
     log.info("==== END batch mc_train_workflow ====")
 
@@ -81,6 +94,7 @@ def batch_plot_rf_features(
     batch_configuration,
     train_jobid,
     logs,
+    dag=None,
 ):
     """
     Batches the plot_model_importance.py script that creates a .png with the RF feature's importance models
@@ -99,6 +113,8 @@ def batch_plot_rf_features(
         Single jobid from training stage.
     logs: dict
         Dictionary with logs files
+    dag: `lstmcpipe.dag.JobDag` or None
+        Jobs of the production. Each plot only waits for the training of its models.
 
     Returns
     -------
@@ -111,6 +127,7 @@ def batch_plot_rf_features(
 
     log.info("==== START {} ====".format("batch plot RF features importance"))
 
+    dag = JobDag() if dag is None else dag
     for path in dict_paths:
         models_dir = path["output"]
 
@@ -121,9 +138,10 @@ def batch_plot_rf_features(
             wrap_command=cmd,
             slurm_error=Path(models_dir).joinpath("job_plot_rf_feat_importance_%j.e").resolve().as_posix(),
             slurm_output=Path(models_dir).joinpath(models_dir, "job_plot_rf_feat_importance_%j.o").resolve().as_posix(),
-            slurm_dependencies=train_jobid,
+            slurm_dependencies=dag.dependencies(models_dir, barrier=train_jobid),
             slurm_account=batch_configuration["slurm_account"],
             source_environment=batch_configuration["source_environment"],
+            executor=get_executor(batch_configuration),
             backend="export MPLBACKEND=Agg;",
         )
 
@@ -135,8 +153,7 @@ def batch_plot_rf_features(
 
     all_jobs_plot_rf_feat = ','.join(all_jobs_plot_rf_feat)
 
-    save_log_to_file(log_rf_feat, logs["log_file"], workflow_step="plot_RF_features_importance")
-    save_log_to_file(log_debug, logs["debug_file"], workflow_step="plot_RF_features_importance")
+    save_logs(logs, "plot_RF_features_importance", log_rf_feat, log_debug)
 
     log.info(" Random Forest importance's plot will be saved at: {}".format(models_dir))
     log.info("==== END {} ====".format("batch plot RF features importance"))
@@ -184,7 +201,7 @@ def train_pipe(
 
     jobid_train : str
         jobid of the batched job to be send (for dependencies purposes) to the next stage of the
-        workflow (onsite_mc_dl1_to_dl2)
+        workflow (onsite_mc_dl1_to_dl2). Empty if the models were restored from the stage cache.
     """
     log_train = {}
 
@@ -195,6 +212,20 @@ def train_pipe(
     if config_file is not None:
         cmd = cmd + " -c {}".format(config_file)
 
+    restored, cache_spec = restore_stage(
+        batch_configuration,
+        "train_pipe",
+        [gamma_dl1_train_file, proton_dl1_train_file],
+        [models_dir],
+        cmd,
+        config_files=[config_file],
+        dependencies=wait_jobs_dl1,
+    )
+    if restored:
+        log.info(f"Models in {models_dir} restored from the stage cache")
+        return log_train, ""
+    cmd = cached_command(batch_configuration, cache_spec, cmd)
+
     sbatch_train_pipe = SbatchLstMCStage(
         "train_pipe",
         wrap_command=cmd,
@@ -204,6 +235,10 @@ def train_pipe(
         extra_slurm_options=extra_slurm_options,
         slurm_account=batch_configuration["slurm_account"],
         source_environment=batch_configuration["source_environment"],
+        executor=get_executor(batch_configuration),
+        resource_options=learned_slurm_options(
+            batch_configuration, "train_pipe", [gamma_dl1_train_file, proton_dl1_train_file]
+        ),
     )
 
     jobid_train = sbatch_train_pipe.submit()
@@ -3,7 +3,10 @@
 import shutil
 import logging
 from pathlib import Path
-from ..utils import save_log_to_file, SbatchLstMCStage
+from ..utils import save_logs, SbatchLstMCStage, map_submissions
+from ..dag import JobDag
+from ..executors import get_executor
+from ..io.stage_cache import restore_stage, cached_command
 
 log = logging.getLogger(__name__)
 
@@ -13,6 +16,7 @@ def batch_train_test_splitting(
     jobids_from_r0dl1,
     batch_config,
     logs,
+    dag=None,
 ):
     """
 
@@ -20,11 +24,14 @@ def batch_train_test_splitting(
     ----------
     dict_paths: dict
     jobids_from_r0dl1: str
+        Jobs to wait for if the jobs producing the files to split are not in the dag
     batch_config: dict
         Dictionary containing the (full) source_environment and the slurm_account strings to be passed
         to `merge_dl1` and `compose_batch_command_of_script` functions.
     logs: dict
         Dictionary with logs files
+    dag: `lstmcpipe.dag.JobDag` or None
+        Jobs of the production. Each split only waits for the jobs producing its input files.
 
     Returns
     -------
@@ -36,23 +43,32 @@ def batch_train_test_splitting(
 
     log.info("==== START {} ====".format("batch train_test_splitting"))
 
-    for paths in dict_paths:
-        job_logs, jobid = train_test_split(
+    dag = JobDag() if dag is None else dag
+    dependencies = [dag.dependencies(paths["input"], barrier=jobids_from_r0dl1) for paths in dict_paths]
+    submissions = map_submissions(
+        lambda paths, wait_jobs: train_test_split(
             paths["input"],
             paths["output"],
-            wait_jobid_r0_dl1=jobids_from_r0dl1,
+            wait_jobid_r0_dl1=wait_jobs,
             batch_configuration=batch_config,
             extra_slurm_options=paths.get("extra_slurm_options", None),
-        )
-
+        ),
+        dict_paths,
+        batch_config,
+        dependencies,
+    )
+    for paths, wait_jobs, (job_logs, jobid) in zip(dict_paths, dependencies, submissions):
+        dag.add("train_test_split", paths["input"], paths["output"], jobid)
+        if not jobid:
+            debug_log[f'**CACHED** {paths["output"]}'] = 'restored from the stage cache'
+            continue
         log_splitting.update(job_logs)
         jobids_for_merging.append(jobid)
-        debug_log[jobid] = f"Train test splitting jobid that depends on : {jobids_from_r0dl1}"
+        debug_log[jobid] = f"Train test splitting jobid that depends on : {wait_jobs}"
 
     jobids_for_merging = ",".join(jobids_for_merging)
 
-    save_log_to_file(log_splitting, logs["log_file"], workflow_step="dl1_to_dl2")
-    save_log_to_file(debug_log, logs["debug_file"], workflow_step="dl1_to_dl2")
+    save_logs(logs, "train_test_split", log_splitting, debug_log)
 
     log.info("==== END {} ====".format("batch train_test_splitting"))
 
@@ -96,16 +112,20 @@ def train_test_split(
     train_dir.mkdir(exist_ok=True, parents=True)
     test_dir.mkdir(exist_ok=True, parents=True)
 
-    # tt ratio
-    if "ratio" not in output_dirs:
-        ratio = 0.5
-    else:
-        ratio = output_dirs["ratio"]
+    cmd = train_test_split_command(input_dir, output_dirs)
 
-    cmd = (
-        f"lstmcpipe_train_test_split -i {input_dir} --otest {test_dir}"
-        f" --otrain {train_dir} -r {ratio} -l {test_dir.parent}"
+    restored, cache_spec = restore_stage(
+        batch_configuration,
+        "train_test_splitting",
+        [input_dir],
+        [train_dir, test_dir],
+        cmd,
+        dependencies=wait_jobid_r0_dl1,
     )
+    if restored:
+        log.info(f"\nTraining {train_dir} and testing {test_dir} dirs restored from the stage cache.")
+        return log_splitting, ""
+    cmd = cached_command(batch_configuration, cache_spec, cmd)
 
     sbatch_tt_splitting = SbatchLstMCStage(
         "train_test_splitting",
@@ -116,6 +136,7 @@ def train_test_split(
         extra_slurm_options=extra_slurm_options,
         slurm_account=batch_configuration["slurm_account"],
         source_environment=batch_configuration["source_environment"],
+        executor=get_executor(batch_configuration),
     )
 
     jobid_split = sbatch_tt_splitting.submit()
@@ -127,6 +148,97 @@ def train_test_split(
     return log_splitting, jobid_split
 
 
+def train_test_split_command(input_dir, output_dirs, virtual=False):
+    """
+    Compose the command splitting the files of a directory.
+
+    Parameters
+    ----------
+    input_dir: str
+    output_dirs: dict
+        with `train`, `test` and optionally `ratio` (fraction of test runs, 0.5 by default) entries
+    virtual: bool
+        If True, only the training and testing filelists are written, the files are not moved
+
+    Returns
+    -------
+    cmd: str
+    """
+    input_dir = Path(input_dir).resolve()
+    test_dir = Path(output_dirs["test"]).resolve()
+    train_dir = Path(output_dirs["train"]).resolve()
+    ratio = output_dirs.get("ratio", 0.5)
+    cmd = (
+        f"lstmcpipe_train_test_split -i {input_dir} --otest {test_dir}"
+        f" --otrain {train_dir} -r {ratio} -l {test_dir.parent}"
+    )
+    if virtual:
+        cmd += " --virtual"
+    return cmd
+
+
+def virtual_split(dict_paths, merge_paths=None):
+    """
+    Virtual train/test split: instead of moving the files, the merging jobs write the training and testing filelists
+    (the split is deterministic) and merge the files of their list.
+
+    Parameters
+    ----------
+    dict_paths: list of dict
+        paths of the `train_test_split` stage
+    merge_paths: list of dict or None
+        paths of the `merge_dl1` stage. If given, only the splits whose train and test dirs are both merged directly
+        are virtual, the other ones must be run (see `physical_split_paths`).
+        Splits sharing their train or test dir with another split (e.g. several gamma offsets split into the same
+        dirs) are never virtual: the merge of a shared dir includes the files of all of them.
+
+    Returns
+    -------
+    dict: {train or test dir: {"input": dir of the files to split, "cmd": split command, "filelist": filelist}}
+    """
+    merge_inputs = None if merge_paths is None else {Path(paths["input"]).resolve().as_posix() for paths in merge_paths}
+    output_dirs = [
+        {Path(paths["output"][dataset]).resolve().as_posix() for dataset in ["train", "test"]} for paths in dict_paths
+    ]
+    n_splits = {}
+    for dirs in output_dirs:
+        for directory in dirs:
+            n_splits[directory] = n_splits.get(directory, 0) + 1
+    split = {}
+    for paths, dirs in zip(dict_paths, output_dirs):
+        if merge_inputs is not None and not dirs <= merge_inputs:
+            continue
+        if any(n_splits[directory] > 1 for directory in dirs):
+            continue
+        cmd = train_test_split_command(paths["input"], paths["output"], virtual=True)
+        list_dir = Path(paths["output"]["test"]).resolve().parent
+        for dataset, filelist in [("train", "training.list"), ("test", "testing.list")]:
+            split[Path(paths["output"][dataset]).resolve().as_posix()] = {
+                "input": Path(paths["input"]).resolve().as_posix(),
+                "cmd": cmd,
+                "filelist": list_dir.joinpath(filelist).as_posix(),
+            }
+    return split
+
+
+def physical_split_paths(dict_paths, split):
+    """
+    Entries of the `train_test_split` stage that are not part of a virtual split and must be run
+
+    Parameters
+    ----------
+    dict_paths: list of dict
+        paths of the `train_test_split` stage
+    split: dict
+        as returned by `virtual_split`
+
+    Returns
+    -------
+    list of dict
+    """
+    return [paths for paths in dict_paths if Path(paths["output"]["train"]).resolve().as_posix() not in split]
+
+
 def check_empty_dir(directory):
     """
     Check if a directory is empty. If not, erase all its content.
@@ -0,0 +1,161 @@
+from pathlib import Path
+
+from lstmcpipe.stages.mc_merge_dl1 import batch_merge_dl1
+
+
+def test_batch_merge_dl1_array(tmp_path, monkeypatch):
+    submitted = []
+
+    def fake_run_command(cmd):
+        submitted.append(cmd)
+        return "1234"
+
+    monkeypatch.setattr("lstmcpipe.utils.run_command", fake_run_command)
+    logs = {"log_file": tmp_path / "log.yml", "debug_file": tmp_path / "debug.yml"}
+    batch_config = {"source_environment": "", "slurm_account": "", "array_stages": ["merge_dl1"]}
+    dict_paths = [
+        {"input": (tmp_path / f"dl1_{particle}").as_posix(), "output": (tmp_path / f"{particle}.h5").as_posix()}
+        for particle in ["gamma", "proton", "electron"]
+    ]
+
+    jobids = batch_merge_dl1(dict_paths, batch_config, logs, jobid_from_splitting="12,13")
+
+    assert jobids == "1234"
+    assert len(submitted) == 1
+    assert "--array=0-2%100" in submitted[0]
+    assert "--dependency=afterok:12:13" in submitted[0]
+    manifest = Path(submitted[0].split("lstmcpipe_run_manifest ")[1].split()[0])
+    assert manifest.parent == tmp_path / "job_arrays"
+    assert [line.split()[-1] for line in manifest.read_text().splitlines()] == [p["output"] for p in dict_paths]
+
+
+def test_batch_merge_dl1_array_dependencies(tmp_path, monkeypatch):
+    from lstmcpipe.dag import JobDag
+
+    submitted = []
+
+    def fake_run_command(cmd):
+        submitted.append(cmd)
+        return str(1234 + len(submitted))
+
+    monkeypatch.setattr("lstmcpipe.utils.run_command", fake_run_command)
+    logs = {"log_file": tmp_path / "log.yml", "debug_file": tmp_path / "debug.yml"}
+    batch_config = {"source_environment": "", "slurm_account": "", "array_stages": ["merge_dl1"]}
+    dict_paths = [
+        {"input": (tmp_path / f"dl1_{particle}").as_posix(), "output": (tmp_path / f"{particle}.h5").as_posix()}
+        for particle in ["gamma", "proton", "electron"]
+    ]
+    dag = JobDag()
+    dag.add("r0_to_dl1", tmp_path / "r0_gamma", dict_paths[0]["input"], "21")
+    dag.add("r0_to_dl1", tmp_path / "r0_proton", dict_paths[1]["input"], "22")
+    dag.add("r0_to_dl1", tmp_path / "r0_electron", dict_paths[2]["input"], "21")
+
+    jobids = batch_merge_dl1(dict_paths, batch_config, logs, jobid_from_splitting="12,13", dag=dag)
+
+    # each merging job only waits for its own dl1 files
+    assert jobids == "1235,1236"
+    assert "--array=0-1%100" in submitted[0] and "--dependency=afterok:21 " in submitted[0]
+    assert "--array=0-0%100" in submitted[1] and "--dependency=afterok:22 " in submitted[1]
+    assert [node["jobid"] for node in dag.nodes if node["stage"] == "merge_dl1"] == ["1235_0", "1236_0", "1235_1"]
+
+
+def test_batch_merge_dl1_virtual_split(tmp_path, monkeypatch):
+    from lstmcpipe.stages.mc_train_test_splitting import virtual_split
+
+    submitted = []
+
+    def fake_run_command(cmd):
+        submitted.append(cmd)
+        return str(1234 + len(submitted))
+
+    monkeypatch.setattr("lstmcpipe.utils.run_command", fake_run_command)
+    logs = {"log_file": tmp_path / "log.yml", "debug_file": tmp_path / "debug.yml"}
+    batch_config = {"source_environment": "", "slurm_account": ""}
+    split_paths = [
+        {
+            "input": (tmp_path / "dl1").as_posix(),
+            "output": {"train": (tmp_path / "train").as_posix(), "test": (tmp_path / "test").as_posix(), "ratio": 0.2},
+        }
+    ]
+    dict_paths = [
+        {"input": (tmp_path / dataset).as_posix(), "output": (tmp_path / f"{dataset}.h5").as_posix()}
+        for dataset in ["train", "test"]
+    ]
+
+    jobids = batch_merge_dl1(
+        dict_paths, batch_config, logs, jobid_from_splitting="12", virtual_split=virtual_split(split_paths)
+    )
+
+    assert jobids == "1235,1236"
+    for cmd, dataset, filelist in zip(sorted(submitted), ["test", "train"], ["testing", "training"]):
+        assert f"lstmcpipe_train_test_split -i {tmp_path / 'dl1'}" in cmd
+        assert "-r 0.2" in cmd and "--virtual" in cmd
+        assert f"lstmcpipe_merge_filelist -f {tmp_path / filelist}.list -o {tmp_path / dataset}.h5" in cmd
+        assert "--dependency=afterok:12" in cmd
+
+
+def test_virtual_split_entries(tmp_path):
+    import pytest
+    from lstmcpipe.stages.mc_merge_dl1 import virtual_split_of
+    from lstmcpipe.stages.mc_train_test_splitting import virtual_split, physical_split_paths
+
+    split_paths = [
+        {
+            "input": (tmp_path / particle).as_posix(),
+            "output": {
+                "train": (tmp_path / particle / "train").as_posix(),
+                "test": (tmp_path / particle / "test").as_posix(),
+            },
+        }
+        for particle in ["gamma", "proton"]
+    ]
+    # the gamma train and test dirs are merged, the proton files are merged from their parent dir
+    merge_paths = [
+        {"input": (tmp_path / "gamma" / dataset).as_posix(), "output": (tmp_path / f"{dataset}.h5").as_posix()}
+        for dataset in ["train", "test"]
+    ] + [{"input": (tmp_path / "proton").as_posix(), "output": (tmp_path / "proton.h5").as_posix()}]
+
+    split = virtual_split(split_paths, merge_paths)
+    assert sorted(split) == [(tmp_path / "gamma" / dataset).as_posix() for dataset in ["test", "train"]]
+    # the proton split is run
+    assert physical_split_paths(split_paths, split) == split_paths[1:]
+    assert virtual_split_of(split, tmp_path / "gamma" / "train")["input"] == (tmp_path / "gamma").as_posix()
+    assert virtual_split_of(split, tmp_path / "proton") is None
+
+    # the files of a virtually split dir are not in its parent
+    with pytest.raises(ValueError):
+        virtual_split_of(virtual_split(split_paths), tmp_path / "proton")
+
+
+def test_virtual_split_shared_dirs(tmp_path):
+    from lstmcpipe.stages.mc_train_test_splitting import virtual_split, physical_split_paths
+
+    # two gamma offsets split into the same train and test dirs
+    shared = {"train": (tmp_path / "gamma" / "train").as_posix(), "test": (tmp_path / "gamma" / "test").as_posix()}
+    split_paths = [{"input": (tmp_path / f"gamma_off{offset}").as_posix(), "output": shared} for offset in [0.0, 0.4]]
+    merge_paths = [
+        {"input": shared[dataset], "output": (tmp_path / f"gamma_{dataset}.h5").as_posix()}
+        for dataset in ["train", "test"]
+    ]
+
+    split = virtual_split(split_paths, merge_paths)
+    # both offsets are moved to the shared dirs and merged together
+    assert split == {}
+    assert physical_split_paths(split_paths, split) == split_paths
+
+
+def test_batch_merge_dl1_cached(tmp_path, monkeypatch):
+    saved = {}
+    monkeypatch.setattr("lstmcpipe.stages.mc_merge_dl1.merge_dl1", lambda *args, **kwargs: ({}, ""))
+    monkeypatch.setattr(
+        "lstmcpipe.stages.mc_merge_dl1.save_logs",
+        lambda logs, step, log_dict, debug_log: saved.update(debug_log),
+    )
+    dict_paths = [
+        {"input": (tmp_path / f"dl1_{particle}").as_posix(), "output": (tmp_path / f"{particle}.h5").as_posix()}
+        for particle in ["gamma", "proton"]
+    ]
+
+    assert batch_merge_dl1(dict_paths, {"source_environment": "", "slurm_account": ""}, {}, "") == ""
+    # one entry per output restored from the stage cache
+    assert sorted(saved) == [f"**CACHED** {paths['output']}" for paths in dict_paths]
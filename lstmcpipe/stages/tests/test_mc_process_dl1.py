@@ -0,0 +1,115 @@
+import tables
+
+from lstmcpipe.stages.mc_process_dl1 import (
+    pack_files_by_size,
+    dl1_target_bytes_per_job,
+    dl1_staging_options,
+    get_file_sizes,
+    dl1_output_filename,
+    select_files_to_process,
+    batch_process_dl1,
+)
+
+
+def test_pack_files_by_size():
+    files = [f"file_{i}" for i in range(7)]
+    sizes = [100, 10, 10, 10, 40, 30, 20]
+    sublists = pack_files_by_size(files, sizes, 2)
+
+    assert sorted(sum(sublists, [])) == files
+    totals = [sum(sizes[files.index(f)] for f in sublist) for sublist in sublists]
+    assert totals == [110, 110]
+    # original order is kept inside a sublist
+    for sublist in sublists:
+        assert sublist == sorted(sublist)
+
+    assert len(pack_files_by_size(files, sizes, 20)) == len(files)
+    assert pack_files_by_size(files[:1], sizes[:1], 0) == [files[:1]]
+
+
+def test_get_file_sizes(tmp_path):
+    files = []
+    for i in range(3):
+        f = tmp_path / f"{i}.simtel.gz"
+        f.write_bytes(b"0" * i)
+        files.append(f.as_posix())
+    assert get_file_sizes(files) == [0, 1, 2]
+
+
+def test_dl1_target_bytes_per_job():
+    assert dl1_target_bytes_per_job({}) is None
+    assert dl1_target_bytes_per_job({"dl1_target_job_duration": "01:00:00", "dl1_throughput_MBps": 1}) == 3600e6
+    assert dl1_target_bytes_per_job({"dl1_target_job_duration": "1-00", "dl1_throughput_MBps": 0.5}) == 43200e6
+    # dl1ab does not use the r0 throughput
+    config = {"dl1_target_job_duration": "01:00:00", "dl1_throughput_MBps": 1}
+    assert dl1_target_bytes_per_job(config, "dl1ab") is None
+    assert dl1_target_bytes_per_job(dict(config, dl1ab_throughput_MBps=5), "dl1ab") == 18000e6
+
+
+def test_dl1_staging_options():
+    assert dl1_staging_options(None) == ""
+    assert dl1_staging_options({"dl1_scratch_staging": False, "dl1_scratch_dir": "/scratch"}) == ""
+    assert dl1_staging_options({"dl1_scratch_staging": True}) == "--scratch-staging "
+    assert (
+        dl1_staging_options({"dl1_scratch_staging": True, "dl1_scratch_dir": "/scratch"})
+        == "--scratch-staging --scratch-dir /scratch "
+    )
+    assert (
+        dl1_staging_options({"dl1_write_behind": True, "dl1_scratch_dir": "/scratch"})
+        == "--write-behind --scratch-dir /scratch "
+    )
+    assert (
+        dl1_staging_options({"dl1_prefetch_depth": 2, "dl1_prefetch_max_gb": 10})
+        == "--prefetch-depth 2 --prefetch-max-gb 10 "
+    )
+
+
+def test_dl1_output_filename():
+    simtel = "/data/gamma_run1.simtel.gz"
+    assert dl1_output_filename(simtel, "/out").as_posix() == "/out/dl1_gamma_run1.h5"
+    assert dl1_output_filename(simtel, "/out", "ctapipe").as_posix() == "/out/gamma_run1.dl1.h5"
+    assert dl1_output_filename(simtel, "/out", "hiperta").as_posix() == "/out/dl1v06_reorganized_gamma_run1.simtel.gz"
+    assert dl1_output_filename("/in/dl1_run1.h5", "/out", dl1_processing_type="dl1ab").as_posix() == "/out/dl1_run1.h5"
+
+
+def test_select_files_to_process(tmp_path):
+    files = [(tmp_path / f"gamma_run{i}.simtel.gz").as_posix() for i in range(4)]
+    # complete output for run 0, corrupted output for run 1, nothing for run 2,
+    # output of a killed job for run 3 (parameters written but not the energy histogram)
+    with tables.open_file(tmp_path / "dl1_gamma_run0.h5", mode="w") as file:
+        file.create_group("/dl1/event/telescope", "parameters", createparents=True)
+        file.create_group("/simulation", "thrown_event_distribution", createparents=True)
+    (tmp_path / "dl1_gamma_run1.h5").write_bytes(b"truncated")
+    with tables.open_file(tmp_path / "dl1_gamma_run3.h5", mode="w") as file:
+        file.create_group("/dl1/event/telescope", "parameters", createparents=True)
+
+    assert select_files_to_process(files, tmp_path, min_size=0) == files[1:]
+    assert not (tmp_path / "dl1_gamma_run1.h5").exists()
+    assert not (tmp_path / "dl1_gamma_run3.h5").exists()
+    assert (tmp_path / "dl1_gamma_run0.h5").exists()
+
+    # dl1ab outputs are complete once their metadata are written
+    dl1_files = [(tmp_path / f"dl1_gamma_run{i}.h5").as_posix() for i in [0, 5]]
+    output_dir = tmp_path / "dl1ab"
+    output_dir.mkdir()
+    for name, complete in [("dl1_gamma_run0.h5", True), ("dl1_gamma_run5.h5", False)]:
+        with tables.open_file(output_dir / name, mode="w") as file:
+            file.create_group("/dl1/event/telescope", "parameters", createparents=True)
+            if complete:
+                file.root._v_attrs["LSTCHAIN_VERSION"] = "0.10"
+    assert select_files_to_process(dl1_files, output_dir, dl1_processing_type="dl1ab", min_size=0) == dl1_files[1:]
+
+
+def test_batch_process_dl1_complete_dirs(monkeypatch):
+    saved = {}
+    monkeypatch.setattr("lstmcpipe.stages.mc_process_dl1.check_data_path", lambda path, glob: None)
+    monkeypatch.setattr("lstmcpipe.stages.mc_process_dl1.r0_to_dl1", lambda *args, **kwargs: ({}, ""))
+    monkeypatch.setattr(
+        "lstmcpipe.stages.mc_process_dl1.save_logs",
+        lambda logs, step, log_dict, debug_log: saved.update(debug_log),
+    )
+    dict_paths = {"r0_to_dl1": [{"input": f"/r0/node_{i}", "output": f"/dl1/node_{i}"} for i in range(2)]}
+
+    assert batch_process_dl1(dict_paths, "config.json", {}, {}, resume=True) == ""
+    # one entry per complete directory
+    assert sorted(saved) == ["**COMPLETE_DL1_DIR** /dl1/node_0", "**COMPLETE_DL1_DIR** /dl1/node_1"]
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+# Supervision of a running production.
+# The jobs and array tasks killed by slurm for lack of resources (OUT_OF_MEMORY, TIMEOUT) or because of their node
+# (NODE_FAIL, BOOT_FAIL) are resubmitted with more memory or time, within limits, and the pending jobs waiting for them
+# are made to wait for the resubmitted ones instead. Otherwise, their `afterok` dependencies would never be satisfied
+# and all the downstream stages would stay pending.
+
+import re
+import asyncio
+import logging
+
+from .utils import (
+    run_sbatch,
+    run_command,
+    slurm_time_to_seconds,
+    seconds_to_slurm_time,
+    memory_to_mb,
+    join_jobids,
+    partition_time_limit,
+)
+from .monitor import poll_states, state_category, production_status
+from .io.lstmcpipe_tree_path import update_scancel_file
+
+log = logging.getLogger(__name__)
+
+# slurm state of the failed unit: resource escalated when resubmitting it
+RESUBMIT_STATES = {"OUT_OF_MEMORY": "mem", "TIMEOUT": "time", "NODE_FAIL": None, "BOOT_FAIL": None}
+
+
+class ResourceLimits:
+    """
+    Escalation of the resources of the resubmitted units.
+
+    Parameters
+    ----------
+    mem_factor: float
+        Factor applied to the memory of a unit killed for lack of memory
+    time_factor: float
+        Factor applied to the time limit of a unit killed for lack of time
+    max_mem: str
+        Maximum memory, in slurm format (e.g. `256G`)
+    max_time: str
+        Maximum time limit, in slurm format (e.g. `2-00:00:00`). The time limit is also capped by the maximum time
+        limit of the partition of the job.
+    max_attempts: int
+        Maximum number of resubmissions of a unit
+    default_mem: str
+        Memory of the jobs submitted without `--mem` (default memory of the cluster)
+    default_time: str
+        Time limit of the jobs submitted without `--time` (default time limit of the partition)
+    """
+
+    def __init__(
+        self,
+        mem_factor=2,
+        time_factor=2,
+        max_mem="256G",
+        max_time="7-00:00:00",
+        max_attempts=2,
+        default_mem="4G",
+        default_time="1-00:00:00",
+    ):
+        self.mem_factor = mem_factor
+        self.time_factor = time_factor
+        self.max_mem = memory_to_mb(max_mem)
+        self.max_time = slurm_time_to_seconds(max_time)
+        self.max_attempts = max_attempts
+        self.default_mem = memory_to_mb(default_mem)
+        self.default_time = slurm_time_to_seconds(default_time)
+
+    def escalate(self, command, reason):
+        """
+        Memory (MB) and time limit (s) to resubmit a unit of a job killed with the slurm state `reason`.
+
+        Returns
+        -------
+        (int, int) or None: None if the resource that was lacking is already at its maximum
+        """
+        mem = memory_to_mb(sbatch_option(command, "mem") or f"{self.default_mem}M")
+        time_limit = sbatch_option(command, "time")
+        time_limit = slurm_time_to_seconds(time_limit) if time_limit else self.default_time
+        max_time = self.max_time
+        partition = sbatch_option(command, "partition")
+        if partition and partition_time_limit(partition) is not None:
+            max_time = min(max_time, partition_time_limit(partition))
+        time_limit = min(time_limit, max_time)
+        resource = RESUBMIT_STATES[reason]
+        if resource == "mem":
+            if mem >= self.max_mem:
+                return None
+            mem = min(int(mem * self.mem_factor), self.max_mem)
+        elif resource == "time":
+            if time_limit >= max_time:
+                return None
+            time_limit = min(int(time_limit * self.time_factor), max_time)
+        return mem, time_limit
+
+
+def sbatch_option(command, option):
+    """
+    Value of a `--option=value` of a sbatch command (before its `--wrap`), None if not set
+    """
+    head = command.partition(" --wrap=")[0]
+    match = re.search(rf"--{option}=(\S+)", head)
+    return match.group(1) if match else None
+
+
+def resubmission_command(command, mem, time_limit, tasks=None):
+    """
+    sbatch command to resubmit a job, without its dependencies and with new resources.
+
+    Parameters
+    ----------
+    command: str
+        Original sbatch command
+    mem: int
+        Memory in MB
+    time_limit: int
+        Time limit in seconds
+    tasks: list of int or None
+        Tasks of the array to resubmit, with the same ids so that they run the same commands
+
+    Returns
+    -------
+    str
+    """
+    head, sep, wrap = command.partition(" --wrap=")
+    head = re.sub(r"\s--(dependency|mem|time)=\S+", "", head)
+    options = f"--mem={mem}M --time={seconds_to_slurm_time(time_limit)}"
+    if tasks is not None:
+        array = sbatch_option(command, "array")
+        parallel = f"%{array.split('%')[1]}" if array and "%" in array else ""
+        head = re.sub(r"\s--array=\S+", "", head)
+        options += f" --array={','.join(str(task) for task in tasks)}{parallel}"
+    return f"{head.rstrip()} {options}{sep}{wrap}"
+
+
+def resubmit_failed(db, units, limits=None, scancel_file=None):
+    """
+    Resubmit the failed units that can be resubmitted and rewire the dependencies of the pending jobs waiting for
+    them.
+
+    Parameters
+    ----------
+    db: `lstmcpipe.io.production_db.ProductionDB`
+    units: dict
+        States of the jobs and array tasks, as returned by `lstmcpipe.monitor.poll_states`
+    limits: `ResourceLimits` or None
+    scancel_file: Path or None
+        scancel file of the production, updated with the new jobs
+
+    Returns
+    -------
+    dict: {failed unit: resubmitted unit}
+    """
+    limits = ResourceLimits() if limits is None else limits
+    jobs = {job["jobid"]: job for job in db.jobs()}
+    resubmissions = db.resubmissions()
+    attempts = {row["new"]: row["attempt"] for row in resubmissions.values()}
+
+    # failed units grouped by job and by cause, as the units of an array killed for the same reason get the same
+    # new resources
+    to_resubmit = {}
+    for unit_id, unit in units.items():
+        jobid, _, task = unit_id.partition("_")
+        if unit_id in resubmissions or jobid not in jobs or unit["state"] not in RESUBMIT_STATES:
+            continue
+        if attempts.get(unit_id, 0) >= limits.max_attempts:
+            log.error(f"{unit_id} failed with {unit['state']} after {limits.max_attempts} resubmissions")
+            continue
+        to_resubmit.setdefault((jobid, unit["state"]), []).append(int(task) if task else None)
+
+    replacements = {}
+    for (jobid, reason), tasks in to_resubmit.items():
+        job = jobs[jobid]
+        resources = limits.escalate(job["command"], reason)
+        if resources is None:
+            log.error(
+                f"Job {jobid} ({job['stage']}) failed with {reason} with the maximum resources (of its partition), "
+                "not resubmitted"
+            )
+            continue
+        mem, time_limit = resources
+        is_array = tasks != [None]
+        command = resubmission_command(job["command"], mem, time_limit, tasks=sorted(tasks) if is_array else None)
+        try:
+            new_jobid = run_sbatch(command)
+        except Exception as e:
+            # the other jobs are still resubmitted, this one is tried again at the next poll
+            log.error(f"Job {jobid} ({job['stage']}) could not be resubmitted after {reason}: {e}")
+            continue
+        log.info(f"Job {jobid} ({job['stage']}) resubmitted as {new_jobid} after {reason}: {command}")
+        db.add_jobs(job["stage"], {new_jobid: command})
+        for task in tasks:
+            old = jobid if task is None else f"{jobid}_{task}"
+            new = new_jobid if task is None else f"{new_jobid}_{task}"
+            db.add_resubmission(
+                old, new, reason, attempts.get(old, 0) + 1, f"{mem}M", seconds_to_slurm_time(time_limit)
+            )
+            replacements[old] = new
+        if scancel_file is not None:
+            update_scancel_file(scancel_file, new_jobid)
+
+    if replacements:
+        rewire_dependencies(db, units, replacements)
+    return replacements
+
+
+def rewire_dependencies(db, units, replacements):
+    """
+    Make the pending jobs waiting for replaced units wait for their replacements instead, with `scontrol update`.
+    Dependencies on completed jobs are dropped, as slurm rejects dependencies on jobs it no longer knows.
+
+    Parameters
+    ----------
+    db: `lstmcpipe.io.production_db.ProductionDB`
+    units: dict
+        States of the jobs and array tasks
+    replacements: dict
+        {replaced unit: new unit}
+    """
+    for job in db.jobs():
+        dependencies = [dep for dep in job["dependencies"].split(",") if dep]
+        replaced_array_jobs = {old.partition("_")[0] for old in replacements}
+        if not any(dep in replacements or dep in replaced_array_jobs for dep in dependencies):
+            continue
+        if not is_pending(units, job["jobid"]):
+            continue
+
+        new_dependencies = []
+        for dep in dependencies:
+            if dep in replacements:
+                new_dependencies.append(replacements[dep])
+            elif dep in replaced_array_jobs:
+                # dependency on a whole array: wait for its remaining tasks and for the resubmitted ones
+                new_dependencies.extend(
+                    unit_id
+                    for unit_id, unit in units.items()
+                    if unit_id.partition("_")[0] == dep
+                    and unit_id not in replacements
+                    and state_category(unit["state"]) != "completed"
+                )
+                new_dependencies.extend(new for old, new in replacements.items() if old.partition("_")[0] == dep)
+            elif state_category(units.get(dep, {}).get("state", "PENDING")) != "completed":
+                new_dependencies.append(dep)
+        new_dependencies = join_jobids(*new_dependencies)
+
+        dependency = f"afterok:{new_dependencies.replace(',', ':')}" if new_dependencies else ""
+        run_command(f"scontrol update JobId={job['jobid']} Dependency={dependency}")
+        db.set_dependencies(job["jobid"], new_dependencies)
+        log.info(f"Job {job['jobid']} ({job['stage']}) now depends on {new_dependencies or 'no job'}")
+
+
+def is_pending(units, jobid):
+    """
+    Whether a job (all its array tasks) is pending. Jobs not reported by sacct yet are pending.
+    """
+    states = [unit["state"] for unit_id, unit in units.items() if unit_id.partition("_")[0] == jobid]
+    return all(state_category(state) == "pending" for state in states)
+
+
+async def supervise(db, interval=300, once=False, limits=None, scancel_file=None, max_concurrent=2, chunk_size=200):
+    """
+    Poll the states of the jobs of a production and resubmit the failed units until all the jobs are finished.
+
+    Parameters
+    ----------
+    db: `lstmcpipe.io.production_db.ProductionDB`
+    interval: float
+        Time in seconds between two polls
+    once: bool
+        Poll only once
+    limits: `ResourceLimits` or None
+    scancel_file: Path or None
+    max_concurrent: int
+        Maximum number of sacct calls running at the same time
+    chunk_size: int
+        Number of job ids per sacct call
+
+    Returns
+    -------
+    dict: {failed unit: resubmitted unit} of all the resubmissions
+    """
+    all_replacements = {}
+    while True:
+        units = await poll_states([job["jobid"] for job in db.jobs()], max_concurrent, chunk_size)
+        replacements = resubmit_failed(db, units, limits=limits, scancel_file=scancel_file)
+        all_replacements.update(replacements)
+        status = production_status(db, units)
+        db.set_states(status.job_states())
+        if once or (not replacements and status.report()["finished"]):
+            return all_replacements
+        await asyncio.sleep(interval)
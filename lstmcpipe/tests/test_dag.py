@@ -0,0 +1,65 @@
+from lstmcpipe.dag import JobDag
+from lstmcpipe.utils import join_jobids
+from lstmcpipe.stages.mc_dl1_to_dl2 import batch_dl1_to_dl2
+
+
+def test_join_jobids():
+    assert join_jobids("1,2", "", None, "2,3") == "1,2,3"
+    assert join_jobids("10_1,10_2", "11_0") == "10_1,10_2,11_0"
+    assert join_jobids("10_1", "10", "12") == "10,12"
+
+
+def test_job_dag(tmp_path):
+    dag = JobDag()
+    for pointing in ["dec_1", "dec_2"]:
+        dag.add("r0_to_dl1", tmp_path / "r0" / pointing, tmp_path / "dl1" / pointing, f"r0_{pointing}")
+        dag.add(
+            "train_test_split",
+            tmp_path / "dl1" / pointing,
+            {"train": tmp_path / "train" / pointing, "test": tmp_path / "test" / pointing, "ratio": 0.5},
+            f"split_{pointing}",
+        )
+    # restored from the stage cache
+    dag.add("merge_dl1", tmp_path / "test" / "dec_2", tmp_path / "test" / "dec_2.h5")
+
+    # equality
+    assert dag.dependencies(tmp_path / "dl1" / "dec_1", barrier="all") == "r0_dec_1"
+    # input in an output dir
+    assert dag.dependencies(tmp_path / "train" / "dec_2" / "file.h5", barrier="all") == "split_dec_2"
+    # input dir containing outputs
+    assert dag.dependencies(tmp_path / "train", barrier="all") == "split_dec_1,split_dec_2"
+    # output already there
+    assert dag.dependencies(tmp_path / "test" / "dec_2.h5", barrier="all") == ""
+    # unknown input: barrier
+    assert dag.dependencies({"gamma": tmp_path / "dl1" / "dec_1", "proton": "/other"}, barrier="all") == "r0_dec_1,all"
+
+    assert dag.stage_jobids("r0_to_dl1") == "r0_dec_1,r0_dec_2"
+
+
+def test_batch_dl1_to_dl2_dag(tmp_path, monkeypatch):
+    submitted = []
+
+    def fake_run_command(cmd):
+        submitted.append(cmd)
+        return str(100 + len(submitted))
+
+    monkeypatch.setattr("lstmcpipe.utils.run_command", fake_run_command)
+    logs = {"log_file": tmp_path / "log.yml", "debug_file": tmp_path / "debug.yml"}
+    batch_config = {"source_environment": "", "slurm_account": "", "n_submit_threads": 1}
+    dag = JobDag()
+    dict_paths = []
+    for index, pointing in enumerate(["dec_1", "dec_2"]):
+        dl1_file = tmp_path / "dl1" / f"{pointing}.h5"
+        models = tmp_path / "models" / pointing
+        dag.add("merge_dl1", tmp_path / "test" / pointing, dl1_file, f"{10 + index}")
+        dag.add("train_pipe", {"gamma": "/train/gamma.h5"}, models, f"{20 + index}")
+        dict_paths.append(
+            {"input": dl1_file.as_posix(), "path_model": models.as_posix(), "output": (tmp_path / "dl2").as_posix()}
+        )
+
+    jobids = batch_dl1_to_dl2(dict_paths, None, "10,11,20,21", batch_config, logs, dag=dag)
+
+    assert jobids == "101,102"
+    assert "--dependency=afterok:10:20" in submitted[0]
+    assert "--dependency=afterok:11:21" in submitted[1]
+    assert dag.dependencies(tmp_path / "dl2" / "dl2_dec_1.h5") == "101,102"
@@ -0,0 +1,99 @@
+import pytest
+
+from lstmcpipe.executors import (
+    LocalExecutor,
+    SlurmExecutor,
+    get_executor,
+    parse_array,
+    DEPENDENCY_FAILED,
+)
+from lstmcpipe.utils import SbatchLstMCStage
+
+
+def test_parse_array():
+    assert parse_array(None) == [None]
+    assert parse_array("0-3%100") == [0, 1, 2, 3]
+    assert parse_array("1,4-5") == [1, 4, 5]
+
+
+def test_get_executor():
+    assert isinstance(get_executor({}), SlurmExecutor)
+    assert isinstance(get_executor({"executor": "local"}), LocalExecutor)
+    assert get_executor({"executor": "local"}) is get_executor({"executor": "local"})
+    with pytest.raises(ValueError):
+        get_executor({"executor": "htcondor"})
+
+
+def test_local_executor(tmp_path):
+    executor = LocalExecutor(n_workers=2)
+    logs = {"output": f"{tmp_path}/job_%j.o", "error": f"{tmp_path}/job_%j.e"}
+    first = executor.submit_command(f"sleep 0.2 && echo first > {tmp_path}/first.txt", **logs)
+    second = executor.submit_command(
+        f"cat {tmp_path}/first.txt > {tmp_path}/second.txt",
+        dependencies=first,
+        output=f"{tmp_path}/second_%j.o",
+        error=logs["error"],
+    )
+    array = executor.submit_command(
+        f"cp {tmp_path}/second.txt {tmp_path}/task_$SLURM_ARRAY_TASK_ID.txt",
+        dependencies=second,
+        output=f"{tmp_path}/array_%A_%a.o",
+        error=f"{tmp_path}/array_%A_%a.e",
+        array="0-2%100",
+    )
+    executor.submit_command(f"touch {tmp_path}/after_task.txt", dependencies=f"{array}_1", **logs)
+    assert executor.wait()
+
+    assert (tmp_path / "second.txt").read_text() == "first\n"
+    assert all((tmp_path / f"task_{task}.txt").read_text() == "first\n" for task in range(3))
+    assert (tmp_path / f"array_{array}_2.o").exists()
+    assert (tmp_path / "after_task.txt").exists()
+
+    failing = executor.submit_command("exit 3", **logs)
+    dependent = executor.submit_command(f"touch {tmp_path}/not_run.txt", dependencies=failing, **logs)
+    assert not executor.wait()
+    assert executor._jobs[dependent][0].result() == DEPENDENCY_FAILED
+    assert not (tmp_path / "not_run.txt").exists()
+
+
+def test_sbatch_stage_local_executor(tmp_path):
+    executor = LocalExecutor(n_workers=1)
+    stage = SbatchLstMCStage(
+        "merge_dl1",
+        wrap_command=f"echo $MY_VAR > {tmp_path}/merged.txt;",
+        slurm_output=f"{tmp_path}/merge_%j.o",
+        slurm_error=f"{tmp_path}/merge_%j.e",
+        source_environment="export MY_VAR=merged",
+        executor=executor,
+    )
+    jobid = stage.submit()
+    assert executor.wait()
+    assert (tmp_path / "merged.txt").read_text() == "merged\n"
+    assert (tmp_path / f"merge_{jobid}.e").exists()
+
+
+def test_local_executor_resources(tmp_path):
+    executor = LocalExecutor(n_workers=4, memory_gb=10)
+    logs = {"output": f"{tmp_path}/job_%j.o", "error": f"{tmp_path}/job_%j.e"}
+    record = f"date +%s.%N >> {tmp_path}/$NAME.txt; sleep 0.3; date +%s.%N >> {tmp_path}/$NAME.txt"
+    # waiting for its dependency, `dependent` does not hold any core
+    first = executor.submit_command(f"NAME=first; {record}", cpus=4, **logs)
+    executor.submit_command(f"NAME=dependent; {record}", dependencies=first, **logs)
+    # the next jobs need all the cores or more than the memory left by the others
+    executor.submit_command(f"NAME=wide; {record}", cpus=4, **logs)
+    executor.submit_command(f"NAME=big_a; {record}", mem="6GB", **logs)
+    executor.submit_command(f"NAME=big_b; {record}", mem="6GB", **logs)
+    assert executor.wait()
+
+    times = {
+        name: [float(t) for t in (tmp_path / f"{name}.txt").read_text().split()]
+        for name in ["first", "dependent", "wide", "big_a", "big_b"]
+    }
+
+    def overlap(a, b):
+        return times[a][0] < times[b][1] and times[b][0] < times[a][1]
+
+    assert not overlap("first", "wide")
+    assert times["dependent"][0] >= times["first"][1]
+    assert not overlap("big_a", "big_b")
+    assert not overlap("wide", "big_a") and not overlap("wide", "dependent")
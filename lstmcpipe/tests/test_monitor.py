@@ -0,0 +1,91 @@
+import os
+import json
+import asyncio
+import subprocess as sp
+
+from lstmcpipe.scripts import fake_slurm
+from lstmcpipe.io.production_db import ProductionDB
+from lstmcpipe.monitor import parse_sacct, ProductionStatus, monitor
+
+
+def test_parse_sacct():
+    output = (
+        "12_0|COMPLETED|2024-01-01T10:00:00|2024-01-01T11:00:00|01:00:00\n"
+        "12_0.batch|COMPLETED|2024-01-01T10:00:00|2024-01-01T11:00:00|01:00:00\n"
+        "12_1|CANCELLED by 1000|2024-01-01T10:00:00|2024-01-01T10:30:00|00:30:00\n"
+        "12_[2-4%2]|PENDING|Unknown|Unknown|00:00:00\n"
+    )
+    units = parse_sacct(output)
+    assert list(units) == ["12_0", "12_1", "12_2", "12_3", "12_4"]
+    assert units["12_0"]["elapsed"] == 3600
+    assert units["12_1"]["state"] == "CANCELLED"
+    assert units["12_4"]["start"] is None
+
+
+def test_production_status():
+    hour = 3600
+    jobs = [
+        {"jobid": "1", "stage": "r0_to_dl1", "dependencies": "", "command": "sbatch --array=0-3%2 --wrap=''"},
+        {"jobid": "2", "stage": "merge_dl1", "dependencies": "1", "command": "sbatch --wrap=''"},
+        {"jobid": "3", "stage": "train_pipe", "dependencies": "2", "command": "sbatch --wrap=''"},
+        {"jobid": "4", "stage": "dl2_to_irfs", "dependencies": "", "command": "sbatch --wrap=''"},
+    ]
+    units = {
+        "1_0": {"state": "COMPLETED", "start": 0, "end": hour, "elapsed": hour},
+        "1_1": {"state": "COMPLETED", "start": 0, "end": hour, "elapsed": hour},
+        "1_2": {"state": "RUNNING", "start": hour, "end": None, "elapsed": 0},
+        "1_3": {"state": "PENDING", "start": None, "end": None, "elapsed": 0},
+        "4": {"state": "FAILED", "start": 0, "end": 10, "elapsed": 10},
+    }
+    status = ProductionStatus(jobs, units, output_files={"1_0": 5, "1_1": 5}, now=1.5 * hour)
+    stages = status.stages()
+    assert stages["r0_to_dl1"] == {
+        "total": 4,
+        "completed": 2,
+        "running": 1,
+        "pending": 1,
+        "failed": 0,
+        "tasks_per_hour": 2 / 1.5,
+    }
+    assert stages["merge_dl1"]["pending"] == 1
+    assert status.files_per_hour() == 10 / 1.5
+
+    # the pending task ends 1h (mean duration of the completed tasks) from now, then merge and train take 1h each
+    report = status.report()
+    assert report["projected_completion"] == 4.5 * hour
+    assert [job["jobid"] for job in report["critical_path"]] == ["1", "2", "3"]
+    assert report["failed"] == 1
+    assert not report["finished"]
+    json.dumps(report)
+
+    assert status.job_states()["1"] == "RUNNING"
+    assert status.job_states()["4"] == "FAILED"
+
+
+def test_monitor_fake_slurm(tmp_path, monkeypatch):
+    bin_dir, state_dir = tmp_path / "bin", tmp_path / "state"
+    fake_slurm.install(bin_dir, state_dir, job_duration=1000)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    def sbatch(options):
+        cmd = f'sbatch --parsable {options} --wrap="echo"'
+        return sp.run(cmd, shell=True, stdout=sp.PIPE, encoding="utf-8", check=True).stdout.strip(), cmd
+
+    db = ProductionDB(tmp_path / "prod.sqlite")
+    array, array_cmd = sbatch("--array=0-2%2")
+    merge, merge_cmd = sbatch(f"--dependency=afterok:{array}")
+    db.add_jobs("r0_to_dl1", {array: array_cmd})
+    db.add_jobs("merge_dl1", {merge: merge_cmd})
+
+    reports = []
+    report = asyncio.run(monitor(db, once=True, callback=reports.append, formatter=json.dumps))
+
+    assert report["stages"]["r0_to_dl1"]["running"] == 2
+    assert report["stages"]["r0_to_dl1"]["pending"] == 1
+    assert report["stages"]["merge_dl1"]["pending"] == 1
+    # no task completed yet
+    assert report["projected_completion"] is None
+    assert json.loads(reports[0])["stages"] == report["stages"]
+    assert [task["state"] for task in db.tasks(array)] == ["RUNNING", "RUNNING", "PENDING"]
+    assert db.jobs(stage="r0_to_dl1")[0]["state"] == "RUNNING"
+    db.close()
@@ -0,0 +1,91 @@
+import json
+
+from lstmcpipe.planner import plan_production, get_stage_rates, format_plan, schedule, scan_paths
+from lstmcpipe.io.production_db import ProductionDB
+
+
+def make_production(tmp_path):
+    r0_dirs = []
+    for particle, n_files in [("gamma", 60), ("proton", 10)]:
+        r0_dir = tmp_path / "DL0" / particle
+        r0_dir.mkdir(parents=True)
+        for i in range(n_files):
+            r0_dir.joinpath(f"run{i}.simtel.gz").write_bytes(b"0" * 1000)
+        r0_dirs.append(r0_dir)
+    dl1 = tmp_path / "DL1"
+    return {
+        "stages_to_run": ["r0_to_dl1", "merge_dl1", "train_pipe", "dl1_to_dl2"],
+        "batch_config": {},
+        "stages": {
+            "r0_to_dl1": [{"input": str(r0), "output": str(dl1 / r0.name)} for r0 in r0_dirs],
+            "merge_dl1": [{"input": str(dl1 / r0.name), "output": str(dl1 / f"{r0.name}.h5")} for r0 in r0_dirs],
+            "train_pipe": [
+                {
+                    "input": {"gamma": str(dl1 / "gamma.h5"), "proton": str(dl1 / "proton.h5")},
+                    "output": str(tmp_path / "models"),
+                }
+            ],
+            "dl1_to_dl2": [
+                {"input": str(dl1 / "gamma.h5"), "path_model": str(tmp_path / "models"), "output": str(tmp_path)}
+            ],
+        },
+    }
+
+
+def test_scan_paths(tmp_path):
+    tmp_path.joinpath("sub").mkdir()
+    tmp_path.joinpath("sub", "a.h5").write_bytes(b"0" * 10)
+    tmp_path.joinpath("b.h5").write_bytes(b"0" * 5)
+    tmp_path.joinpath("c.txt").write_bytes(b"0" * 100)
+    scans = scan_paths([tmp_path, tmp_path / "b.h5", tmp_path / "missing"])
+    assert scans == {tmp_path: (2, 15), tmp_path / "b.h5": (1, 5), tmp_path / "missing": None}
+
+
+def test_plan_production(tmp_path):
+    config = make_production(tmp_path)
+    rates = {stage: {"throughput_MBps": 0.001, "size_ratio": 0.5} for stage in get_stage_rates()}
+    plan = plan_production(config, rates=rates)
+    stages = plan.stages()
+
+    # 60 gamma files in 50-file tasks, 10 proton files in a 20-file task
+    assert stages["r0_to_dl1"]["tasks"] == 3
+    assert stages["r0_to_dl1"]["input_bytes"] == 70000
+    # the merge inputs do not exist yet: they are the planned dl1 outputs
+    assert stages["merge_dl1"]["input_files"] == 70
+    assert stages["merge_dl1"]["input_bytes"] == 35000
+    assert stages["merge_dl1"]["depends_on"] == ["r0_to_dl1"]
+    assert stages["train_pipe"]["input_bytes"] == 17500
+    assert stages["dl1_to_dl2"]["depends_on"] == ["merge_dl1", "train_pipe"]
+    # merged gamma file and models
+    assert stages["dl1_to_dl2"]["input_bytes"] == 15000 + 8750
+    # train_pipe runs on 16 cpus
+    assert stages["train_pipe"]["core_hours"] == 16 * 17.5 / 3600
+
+    report = plan.report(n_slots=2)
+    assert report["jobs"] == 3 + 2 + 1 + 1
+    # gamma tasks: 2 x 30 s in parallel, then gamma merge (30 s), train (17.5 s) and dl2 (23.75 s)
+    assert report["wall_time"] == 30 + 30 + 17.5 + 23.75
+    json.dumps(report)
+    assert "7 jobs" in format_plan(report)
+
+
+def test_schedule():
+    units = [
+        {"n_tasks": 4, "task_duration": 10, "dependencies": []},
+        {"n_tasks": 1, "task_duration": 5, "dependencies": []},
+        {"n_tasks": 1, "task_duration": 1, "dependencies": [0, 1]},
+    ]
+    assert schedule(units, 2) == [20, 25, 26]
+    assert schedule(units, 10) == [10, 5, 11]
+
+
+def test_stage_rates_from_db(tmp_path):
+    dl1, merged = tmp_path / "dl1", tmp_path / "merged.h5"
+    dl1.mkdir()
+    dl1.joinpath("run1.h5").write_bytes(b"0" * 400)
+    merged.write_bytes(b"0" * 100)
+    with ProductionDB(tmp_path / "prod.sqlite") as db:
+        db.add_unit("merge_dl1", [dl1], [merged], "12")
+        rates = get_stage_rates(db=db)
+    assert rates["merge_dl1"]["size_ratio"] == 0.25
+    assert rates["train_pipe"] == get_stage_rates()["train_pipe"]
@@ -0,0 +1,93 @@
+from lstmcpipe.io.production_db import ProductionDB
+from lstmcpipe.utils import memory_to_mb
+from lstmcpipe.supervisor import ResourceLimits, resubmission_command, resubmit_failed
+
+
+def test_resubmission_command(monkeypatch):
+    monkeypatch.setattr("lstmcpipe.supervisor.partition_time_limit", lambda partition: None)
+    command = (
+        'sbatch --parsable --partition=long --mem=32GB --array=0-9%5 --dependency=afterok:10:11 '
+        '--wrap="lstmcpipe_run_manifest --mem=1 a.manifest"'
+    )
+    assert resubmission_command(command, 65536, 7200, tasks=[2, 7]) == (
+        'sbatch --parsable --partition=long --mem=65536M --time=0-02:00:00 --array=2,7%5 '
+        '--wrap="lstmcpipe_run_manifest --mem=1 a.manifest"'
+    )
+
+    limits = ResourceLimits(max_mem="64G", max_time="1-00:00:00")
+    assert memory_to_mb("32GB") == 32768
+    assert limits.escalate(command, "OUT_OF_MEMORY") == (65536, 86400)
+    assert limits.escalate(command.replace("32GB", "64G"), "OUT_OF_MEMORY") is None
+    assert limits.escalate(command, "TIMEOUT") is None
+    assert limits.escalate("sbatch --time=10:00:00 --wrap=''", "TIMEOUT") == (4096, 72000)
+
+    # capped by the time limit of the partition
+    monkeypatch.setattr("lstmcpipe.supervisor.partition_time_limit", {"short": 3600 * 12}.get)
+    assert limits.escalate("sbatch --partition=short --time=10:00:00 --wrap=''", "TIMEOUT") == (4096, 43200)
+    assert limits.escalate("sbatch --partition=short --time=12:00:00 --wrap=''", "TIMEOUT") is None
+
+
+def test_resubmit_failed(tmp_path, monkeypatch):
+    submitted, updates = [], []
+
+    def fake_run_sbatch(cmd):
+        submitted.append(cmd)
+        return str(100 + len(submitted))
+
+    monkeypatch.setattr("lstmcpipe.supervisor.run_sbatch", fake_run_sbatch)
+    monkeypatch.setattr("lstmcpipe.supervisor.run_command", updates.append)
+    monkeypatch.setattr("lstmcpipe.supervisor.partition_time_limit", lambda partition: None)
+
+    db = ProductionDB(tmp_path / "prod.sqlite")
+    db.add_jobs("r0_to_dl1", {"10": "sbatch --parsable --mem=8G --array=0-2%100 --wrap='r0_dl1'"})
+    db.add_jobs("merge_dl1", {"11": "sbatch --parsable --dependency=afterok:10 --wrap='merge'"})
+    db.add_jobs("train_pipe", {"12": "sbatch --parsable --dependency=afterok:11:9 --wrap='train'"})
+    units = {
+        "10_0": {"state": "COMPLETED"},
+        "10_1": {"state": "OUT_OF_MEMORY"},
+        "10_2": {"state": "RUNNING"},
+        "11": {"state": "PENDING"},
+        "12": {"state": "PENDING"},
+        "9": {"state": "COMPLETED"},
+    }
+
+    replacements = resubmit_failed(db, units, limits=ResourceLimits(max_attempts=1))
+
+    assert replacements == {"10_1": "101_1"}
+    assert "--mem=16384M" in submitted[0] and "--array=1%100" in submitted[0]
+    # the merge waits for the running task and the resubmitted one
+    assert updates == ["scontrol update JobId=11 Dependency=afterok:10_2:101_1"]
+    assert db.jobs(stage="merge_dl1")[0]["dependencies"] == "10_2,101_1"
+    assert db.resubmissions()["10_1"]["attempt"] == 1
+
+    # already resubmitted
+    assert resubmit_failed(db, units) == {}
+    # the resubmitted task fails again: no more attempts
+    units["101_1"] = {"state": "OUT_OF_MEMORY"}
+    assert resubmit_failed(db, units, limits=ResourceLimits(max_attempts=1)) == {}
+    assert len(submitted) == 1
+    db.close()
+
+
+def test_resubmit_failed_sbatch_error(tmp_path, monkeypatch):
+    submitted = []
+
+    def fake_run_sbatch(cmd):
+        if "broken" in cmd:
+            raise ValueError("sbatch: error: Batch job submission failed")
+        submitted.append(cmd)
+        return str(100 + len(submitted))
+
+    monkeypatch.setattr("lstmcpipe.supervisor.run_sbatch", fake_run_sbatch)
+    monkeypatch.setattr("lstmcpipe.supervisor.run_command", lambda cmd: None)
+    monkeypatch.setattr("lstmcpipe.supervisor.partition_time_limit", lambda partition: None)
+
+    db = ProductionDB(tmp_path / "prod.sqlite")
+    db.add_jobs("r0_to_dl1", {"10": "sbatch --parsable --mem=8G --wrap='broken'"})
+    db.add_jobs("dl1ab", {"11": "sbatch --parsable --mem=8G --wrap='dl1ab'"})
+    units = {"10": {"state": "OUT_OF_MEMORY"}, "11": {"state": "OUT_OF_MEMORY"}}
+
+    # the failed resubmission does not prevent the other one
+    assert resubmit_failed(db, units) == {"11": "101"}
+    assert "10" not in db.resubmissions()
+    db.close()
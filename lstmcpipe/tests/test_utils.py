@@ -1,9 +1,23 @@
+import os
 import json
 import pytest
 import tempfile
+import subprocess
 from pathlib import Path
 from ruamel.yaml import YAML
-from lstmcpipe.utils import rerun_cmd, dump_lstchain_std_config, SbatchLstMCStage, run_command
+from lstmcpipe.utils import (
+    rerun_cmd,
+    rerun_func,
+    dump_lstchain_std_config,
+    SbatchLstMCStage,
+    run_command,
+    slurm_time_to_seconds,
+    submit_command_arrays,
+    run_sbatch,
+    map_submissions,
+    partition_time_limit,
+    max_array_size,
+)
 
 
 @pytest.fixture(scope="session")
@@ -58,6 +72,28 @@ def test_rerun_cmd():
             assert isinstance(e, RuntimeError)
 
 
+def test_rerun_func(tmp_path):
+    outfile = tmp_path / "output.h5"
+    calls = []
+
+    def write_and_fail(filename, fail_until=3):
+        calls.append(filename)
+        Path(filename).write_text(str(len(calls)))
+        if len(calls) < fail_until:
+            raise OSError("simulated failure")
+
+    failed_jobs_dir = tmp_path / "failed"
+    ntry = rerun_func(write_and_fail, outfile, outfile, max_ntry=3, failed_jobs_dir=failed_jobs_dir)
+    assert ntry == 3
+    assert outfile.read_text() == "3"
+    assert failed_jobs_dir.joinpath(outfile.name).read_text() == "2"
+
+    calls.clear()
+    with pytest.raises(RuntimeError, match="failed after 2 attempts"):
+        rerun_func(write_and_fail, outfile, outfile, max_ntry=2, failed_jobs_dir=failed_jobs_dir, fail_until=5)
+    assert not outfile.exists()
+
+
 def test_rerun_cmd_lstchain_mc_r0_to_dl1(mc_gamma_testfile):
     with tempfile.TemporaryDirectory() as tmp_dir:
         cmd = ['lstchain_mc_r0_to_dl1', '-o', tmp_dir, '-f', mc_gamma_testfile]
@@ -72,6 +108,15 @@ def test_rerun_cmd_lstchain_mc_r0_to_dl1(mc_gamma_testfile):
         assert Path(tmp_dir, 'failed_outputs', outfilename).exists()
 
 
+def test_slurm_time_to_seconds():
+    assert slurm_time_to_seconds("30") == 1800
+    assert slurm_time_to_seconds("30:15") == 1815
+    assert slurm_time_to_seconds("06:00:00") == 21600
+    assert slurm_time_to_seconds("1-00") == 86400
+    assert slurm_time_to_seconds("2-01:30") == 2 * 86400 + 5400
+    assert slurm_time_to_seconds("03-00:00:00") == 3 * 86400
+
+
 def test_run_command():
     cmd = run_command("echo 'this is the command to be passed'")
     assert cmd == "this is the command to be passed"
@@ -125,6 +170,128 @@ def test_sbatch_lst_mc_stage():
         assert "--partition=" in sbatch.slurm_command
 
 
+def test_submit_command_arrays(tmp_path, monkeypatch):
+    submitted = []
+
+    def fake_run_command(cmd):
+        submitted.append(cmd)
+        return str(100 + len(submitted))
+
+    monkeypatch.setattr("lstmcpipe.utils.run_command", fake_run_command)
+    batch_config = {"source_environment": "", "slurm_account": "", "array_parallel_jobs": 10}
+    commands = ["echo 0", "echo 1", "echo 2"]
+    options = [None, {"mem": "64GB"}, None]
+
+    jobid2log, task_ids = submit_command_arrays(
+        "dl1_to_dl2", commands, tmp_path, batch_config, slurm_dependencies="12,13", extra_slurm_options=options
+    )
+    assert list(jobid2log) == ["101", "102"]
+    assert task_ids == ["101_0", "102_0", "101_1"]
+    assert "--array=0-1%10" in submitted[0] and "--dependency=afterok:12:13" in submitted[0]
+    assert "--array=0-0%10" in submitted[1] and "--mem=64GB" in submitted[1]
+
+    manifest = submitted[0].split("lstmcpipe_run_manifest ")[1].split()[0]
+    assert Path(manifest).read_text().splitlines() == ["echo 0", "echo 2"]
+    result = subprocess.run(["lstmcpipe_run_manifest", manifest, "--task-id", "1"], capture_output=True, text=True)
+    assert result.returncode == 0
+    assert result.stdout.splitlines()[-1] == "2"
+
+
+def test_submit_command_arrays_dependencies(tmp_path, monkeypatch):
+    submitted = []
+
+    def fake_run_command(cmd):
+        submitted.append(cmd)
+        return str(100 + len(submitted))
+
+    monkeypatch.setattr("lstmcpipe.utils.run_command", fake_run_command)
+    batch_config = {"source_environment": "", "slurm_account": "", "max_array_size": 2}
+    commands = [f"echo {i}" for i in range(5)]
+    dependencies = ["12", "13,12", "12", "12", "12,13"]
+    resources = [
+        {"mem": "2000M", "time": "0-01:00:00", "cpus-per-task": 1},
+        None,
+        {"mem": "4G", "time": "0-00:30:00", "cpus-per-task": 2},
+        {"mem": "1000M", "time": "0-02:00:00", "cpus-per-task": 1},
+        None,
+    ]
+
+    jobid2log, task_ids = submit_command_arrays(
+        "dl1_to_dl2", commands, tmp_path, batch_config, slurm_dependencies=dependencies, resource_options=resources
+    )
+    # each task only waits for its own dependencies, and the arrays have at most 2 tasks
+    assert list(jobid2log) == ["101", "102", "103"]
+    assert task_ids == ["101_0", "103_0", "101_1", "102_0", "103_1"]
+    assert "--dependency=afterok:12 " in submitted[0] and "--array=0-1%100" in submitted[0]
+    assert "--dependency=afterok:12 " in submitted[1] and "--array=0-0%100" in submitted[1]
+    assert "--dependency=afterok:12:13" in submitted[2]
+    # an array gets the largest resources learned for its tasks
+    assert "--mem=4096M" in submitted[0] and "--time=0-01:00:00" in submitted[0]
+    assert "--cpus-per-task=2" in submitted[0]
+    assert "--mem=1000M" in submitted[1] and "--time=0-02:00:00" in submitted[1]
+    assert "--mem=32GB" in submitted[2]
+
+
+def test_max_array_size(monkeypatch):
+    def fake_run(cmd, **kwargs):
+        return subprocess.CompletedProcess(cmd, 0, stdout="MaxArraySize            = 4001\nMaxJobCount = 10000\n")
+
+    max_array_size.cache_clear()
+    monkeypatch.setattr("lstmcpipe.utils.sp.run", fake_run)
+    assert max_array_size() == 4001
+    max_array_size.cache_clear()
+
+    def no_slurm(cmd, **kwargs):
+        raise FileNotFoundError(cmd[0])
+
+    monkeypatch.setattr("lstmcpipe.utils.sp.run", no_slurm)
+    assert max_array_size() == 1001
+    max_array_size.cache_clear()
+
+
+def test_run_sbatch(monkeypatch):
+    calls = []
+
+    def flaky_run_command(cmd):
+        calls.append(cmd)
+        if len(calls) < 3:
+            raise ValueError("sbatch: error: Slurm temporarily unable to accept job, sleeping and retrying")
+        return "1234"
+
+    monkeypatch.setattr("lstmcpipe.utils.run_command", flaky_run_command)
+    assert run_sbatch("sbatch cmd", wait=0) == "1234"
+    assert len(calls) == 3
+
+    calls.clear()
+    with pytest.raises(ValueError):
+        run_sbatch("sbatch cmd", max_ntry=2, wait=0)
+
+    def failing_run_command(cmd):
+        calls.append(cmd)
+        raise ValueError("sbatch: error: invalid partition specified")
+
+    calls.clear()
+    monkeypatch.setattr("lstmcpipe.utils.run_command", failing_run_command)
+    with pytest.raises(ValueError):
+        run_sbatch("sbatch cmd", wait=0)
+    assert len(calls) == 1
+
+    # the job may have been created before the reply timed out, it must not be submitted again
+    def timed_out_run_command(cmd):
+        calls.append(cmd)
+        raise ValueError("sbatch: error: Batch job submission failed: Socket timed out on send/recv operation")
+
+    calls.clear()
+    monkeypatch.setattr("lstmcpipe.utils.run_command", timed_out_run_command)
+    with pytest.raises(ValueError):
+        run_sbatch("sbatch cmd", wait=0)
+    assert len(calls) == 1
+
+
+def test_map_submissions():
+    assert map_submissions(lambda x: x**2, list(range(20)), {"n_submit_threads": 3}) == [x**2 for x in range(20)]
+
+
 def test_dump_lstchain_std_config():
     with tempfile.TemporaryDirectory() as tmpdir:
         outfile = Path(tmpdir).joinpath('cfg.json')
@@ -132,3 +299,48 @@ def test_dump_lstchain_std_config():
         assert json.load(outfile.open())['GlobalPeakWindowSum']['apply_integration_correction']
         dump_lstchain_std_config(filename=outfile, allsky=True, overwrite=True)
         assert 'alt_tel' in json.load(outfile.open())['energy_regression_features']
+
+
+def test_batch_mc_production_check_without_jobs(tmp_path, monkeypatch):
+    from ..utils import batch_mc_production_check
+
+    submitted = []
+
+    class FakePipe:
+        def read(self):
+            return "1234\n"
+
+    monkeypatch.setattr("lstmcpipe.utils.os.popen", lambda cmd: submitted.append(cmd) or FakePipe())
+    config = tmp_path / "config.yml"
+    config.write_text("prod_id: test")
+    logs = {"log_file": tmp_path / "log.yml", "debug_file": tmp_path / "debug.yml"}
+    batch_config = {"source_environment": "", "slurm_account": ""}
+
+    # all the units were restored from the stage cache
+    jobid = batch_mc_production_check({"merge_dl1": "", "train_pipe": ""}, tmp_path, "test", config, batch_config, logs)
+    assert jobid == "1234"
+    assert "--dependency" not in submitted[0] and "sacct" not in submitted[0]
+
+    batch_mc_production_check({"merge_dl1": "12,13", "train_pipe": "14"}, tmp_path, "test", config, batch_config, logs)
+    assert "--dependency=afterok:12,13,14" in submitted[1]
+
+
+def test_partition_time_limit(tmp_path, monkeypatch):
+    fake = tmp_path / "scontrol"
+    fake.write_text(
+        "#!/bin/bash\n"
+        'case $3 in\n'
+        '  short) echo "PartitionName=short MaxNodes=UNLIMITED MaxTime=12:00:00 MinNodes=0";;\n'
+        '  xxl) echo "PartitionName=xxl MaxTime=UNLIMITED";;\n'
+        '  *) exit 1;;\n'
+        "esac\n"
+    )
+    fake.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+    partition_time_limit.cache_clear()
+    try:
+        assert partition_time_limit("short") == 12 * 3600
+        assert partition_time_limit("xxl") is None
+        assert partition_time_limit("unknown") is None
+    finally:
+        partition_time_limit.cache_clear()
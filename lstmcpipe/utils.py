@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 
 import os
+import re
 import json
 import shutil
+import functools
 import logging
 import warnings
+import time
+import tempfile
 import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from ruamel.yaml import YAML
 from pprint import pprint
@@ -43,6 +48,38 @@ def save_log_to_file(dictionary, output_file, workflow_step=None):
         YAML().dump(dict2log, fileout)
 
 
+def save_logs(logs, workflow_step, log_dict=None, debug_log=None):
+    """
+    Save the logs of a stage in the production database (`db` entry of `logs`), from which the YAML log files are
+    then exported, or directly in the YAML log files if there is no database.
+    The YAML log files are thus up to date after each stage, even if the production is interrupted.
+
+    Parameters
+    ----------
+    logs: dict
+        Dictionary with logs files and optionally the `lstmcpipe.io.production_db.ProductionDB` of the production
+    workflow_step: str
+        Step of the workflow, to be recorded in the log
+    log_dict: dict or None
+        {jobid: batch_cmd} of the submitted jobs, written in the `log_file`
+    debug_log: dict or None
+        Reduced log, written in the `debug_file`
+    """
+    db = logs.get("db")
+    for log_type, dictionary in (("log_file", log_dict), ("debug_file", debug_log)):
+        if dictionary is None:
+            continue
+        if db is None:
+            save_log_to_file(dictionary, logs[log_type], workflow_step=workflow_step)
+        else:
+            db.add_log(log_type, workflow_step, dictionary)
+    if db is not None:
+        if log_dict:
+            db.add_jobs(workflow_step, log_dict)
+        db.flush()
+        db.export_yaml({log_type: logs[log_type] for log_type in ("log_file", "debug_file") if log_type in logs})
+
+
 def batch_mc_production_check(
     dict_jobids_all_stages,
     log_directory,
@@ -50,6 +87,7 @@ def batch_mc_production_check(
     prod_config_file,
     batch_config,
     logs_files,
+    executor=None,
 ):
     """
     Check that the dl1_to_dl2 stage, and therefore, the whole workflow has ended correctly.
@@ -66,6 +104,9 @@ def batch_mc_production_check(
     batch_config: dict
     logs_files: dict
         Dictionary with logs files
+    executor: `lstmcpipe.executors` backend or None
+        Backend running the jobs, sbatch if None. Without slurm, the machine information of the jobs is not available
+        and the check file is only created once all the jobs succeeded.
 
     Returns
     -------
@@ -82,7 +123,7 @@ def batch_mc_production_check(
         all_pipeline_jobs.append(jobids)
         debug_log[f"SUMMARY_{stage}"] = jobids
 
-    all_pipeline_jobs = ",".join(all_pipeline_jobs)
+    all_pipeline_jobs = join_jobids(*all_pipeline_jobs)
 
     # Copy lstmcpipe config used to log directory
     shutil.copyfile(Path(prod_config_file).resolve(), log_directory.joinpath(f"config_MC_prod_{prod_id}.yml"))
@@ -90,23 +131,45 @@ def batch_mc_production_check(
     # Save machine info into the check file
     check_prod_file = log_directory.joinpath(f"check_MC_{prod_id}.txt").absolute().as_posix()
 
+    if executor is not None and executor.name != "slurm":
+        jobid = executor.submit_command(
+            f"touch {check_prod_file}",
+            dependencies=all_pipeline_jobs,
+            output=log_directory.joinpath("prod_check_%j.o").as_posix(),
+            error=log_directory.joinpath("prod_check_%j.e").as_posix(),
+        )
+        log.info(f"Submitted {executor.name} CHECK-job {jobid}")
+        debug_log[f"prod_check_{jobid}"] = f"touch {check_prod_file}"
+        save_logs(logs_files, "check_full_workflow", {jobid: f"touch {check_prod_file}"}, debug_log)
+        return jobid
+
     cmd_wrap = f"touch {check_prod_file}; "
-    cmd_wrap += (
-        f"sacct --format=jobid,jobname,nodelist,cputime,state,exitcode,avediskread,maxdiskread,avediskwrite,"
-        f"maxdiskwrite,AveVMSize,MaxVMSize,avecpufreq,reqmem -j {all_pipeline_jobs} >> {check_prod_file}; "
-        f"mv slurm-* IRFFITSWriter.provenance.log {log_directory.absolute().as_posix()} "
-    )
+    if all_pipeline_jobs:
+        cmd_wrap += (
+            f"sacct --format=jobid,jobname,nodelist,cputime,state,exitcode,avediskread,maxdiskread,avediskwrite,"
+            f"maxdiskwrite,AveVMSize,MaxVMSize,avecpufreq,reqmem -j {all_pipeline_jobs} >> {check_prod_file}; "
+        )
+    cmd_wrap += f"mv slurm-* IRFFITSWriter.provenance.log {log_directory.absolute().as_posix()}; "
+    if batch_config.get("resource_history") and logs_files.get("db") is not None:
+        # usage of the jobs of this production, to size the jobs of the next ones
+        cmd_wrap += (
+            f"lstmcpipe_resource_history record {prod_id} {Path(batch_config['resource_history']).absolute()} "
+            f"--db {logs_files['db'].filename.absolute().as_posix()}; "
+        )
 
     batch_cmd = "sbatch -p short --parsable"
     if slurm_account != "":
         batch_cmd += f" -A {slurm_account}"
-    batch_cmd += f" --dependency=afterok:{all_pipeline_jobs} -J prod_check" f' --wrap="{source_env} {cmd_wrap}"'
+    # no job to wait for if all the units were restored from the stage cache or resumed
+    if all_pipeline_jobs:
+        batch_cmd += f" --dependency=afterok:{all_pipeline_jobs}"
+    batch_cmd += f' -J prod_check --wrap="{source_env} {cmd_wrap}"'
 
     jobid = os.popen(batch_cmd).read().strip("\n")
     log.info(f"Submitted batch CHECK-job {jobid}")
     debug_log[f"prod_check_{jobid}"] = batch_cmd
 
-    save_log_to_file(debug_log, logs_files["debug_file"], workflow_step="check_full_workflow")
+    save_logs(logs_files, "check_full_workflow", {jobid: batch_cmd}, debug_log)
 
     return jobid
 
@@ -143,11 +206,7 @@ def rerun_cmd(cmd, outfile, max_ntry=2, failed_jobs_dir=prod_logs/"failed_output
             return ntry  # Success, return the number of tries it took
 
         # Command failed, handle the error
-        if outfile.exists():
-            failed_jobs_dir.mkdir(exist_ok=True)
-            outfile_target = failed_jobs_dir.joinpath(outfile.name)
-            print(f"Try #{ntry} - move failed output file from {outfile} to {outfile_target}")
-            shutil.move(outfile, outfile_target)
+        _move_failed_output(outfile, failed_jobs_dir, ntry)
 
         # If this was the last try, raise an exception
         if ntry == max_ntry:
@@ -162,6 +221,58 @@ def rerun_cmd(cmd, outfile, max_ntry=2, failed_jobs_dir=prod_logs/"failed_output
     raise RuntimeError("Unexpected error in rerun_cmd")
 
 
+def rerun_func(func, outfile, *args, max_ntry=2, failed_jobs_dir=prod_logs/"failed_outputs", **kwargs):
+    """
+    In-process equivalent of `rerun_cmd`: call `func(*args, **kwargs)` up to max_ntry times.
+    If an attempt raises, its output file is moved to `failed_jobs_dir` before the next one.
+    If all attempts fail, raise an exception.
+
+    Parameters
+    ----------
+    func: callable
+        Function to call
+    outfile: Path
+        Path to the function output file
+    args: args
+        Positional arguments for func
+    max_ntry: int
+        Maximum number of attempts to call the function
+    failed_jobs_dir: Path or str
+        Subdirectory to move failed output files to
+    kwargs: kwargs
+        Keyword arguments for func
+
+    Returns
+    -------
+    int: the number of tries it took
+
+    Raises
+    ------
+    RuntimeError
+        If the function fails after all retry attempts
+    """
+    outfile = Path(outfile)
+    failed_jobs_dir = Path(failed_jobs_dir)
+    for ntry in range(1, max_ntry + 1):
+        try:
+            func(*args, **kwargs)
+            return ntry
+        except Exception as e:
+            _move_failed_output(outfile, failed_jobs_dir, ntry)
+            if ntry == max_ntry:
+                raise RuntimeError(
+                    f"{func.__name__} failed after {max_ntry} attempts for {outfile}. Last failure: {e!r}"
+                ) from e
+
+
+def _move_failed_output(outfile, failed_jobs_dir, ntry):
+    if outfile.exists():
+        failed_jobs_dir.mkdir(exist_ok=True)
+        outfile_target = failed_jobs_dir.joinpath(outfile.name)
+        print(f"Try #{ntry} - move failed output file from {outfile} to {outfile_target}")
+        shutil.move(outfile, outfile_target)
+
+
 def dump_lstchain_std_config(filename='lstchain_config.json', allsky=True, overwrite=False):
     from lstchain.io.config import get_mc_config
 
@@ -195,6 +306,89 @@ def dump_lstchain_std_config(filename='lstchain_config.json', allsky=True, overw
     print(f"\nModified lstchain config dumped in {filename}. Check full config thoroughly.")
 
 
+# MB per unit of the slurm memory specifications
+MEMORY_UNITS = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024**2}
+
+
+def slurm_time_to_seconds(time_string):
+    """
+    Convert a slurm time string to seconds.
+    Accepted formats: "minutes", "minutes:seconds", "hours:minutes:seconds", "days-hours",
+    "days-hours:minutes" and "days-hours:minutes:seconds".
+
+    Parameters
+    ----------
+    time_string: str or int
+
+    Returns
+    -------
+    int
+    """
+    time_string = str(time_string).strip()
+    days = 0
+    if "-" in time_string:
+        days, time_string = time_string.split("-", 1)
+        fields = [int(f) for f in time_string.split(":")]
+        fields += [0] * (3 - len(fields))  # days-hours[:minutes[:seconds]]
+        hours, minutes, seconds = fields
+    else:
+        fields = [int(f) for f in time_string.split(":")]
+        if len(fields) == 1:
+            hours, minutes, seconds = 0, fields[0], 0
+        elif len(fields) == 2:
+            hours, minutes, seconds = 0, fields[0], fields[1]
+        else:
+            hours, minutes, seconds = fields
+    return ((int(days) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def memory_to_mb(memory):
+    """
+    Memory in MB of a slurm memory specification, e.g. `32GB`, `4000M` or `4000` (MB)
+    """
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMGT]?)B?", str(memory).strip().upper())
+    if match is None:
+        raise ValueError(f"Invalid memory {memory}")
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2) or "M"])
+
+
+def seconds_to_slurm_time(seconds):
+    """
+    `days-hours:minutes:seconds` slurm time
+    """
+    seconds = int(seconds)
+    return f"{seconds // 86400}-{seconds % 86400 // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+@functools.lru_cache(maxsize=None)
+def partition_time_limit(partition):
+    """
+    Maximum time limit of a slurm partition, from `scontrol show partition`.
+
+    Parameters
+    ----------
+    partition: str
+
+    Returns
+    -------
+    int or None: time limit in seconds, None if it is unlimited or cannot be obtained (e.g. slurm not available)
+    """
+    try:
+        output = sp.run(
+            ["scontrol", "show", "partition", str(partition), "--oneliner"],
+            stdout=sp.PIPE,
+            stderr=sp.DEVNULL,
+            encoding="utf-8",
+            check=True,
+        ).stdout
+    except (OSError, sp.CalledProcessError):
+        return None
+    match = re.search(r"MaxTime=(\S+)", output)
+    if match is None or match.group(1) == "UNLIMITED":
+        return None
+    return slurm_time_to_seconds(match.group(1))
+
+
 def run_command(*args):
     """
     Runs the command passed through args, as a subprocess.Popen() call.
@@ -222,6 +416,88 @@ def run_command(*args):
         return stdout.strip('\n')
 
 
+# sbatch errors worth retrying: the slurm controller is overloaded or briefly unreachable
+# errors returned before the job is created. A "Socket timed out" is not retried: the controller may have
+# created the job before the reply was lost, and a new submission would then run it twice
+TRANSIENT_SLURM_ERRORS = (
+    "Slurm temporarily unable",
+    "Unable to contact slurm controller",
+    "Resource temporarily unavailable",
+)
+
+DEFAULT_N_SUBMIT_THREADS = 4
+
+
+def run_sbatch(cmd, max_ntry=5, wait=2):
+    """
+    Run a sbatch command, retrying with an exponential backoff when slurm returns a transient error.
+
+    Parameters
+    ----------
+    cmd: str
+    max_ntry: int
+        Maximum number of tries
+    wait: float
+        Waiting time in seconds before the second try, doubled at each try
+
+    Returns
+    -------
+    str: output of the command (job id)
+    """
+    for ntry in range(1, max_ntry + 1):
+        try:
+            return run_command(cmd)
+        except ValueError as e:
+            if ntry == max_ntry or not any(error in str(e) for error in TRANSIENT_SLURM_ERRORS):
+                raise
+            delay = wait * 2 ** (ntry - 1)
+            log.warning(f"sbatch failed with a transient error, retrying in {delay} s ({ntry}/{max_ntry}): {e}")
+            time.sleep(delay)
+
+
+def join_jobids(*jobids):
+    """
+    Join comma-separated job ids, removing empty and duplicated ids as well as the array tasks (`jobid_task`) of a
+    job array whose id is also given.
+
+    Parameters
+    ----------
+    jobids: str
+
+    Returns
+    -------
+    str
+    """
+    unique = []
+    for jobid in ",".join(filter(None, jobids)).split(","):
+        jobid = jobid.strip()
+        if jobid and jobid not in unique:
+            unique.append(jobid)
+    return ",".join(jobid for jobid in unique if jobid.split("_")[0] == jobid or jobid.split("_")[0] not in unique)
+
+
+def map_submissions(func, entries, batch_config, *iterables):
+    """
+    Call `func` on each entry in a pool of `n_submit_threads` threads (batch config entry), as the submission of jobs
+    is mostly spent waiting for sbatch.
+
+    Parameters
+    ----------
+    func: callable
+    entries: list
+    batch_config: dict
+    iterables: list
+        Other arguments of `func`, one per entry (as for `map`)
+
+    Returns
+    -------
+    list: results of `func`, in the order of the entries
+    """
+    n_threads = batch_config.get("n_submit_threads") or DEFAULT_N_SUBMIT_THREADS
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        return list(pool.map(func, entries, *iterables))
+
+
 class SbatchLstMCStage:
     """
     Base class to (slurm) sbatch a lstMCpipe stage
@@ -239,6 +515,8 @@ class SbatchLstMCStage:
         extra_slurm_options=None,
         source_environment="",
         backend="",
+        executor=None,
+        resource_options=None,
     ):
         self.base_slurm_command = "sbatch --parsable"
         self.stage = stage
@@ -250,6 +528,10 @@ class SbatchLstMCStage:
         self.slurm_account = slurm_account
         self.slurm_dependencies = slurm_dependencies
         self.extra_slurm_options = extra_slurm_options
+        # `lstmcpipe.executors` backend running the job, sbatch if None
+        self.executor = executor
+        # resources learned from previous productions, see `lstmcpipe.io.resource_history`
+        self.resource_options = resource_options
 
         self.compose_wrap_command(wrap_command, source_environment, backend)
 
@@ -275,15 +557,19 @@ class SbatchLstMCStage:
     def compose_wrap_command(self, wrap_command=None, source_env="", backend=""):
         if wrap_command is None or wrap_command == "":
             warnings.warn("You must pass a command to be batched! ")
+            self.shell_command = ""
         else:
             # Remove trailing semicolon and any extra spaces
             wrap_command = wrap_command.rstrip(";").strip()
-            # exit if any command fails
-            wrap_command = wrap_command + ' || exit ' + r'\$?'
         if source_env != "" and not source_env.strip().endswith(";"):
             source_env = f"{source_env.strip()}; "
         if backend != "" and not backend.strip().endswith(";"):
             backend = f"{backend.strip()}; "
+        if wrap_command:
+            # command run by executors other than slurm
+            self.shell_command = f"{backend}{source_env}{wrap_command}"
+            # exit if any command fails
+            wrap_command = wrap_command + ' || exit ' + r'\$?'
         self.wrap_cmd = f'--wrap="{backend}{source_env}{wrap_command}"'
 
     @property
@@ -332,7 +618,9 @@ class SbatchLstMCStage:
 
     def submit(self):
         if self.wrap_cmd is not None and self.wrap_cmd != "":
-            jobid = run_command(self.slurm_command)
+            if self.executor is not None:
+                return self.executor.submit(self)
+            jobid = run_sbatch(self.slurm_command)
             return jobid
         else:
             raise ValueError(
@@ -348,12 +636,15 @@ class SbatchLstMCStage:
         """
         Construct the complet set of slurm options with the following priority order:
         - default ones for the stage
+        - the resources learned from previous productions, with a time capped by the maximum time of the partition
         - the general ones (job_name, error, output, account)
         - extra_slurm_options
         """
-        # set all the slurm options with the following priority order: default, general, extra_slurm_options
+        # set all the slurm options with the following priority order: default, learned, general, extra_slurm_options
         self._slurm_options = {}
         self._slurm_options.update(self.stage_default_options(self.stage))
+        if self.resource_options is not None:
+            self._slurm_options.update(self.resource_options)
 
         if self.job_name is not None:
             self._slurm_options['job-name'] = self.job_name
@@ -368,6 +659,14 @@ class SbatchLstMCStage:
         if self.extra_slurm_options is not None:
             self._slurm_options.update(self.extra_slurm_options)
 
+        # a learned time limit above the maximum time of the partition would be rejected by sbatch
+        learned_time = (self.resource_options or {}).get('time')
+        partition = self._slurm_options.get('partition')
+        if learned_time is not None and self._slurm_options.get('time') == learned_time and partition:
+            max_time = partition_time_limit(partition)
+            if max_time is not None and slurm_time_to_seconds(learned_time) > max_time:
+                self._slurm_options['time'] = seconds_to_slurm_time(max_time)
+
     @property
     def r0_dl1_default_options(self):
         return {'job-name': 'r0_dl1', 'partition': 'long', 'array': '0-0%100'}
@@ -407,3 +706,151 @@ class SbatchLstMCStage:
     @property
     def dl2_sens_plot_default_options(self):
         return {'job-name': 'dl2_sens_plot', 'partition': 'short'}
+
+
+def use_job_array(batch_config, stage):
+    """
+    Whether the jobs of a stage are batched as a single slurm array (`array_stages` entry of the slurm config).
+    """
+    return stage in (batch_config.get("array_stages") or [])
+
+
+def submit_command_arrays(
+    stage,
+    commands,
+    array_dir,
+    batch_config,
+    slurm_dependencies=None,
+    extra_slurm_options=None,
+    executor=None,
+    resource_options=None,
+):
+    """
+    Batch a list of commands as slurm job arrays instead of one job per command.
+    The commands are written in a manifest file, one per line, and each array task runs the line given by its
+    `SLURM_ARRAY_TASK_ID` through `lstmcpipe_run_manifest`.
+    Commands with different dependencies or extra slurm options are batched in different arrays, so that each task
+    only waits for its own dependencies, and arrays are split to respect the maximum array size of slurm.
+
+    Parameters
+    ----------
+    stage: str
+        Stage name, see `SbatchLstMCStage`
+    commands: list of str
+    array_dir: str or Path
+        Directory for the manifests and the slurm logs of the tasks
+    batch_config: dict
+        Dictionary containing the (full) source_environment and the slurm_account strings, and optionally the maximum
+        number of tasks running at the same time (`array_parallel_jobs`, default 100) and the maximum number of tasks
+        of an array (`max_array_size`, default from the slurm configuration)
+    slurm_dependencies: str or list of str
+        Comma-separated job ids all the arrays depend on, or the job ids each command depends on
+    extra_slurm_options: list of dict
+        Extra slurm options of each command
+    executor: `lstmcpipe.executors` backend or None
+        Backend running the arrays, sbatch if None
+    resource_options: list of dict
+        Slurm options predicted from the resource history for each command, see `learned_slurm_options`.
+        An array is given the largest resources of its tasks.
+
+    Returns
+    -------
+    jobid2log: dict
+        {jobid: batch_cmd} of the submitted arrays
+    task_ids: list of str
+        `{array_jobid}_{task_id}` of each command
+    """
+    array_dir = Path(array_dir)
+    array_dir.mkdir(exist_ok=True, parents=True)
+    n_jobs_parallel = batch_config.get("array_parallel_jobs") or 100
+    array_size = batch_config.get("max_array_size") or max_array_size()
+    if slurm_dependencies is None or isinstance(slurm_dependencies, str):
+        slurm_dependencies = [slurm_dependencies] * len(commands)
+    if extra_slurm_options is None:
+        extra_slurm_options = [None] * len(commands)
+    if resource_options is None:
+        resource_options = [None] * len(commands)
+
+    groups = {}
+    for index, (dependencies, options) in enumerate(zip(slurm_dependencies, extra_slurm_options)):
+        dependencies = ",".join(sorted(join_jobids(dependencies or "").split(",")))
+        groups.setdefault((dependencies, json.dumps(options, sort_keys=True)), []).append(index)
+
+    jobid2log = {}
+    task_ids = [None] * len(commands)
+    for (dependencies, group_options), group in groups.items():
+        for start in range(0, len(group), array_size):
+            indices = group[start : start + array_size]
+            fd, manifest_file = tempfile.mkstemp(prefix=f"{stage}_", suffix=".manifest", dir=array_dir)
+            with os.fdopen(fd, "w") as manifest:
+                for index in indices:
+                    manifest.write(commands[index] + "\n")
+
+            array_options = {"array": f"0-{len(indices) - 1}%{n_jobs_parallel}"}
+            array_options.update(json.loads(group_options) or {})
+            sbatch_array = SbatchLstMCStage(
+                stage,
+                wrap_command=f"lstmcpipe_run_manifest {manifest_file}",
+                slurm_error=array_dir.joinpath(f"{stage}_%A_%a.e").as_posix(),
+                slurm_output=array_dir.joinpath(f"{stage}_%A_%a.o").as_posix(),
+                slurm_dependencies=dependencies or None,
+                extra_slurm_options=array_options,
+                slurm_account=batch_config["slurm_account"],
+                source_environment=batch_config["source_environment"],
+                executor=executor,
+                resource_options=merge_resource_options([resource_options[index] for index in indices]),
+            )
+            jobid = sbatch_array.submit()
+            log.info(f"Submitted batch job array {jobid} of {len(indices)} {stage} tasks")
+            jobid2log[jobid] = sbatch_array.slurm_command
+            for task, index in enumerate(indices):
+                task_ids[index] = f"{jobid}_{task}"
+
+    return jobid2log, task_ids
+
+
+@functools.lru_cache(maxsize=None)
+def max_array_size():
+    """
+    Maximum number of tasks of a slurm job array, from the `MaxArraySize` of `scontrol show config`.
+
+    Returns
+    -------
+    int: 1001 (slurm default) if it cannot be obtained (e.g. slurm not available)
+    """
+    try:
+        output = sp.run(
+            ["scontrol", "show", "config"],
+            stdout=sp.PIPE,
+            stderr=sp.DEVNULL,
+            encoding="utf-8",
+            check=True,
+        ).stdout
+    except (OSError, sp.CalledProcessError):
+        return 1001
+    match = re.search(r"MaxArraySize\s*=\s*(\d+)", output)
+    # the task ids go from 0 to MaxArraySize - 1
+    return int(match.group(1)) if match is not None and int(match.group(1)) > 0 else 1001
+
+
+def merge_resource_options(resource_options):
+    """
+    Slurm options (mem, time, cpus-per-task) covering all the given predictions, see `learned_slurm_options`.
+
+    Parameters
+    ----------
+    resource_options: list of dict or None
+
+    Returns
+    -------
+    dict or None: None if one of the predictions is None, the stage defaults are then kept
+    """
+    if not resource_options or any(options is None for options in resource_options):
+        return None
+    mem = max(memory_to_mb(options["mem"]) for options in resource_options)
+    seconds = max(slurm_time_to_seconds(options["time"]) for options in resource_options)
+    return {
+        "mem": f"{mem}M",
+        "time": seconds_to_slurm_time(seconds),
+        "cpus-per-task": max(int(options["cpus-per-task"]) for options in resource_options),
+    }
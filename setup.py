@@ -41,6 +41,14 @@ entry_points = {
         "lstmcpipe_validate_config = lstmcpipe.scripts.script_lstmcpipe_validate_config:main",
         "lstmcpipe_generate_config = lstmcpipe.scripts.lstmcpipe_generate_config:main",
         "lstmcpipe_generate_nsb_levels_configs = lstmcpipe.scripts.generate_nsb_levels_configs:main",
+        "lstmcpipe_stage_cache = lstmcpipe.scripts.script_stage_cache:main",
+        "lstmcpipe_run_manifest = lstmcpipe.scripts.script_run_manifest:main",
+        "lstmcpipe_merge_filelist = lstmcpipe.scripts.script_merge_filelist:main",
+        "lstmcpipe_monitor = lstmcpipe.scripts.script_monitor:main",
+        "lstmcpipe_supervise = lstmcpipe.scripts.script_supervise:main",
+        "lstmcpipe_resource_history = lstmcpipe.scripts.script_resource_history:main",
+        "lstmcpipe_fake_slurm = lstmcpipe.scripts.fake_slurm:main",
+        "lstmcpipe_benchmark_orchestration = lstmcpipe.benchmarks.orchestration:main",
     ]
 }
 